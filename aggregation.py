@@ -0,0 +1,183 @@
+"""
+Combining the distances of many origins into one map, incrementally.
+
+Selecting origins one shift-click at a time used to recompute the reduction
+over all of them every time, a (k, cells) copy for the k-th origin. An
+`OriginAggregate` instead keeps a running state per cell which is updated
+with just the vectors of the origins added or removed:
+
+* `mean` - the sum of finite distances and the count of unreachable ones,
+* `max`/`min` - the extreme so far and how many origins attain it; removing
+  an origin only recomputes the cells where it was the only one attaining it,
+* `percentile` - a histogram of whole minutes per cell (up to
+  `HISTOGRAM_MINUTES`, beyond which distances count as unreachable), from
+  which percentiles are interpolated within a minute.
+
+Vectors are always read in chunks of `chunk_size` origins, so even a whole
+district as the selection never needs more than a chunk's copy.
+"""
+
+import numpy as np
+from typing import Callable, Iterable, List, Sequence
+
+REDUCERS = ['max', 'mean', 'min', 'percentile']
+HISTOGRAM_MINUTES = 240
+DEFAULT_CHUNK_SIZE = 256
+
+def histogram_percentile(histogram: np.ndarray, edges: np.ndarray, percentile: float) -> np.ndarray:
+  """
+  Estimates a percentile (interpolated between ranks like np.percentile) from
+  histograms along the last axis. Bin `i` covers [edges[i], edges[i + 1]) and
+  the last bin everything from edges[-1] up, reported as unreachable (inf).
+  Distances are assumed to be spread evenly within each bin.
+  """
+  last = edges.size - 1
+  counts = histogram.sum(axis=-1)
+  cumulative = np.cumsum(histogram, axis=-1)
+  rank = (counts - 1) * percentile / 100
+  widths = np.diff(edges)
+
+  def rankDistances(rank: np.ndarray) -> np.ndarray:
+    bins = (cumulative <= rank[..., None]).sum(axis=-1)
+    before = np.where(bins > 0, np.take_along_axis(cumulative, np.maximum(bins - 1, 0)[..., None], -1)[..., 0], 0)
+    within = np.take_along_axis(histogram, np.minimum(bins, last)[..., None], -1)[..., 0]
+    distances = edges[np.minimum(bins, last)] + (rank - before + 0.5) / np.maximum(within, 1) * \
+      widths[np.minimum(bins, last - 1)]
+    return np.where(bins >= last, np.inf, distances)
+
+  low, high = rankDistances(np.floor(rank)), rankDistances(np.ceil(rank))
+  with np.errstate(invalid='ignore'):
+    distances = np.where(high > low, low + (high - low) * (rank - np.floor(rank)), low)
+  return np.where(counts > 0, distances, np.nan)
+
+class OriginAggregate:
+  """
+  The distances of a set of origins reduced per cell. `vectors(origins)`
+  returns one row of distances per origin, e.g. `DistanceMatrix.columns`.
+  """
+
+  def __init__(self, vectors: Callable[[Sequence[int]], np.ndarray], cells: int, reducer: str = 'max',
+               percentile: float = 50, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    if reducer not in REDUCERS:
+      raise ValueError('Unknown reducer %r' % reducer)
+    self.vectors = vectors
+    self.cells = cells
+    self.reducer = reducer
+    self.percentile = percentile
+    self.chunk_size = chunk_size
+    self.origins: List[int] = []
+    self.reset()
+
+  def reset(self):
+    self.origins = []
+    if self.reducer == 'mean':
+      self.sums = np.zeros(self.cells)
+      self.unreachable = np.zeros(self.cells, dtype=np.int64)
+    elif self.reducer == 'percentile':
+      self.histogram = np.zeros((self.cells, HISTOGRAM_MINUTES + 1), dtype=np.int64)
+    else:
+      # The minimum is kept as the maximum of negated distances.
+      self.sign = 1 if self.reducer == 'max' else -1
+      self.extreme = np.full(self.cells, -np.inf)
+      self.ties = np.zeros(self.cells, dtype=np.int64)
+
+  def chunks(self, origins: Sequence[int]) -> Iterable[np.ndarray]:
+    for start in range(0, len(origins), self.chunk_size):
+      yield np.asarray(self.vectors(origins[start:start + self.chunk_size]), dtype=float)
+
+  def bins(self, vectors: np.ndarray) -> np.ndarray:
+    """
+    Indices into the flattened histogram of every distance in `vectors`.
+    """
+    minutes = np.minimum(np.nan_to_num(vectors, posinf=HISTOGRAM_MINUTES), HISTOGRAM_MINUTES).astype(np.int64)
+    return (np.arange(self.cells) * (HISTOGRAM_MINUTES + 1))[None, :] + minutes
+
+  def update(self, origins: Sequence[int], added: bool):
+    """
+    Adds (or removes) the vectors of `origins` to the running state.
+    """
+    step = 1 if added else -1
+    for vectors in self.chunks(origins):
+      if self.reducer == 'mean':
+        finite = np.isfinite(vectors)
+        self.sums += step * np.where(finite, vectors, 0).sum(axis=0)
+        self.unreachable += step * (~finite).sum(axis=0)
+      elif self.reducer == 'percentile':
+        counts = np.bincount(self.bins(vectors).ravel(), minlength=self.histogram.size)
+        self.histogram += step * counts.reshape(self.histogram.shape)
+      elif added:
+        vectors = self.sign * vectors
+        extreme = vectors.max(axis=0)
+        ties = (vectors == extreme).sum(axis=0)
+        self.ties = np.where(extreme > self.extreme, ties, self.ties + np.where(extreme == self.extreme, ties, 0))
+        self.extreme = np.maximum(self.extreme, extreme)
+      else:
+        self.ties -= (self.sign * vectors == self.extreme).sum(axis=0)
+
+  def add(self, origins: Sequence[int]):
+    selected = set(self.origins)
+    origins = [origin for origin in dict.fromkeys(int(origin) for origin in origins) if origin not in selected]
+    self.origins += origins
+    self.update(origins, True)
+
+  def remove(self, origins: Sequence[int]):
+    removed = set(int(origin) for origin in origins) & set(self.origins)
+    if len(removed) == 0:
+      return
+    self.origins = [origin for origin in self.origins if origin not in removed]
+    if len(self.origins) == 0:
+      self.reset()
+      return
+    self.update(sorted(removed), False)
+
+    # Cells whose extreme was only attained by removed origins are recomputed
+    # over the remaining ones, only for those cells.
+    if self.reducer in ('max', 'min'):
+      stale = np.flatnonzero(self.ties <= 0)
+      if stale.size > 0:
+        self.extreme[stale] = -np.inf
+        self.ties[stale] = 0
+        for vectors in self.chunks(self.origins):
+          vectors = self.sign * vectors[:, stale]
+          extreme = vectors.max(axis=0)
+          ties = (vectors == extreme).sum(axis=0)
+          self.ties[stale] = np.where(
+            extreme > self.extreme[stale], ties,
+            self.ties[stale] + np.where(extreme == self.extreme[stale], ties, 0)
+          )
+          self.extreme[stale] = np.maximum(self.extreme[stale], extreme)
+
+  def set(self, origins: Sequence[int]):
+    """
+    Changes the selection to `origins`, adding and removing only the difference.
+    """
+    origins = [int(origin) for origin in origins]
+    wanted = set(origins)
+    self.remove([origin for origin in self.origins if origin not in wanted])
+    self.add(origins)
+
+  def setReducer(self, reducer: str, percentile: float = None):
+    """
+    Switches the reducer, rebuilding the state for the current origins.
+    """
+    if reducer not in REDUCERS:
+      raise ValueError('Unknown reducer %r' % reducer)
+    origins = self.origins
+    self.reducer = reducer
+    self.percentile = self.percentile if percentile is None else percentile
+    self.reset()
+    self.add(origins)
+
+  def result(self) -> np.ndarray:
+    """
+    The reduced distances per cell, or None while there are no origins.
+    """
+    count = len(self.origins)
+    if count == 0:
+      return None
+    if self.reducer == 'mean':
+      return np.where(self.unreachable > 0, np.inf, self.sums / count).astype(np.float32)
+    if self.reducer == 'percentile':
+      edges = np.arange(HISTOGRAM_MINUTES + 1, dtype=float)
+      return histogram_percentile(self.histogram, edges, self.percentile).astype(np.float32)
+    return (self.sign * self.extreme).astype(np.float32)
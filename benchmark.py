@@ -0,0 +1,231 @@
+"""
+Benchmarks the hot paths (graph build, shortest paths, heatmap rendering and
+region statistics) against the bundled routes.txt and stops-bg.json and
+against synthetic networks of increasing size. Runs headless and offline.
+
+Example usage: `python benchmark.py --output bench.json --compare baseline.json`
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from typing import Callable, List
+from condensation import CondensedRows
+from heatmap import heat_colors, heat_lut, quantize_distances
+from regions import RegionIndex
+from shortest_paths import DijkstraRows
+from timetable import TimetableEngine, TimetableRows
+from transit import EASTMOST_LAT, WESTMOST_LAT, NORTHMOST_LON, SOUTHMOST_LON, Grid, TransitNetwork, build_graph,\
+  load_network
+
+DEFAULT_SIZES = [25, 50, 100, 200]
+SYNTHETIC_STATIONS = [1000, 2000, 4000]
+SAMPLE_ROWS = 256
+
+def synthetic_network(num_stations: int, seed: int = 0):
+  """
+  Generates random stations and routes in the formats of stops-bg.json and
+  routes.txt. Routes visit ~20 stations each, one per ~3 stations overall.
+  """
+  rng = np.random.default_rng(seed)
+  stations = [
+    {'c': '%05d' % i, 'n': 'STATION %d' % i, 'x': float(x), 'y': float(y)}
+    for i, (x, y) in enumerate(zip(
+      rng.uniform(EASTMOST_LAT, WESTMOST_LAT, num_stations),
+      rng.uniform(SOUTHMOST_LON, NORTHMOST_LON, num_stations)
+    ))
+  ]
+
+  routes = []
+  for _ in range(max(1, num_stations // 3)):
+    visited = rng.choice(num_stations, size=min(20, num_stations), replace=False)
+    elapsed = np.cumsum(rng.integers(1, 4, size=visited.size))
+    stops = [['***', stations[visited[0]]['c']]]
+    for station, minutes in zip(visited[1:], elapsed[1:]):
+      time_str = '+%d' % minutes if rng.random() < 0.5 else '+%d - %d' % (minutes, minutes + 1)
+      stops.append([time_str, stations[station]['c']])
+    routes.append({'stops': stops, 'median_wait': float(rng.integers(5, 30))})
+
+  return routes, stations
+
+def measure(call: Callable[[], object], repeat: int = 1):
+  """
+  Runs `call` `repeat` times, returning its last result, the best wall time in
+  seconds and the peak traced memory in MB. Memory is traced in one extra run,
+  as tracing slows down allocations.
+  """
+  best = np.inf
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = call()
+    best = min(best, time.perf_counter() - start)
+
+  tracemalloc.start()
+  call()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, best, peak / 1024 / 1024
+
+class Benchmark:
+  def __init__(self, repeat: int):
+    self.repeat = repeat
+    self.results: List[dict] = []
+
+  def run(self, stage: str, dataset: str, size: int, call: Callable[[], object], **extra):
+    result, seconds, peak_mb = measure(call, self.repeat)
+    entry = {'stage': stage, 'dataset': dataset, 'size': size, 'seconds': seconds, 'peak_mb': peak_mb}
+    entry.update({key: value(result, seconds) if callable(value) else value for key, value in extra.items()})
+    self.results.append(entry)
+    print('%-24s %-18s %5d  %9.4fs  %8.1fMB' % (stage, dataset, size, seconds, peak_mb))
+    return result
+
+  def networkStages(self):
+    # Parsing routes.txt and stops-bg.json against loading the parsed cache.
+    self.run('network_parse', 'bundled', 0, lambda: TransitNetwork.fromFiles(), stops=lambda n, _: n.num_stops)
+    cache_path = 'benchmark_network.npz'
+    load_network(cache_path=cache_path)
+    self.run('network_load', 'bundled', 0, lambda: load_network(cache_path=cache_path))
+    os.remove(cache_path)
+
+  def graphStages(self, dataset: str, network: TransitNetwork, size: int, sample_rows: int):
+    grid = Grid(size, size)
+    graph = self.run('graph_build', dataset, size, lambda: build_graph(network, grid),
+                     nodes=lambda g, _: g.num_nodes, edges=lambda g, _: int(g.matrix.nnz))
+
+    sample = min(sample_rows, grid.cells)
+    dijkstra_rows = DijkstraRows(graph)
+    self.run('dijkstra_rows', dataset, size, lambda: dijkstra_rows(0, sample),
+             rows=sample, rows_per_sec=lambda _, seconds: sample / seconds)
+
+    condensed = self.run('condensed_setup', dataset, size, lambda: CondensedRows(graph),
+                         linked=lambda rows, _: int(rows.linked.size))
+    self.run('condensed_rows', dataset, size, lambda: condensed(0, sample),
+             rows=sample, rows_per_sec=lambda _, seconds: sample / seconds)
+
+    timetable = TimetableRows(TimetableEngine(network, grid), [8 * 60])
+    self.run('timetable_rows', dataset, size, lambda: timetable(0, sample),
+             rows=sample, rows_per_sec=lambda _, seconds: sample / seconds)
+    return condensed
+
+  def renderStages(self, size: int, distances: np.ndarray, map_shape):
+    # DistanceMap.updateDistances: quantize, then a colour lookup per redraw.
+    def lutRender():
+      indices = quantize_distances(distances).reshape(size, size)[::-1]
+      return heat_lut(0, 60)[indices]
+    self.run('render_lut', 'bundled', size, lutRender)
+
+    # visualize.py compute_heatmap: HSV mapping, resize and blend.
+    try:
+      import cv2
+    except ImportError:
+      return
+    background = np.random.default_rng(0).random(map_shape + (3,), dtype=np.float32)
+    def blendRender():
+      heat = heat_colors(distances.reshape(size, size)[::-1], 0, 90).astype(np.float32)
+      heat = cv2.resize(heat, (map_shape[1], map_shape[0]), interpolation=cv2.INTER_LINEAR)
+      return cv2.addWeighted(heat, 0.5, background, 0.5, 0)
+    self.run('render_blend', 'bundled', size, blendRender)
+
+  def qtStages(self, size: int, distances: np.ndarray):
+    """
+    Times the real DistanceMap widget offscreen, if PyQt5 is available.
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+      from PyQt5 import QtWidgets as widgets
+      from distance_map import DistanceMap
+    except ImportError:
+      return
+
+    app = widgets.QApplication.instance() or widgets.QApplication(['benchmark'])
+    widget = DistanceMap(None, size, size)
+    self.run('qt_update_distances', 'bundled', size, lambda: widget.updateDistances(distances))
+    self.run('qt_set_max_heat', 'bundled', size, lambda: widget.setMaxHeat(75))
+    widget.close()
+
+  def regionStages(self, size: int, distances: np.ndarray):
+    # Regions as blocks of 5x5 squares, like small districts.
+    block = np.arange(size * size)
+    block = (block % size) // 5 + (block // size) // 5 * ((size + 4) // 5)
+    regions = {str(region): np.flatnonzero(block == region).tolist() for region in np.unique(block)}
+    index = RegionIndex.fromMapping(regions)
+    self.run('region_stats', 'bundled', size, lambda: index.stats(distances, [50, 90]), regions=len(regions))
+
+def git_revision() -> str:
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compare(results: List[dict], baseline_path: str, threshold: float) -> bool:
+  """
+  Prints the time ratio of every result to a baseline run and returns whether
+  any got slower by more than `threshold` (e.g. 0.2 for 20%).
+  """
+  with open(baseline_path, 'r') as file:
+    baseline = {(r['stage'], r['dataset'], r['size']): r for r in json.load(file)['results']}
+
+  regressed = False
+  print('\nComparison with %s:' % baseline_path)
+  for result in results:
+    old = baseline.get((result['stage'], result['dataset'], result['size']))
+    if old is None:
+      continue
+    ratio = result['seconds'] / max(old['seconds'], 1e-9)
+    flag = ''
+    if ratio > 1 + threshold:
+      regressed = True
+      flag = '  REGRESSION'
+    print('%-24s %-18s %5d  %6.2fx%s' % (result['stage'], result['dataset'], result['size'], ratio, flag))
+  return regressed
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, dest='sizes')
+  parser.add_argument('--synthetic', nargs='*', type=int, default=SYNTHETIC_STATIONS, dest='synthetic')
+  parser.add_argument('--sample-rows', default=SAMPLE_ROWS, type=int, dest='sample_rows')
+  parser.add_argument('--repeat', default=3, type=int, dest='repeat')
+  parser.add_argument('--output', default='benchmark.json', dest='output')
+  parser.add_argument('--compare', default=None, dest='compare')
+  parser.add_argument('--threshold', default=0.2, type=float, dest='threshold')
+  args = parser.parse_args()
+
+  bench = Benchmark(args.repeat)
+  print('%-24s %-18s %5s  %10s  %10s' % ('stage', 'dataset', 'size', 'time', 'peak mem'))
+
+  bench.networkStages()
+  network = TransitNetwork.fromFiles()
+
+  for size in args.sizes:
+    condensed = bench.graphStages('bundled', network, size, args.sample_rows)
+    distances = condensed(size * size // 2, size * size // 2 + 1)[0]
+    bench.renderStages(size, distances, (896, 970))
+    bench.qtStages(size, distances)
+    bench.regionStages(size, distances)
+
+  # Synthetic networks are only benchmarked at a middle grid size.
+  for num_stations in args.synthetic:
+    synthetic = TransitNetwork.fromJson(*synthetic_network(num_stations))
+    bench.graphStages('synthetic-%d' % num_stations, synthetic, 100, args.sample_rows)
+
+  report = {
+    'revision': git_revision(),
+    'python': sys.version.split()[0],
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'repeat': args.repeat,
+    'results': bench.results,
+  }
+  with open(args.output, 'w') as file:
+    json.dump(report, file, indent=2)
+  print('Results written to %s' % args.output)
+
+  if args.compare is not None and compare(bench.results, args.compare, args.threshold):
+    sys.exit(1)
@@ -0,0 +1,249 @@
+"""
+Station-level condensation of the shortest path problem.
+
+Walking between cells happens on a uniform eight-neighbour lattice, so the
+walking time between two cells has a closed form (the octile distance) and
+only the cells linked to stations need a real graph search. Any shortest path
+from cell a to cell b either walks the whole way, or walks to some linked cell
+p, travels (possibly with further walks between linked cells) to a linked cell
+q and walks on to b:
+
+  d(a, b) = min(walk(a, b), min_{p, q} walk(a, p) + T(p, q) + walk(q, b))
+
+T is computed by Dijkstra over a small graph of linked cells, stations and
+route stops only. Both min-plus products with walking times are evaluated as
+walking transforms over the grid (see `walking_transform`), so a full row
+costs O(width * height) array operations.
+"""
+
+import os
+import tempfile
+import weakref
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from transit import Grid, TransitGraph, edges_to_csr
+
+# Scratch file of the times to linked cells, next to the matrix being built.
+LINKED_TIMES_SUFFIX = '.linked.npy'
+
+def linked_cells(graph: TransitGraph) -> np.ndarray:
+  """
+  Returns the sorted cells having an edge to or from a non-cell node.
+  """
+  coo = graph.matrix.tocoo()
+  cells = graph.grid.cells
+  linked = np.concatenate([coo.row[coo.col >= cells], coo.col[coo.row >= cells]])
+  return np.unique(linked[linked < cells])
+
+def octile_distances(grid: Grid, cells_from: np.ndarray, cells_to: np.ndarray) -> np.ndarray:
+  """
+  Walking times between cells, broadcast elementwise over the two arrays.
+  """
+  dx = np.abs(cells_from % grid.width - cells_to % grid.width)
+  dy = np.abs(cells_from // grid.width - cells_to // grid.width)
+  diagonal = np.minimum(dx, dy)
+  return (dx - diagonal) * grid.walk_x + (dy - diagonal) * grid.walk_y + diagonal * grid.walk_diagonal
+
+def _prefixCounts(counts: np.ndarray) -> np.ndarray:
+  prefix = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+  prefix[1:, 1:] = counts.cumsum(0).cumsum(1)
+  return prefix
+
+def walking_pairs(grid: Grid, linked: np.ndarray, chunk_size: int = 256):
+  """
+  Returns the (from, to) indices into `linked` of the pairs of linked cells
+  that need a direct walking edge between them.
+
+  A walk from p to q is redundant when another linked cell r lies on one of
+  its shortest lattice walks, as walking p -> r -> q costs the same. After
+  mirroring q into the north-east of p, those walks cover a parallelogram which
+  becomes an axis-aligned rectangle once sheared, so the linked cells in it are
+  counted in O(1) per pair from prefix sums over sheared coordinates.
+  """
+  width, height = grid.width, grid.height
+  x, y = linked % width, linked // width
+
+  # One table per mirroring, sheared along x when |dx| >= |dy| (a) and along
+  # y otherwise (b).
+  prefix_a = np.empty((4, width + height, height + 1), dtype=np.int64)
+  prefix_b = np.empty((4, width + height, width + 1), dtype=np.int64)
+  for mirror in range(4):
+    mx = width - 1 - x if mirror & 2 else x
+    my = height - 1 - y if mirror & 1 else y
+    counts_a = np.zeros((width + height - 1, height), dtype=np.int64)
+    np.add.at(counts_a, (mx - my + height - 1, my), 1)
+    counts_b = np.zeros((width + height - 1, width), dtype=np.int64)
+    np.add.at(counts_b, (my - mx + width - 1, mx), 1)
+    prefix_a[mirror] = _prefixCounts(counts_a)
+    prefix_b[mirror] = _prefixCounts(counts_b)
+
+  pairs_from, pairs_to = [], []
+  j = np.arange(linked.size)[None, :]
+  for start in range(0, linked.size, chunk_size):
+    i = np.arange(start, min(start + chunk_size, linked.size))[:, None]
+    dx, dy = x[j] - x[i], y[j] - y[i]
+    mirror = (dx < 0) * 2 + (dy < 0)
+    dx, dy = np.abs(dx), np.abs(dy)
+    px = np.where(mirror & 2, width - 1 - x[i], x[i])
+    py = np.where(mirror & 1, height - 1 - y[i], y[i])
+
+    along_x = dx >= dy
+    u0 = np.where(along_x, px - py + height - 1, py - px + width - 1)
+    u1 = u0 + np.abs(dx - dy) + 1
+    v0 = np.where(along_x, py, px)
+    v1 = v0 + np.where(along_x, dy, dx) + 1
+
+    def rectangle(prefix, limit):
+      lo, hi = np.minimum(v0, limit), np.minimum(v1, limit)
+      return prefix[mirror, u1, hi] - prefix[mirror, u0, hi] - prefix[mirror, u1, lo] + prefix[mirror, u0, lo]
+
+    # The rectangle always contains p and q themselves.
+    inside = np.where(along_x, rectangle(prefix_a, height), rectangle(prefix_b, width))
+    pair_from, pair_to = np.nonzero((inside <= 2) & (i != j))
+    pairs_from.append(pair_from + start)
+    pairs_to.append(pair_to)
+
+  return np.concatenate(pairs_from), np.concatenate(pairs_to)
+
+def station_closure(graph: TransitGraph, linked: np.ndarray, chunk_size: int = 256) -> np.ndarray:
+  """
+  Computes the shortest times T between every pair of linked cells.
+
+  Searches a condensed graph in which the linked cells replace the grid: all
+  edges between non-cell nodes and between them and linked cells are kept,
+  and linked cells are connected by walking edges (see `walking_pairs`).
+  """
+  cells = graph.grid.cells
+  coo = graph.matrix.tocoo()
+  keep = (coo.row >= cells) | (coo.col >= cells)
+
+  # Condensed node numbering: linked cells first, then every non-cell node.
+  node_map = np.full(graph.num_nodes, -1, dtype=np.int64)
+  node_map[linked] = np.arange(linked.size)
+  node_map[cells:] = np.arange(graph.num_nodes - cells) + linked.size
+  num_nodes = linked.size + graph.num_nodes - cells
+
+  walk_from, walk_to = walking_pairs(graph.grid, linked)
+  walking = octile_distances(graph.grid, linked[walk_from], linked[walk_to])
+
+  condensed = edges_to_csr([
+    (node_map[coo.row[keep]], node_map[coo.col[keep]], coo.data[keep]),
+    (walk_from, walk_to, walking),
+  ], num_nodes)
+
+  # Search in chunks of sources, keeping only the columns of linked cells.
+  closure = np.empty((linked.size, linked.size))
+  for start in range(0, linked.size, chunk_size):
+    sources = np.arange(start, min(start + chunk_size, linked.size))
+    closure[sources] = dijkstra(condensed, indices=sources)[:, :linked.size]
+  return closure
+
+def _sweepRows(rows: np.ndarray, ramp: np.ndarray) -> np.ndarray:
+  """
+  Relaxes horizontal walking along a batch of grid rows in both directions.
+  min_k(v[k] + |x - k| * step) is evaluated as a running minimum of v - ramp.
+  """
+  rows = np.minimum(rows, np.minimum.accumulate(rows - ramp, axis=-1) + ramp)
+  reverse = rows[..., ::-1]
+  reverse = np.minimum(reverse, np.minimum.accumulate(reverse - ramp, axis=-1) + ramp)
+  return reverse[..., ::-1]
+
+def walking_transform(values: np.ndarray, grid: Grid) -> np.ndarray:
+  """
+  Given a batch of initial times per cell (shape (batch, cells), inf where
+  unset), returns min over k of values[k] + walk(k, x) for every cell x.
+
+  Shortest walks on the lattice can always be taken monotone in y, so one
+  sweep southwards and one northwards, each relaxing horizontal walking within
+  every row, are exact.
+  """
+  grid_values = values.reshape(-1, grid.height, grid.width).copy()
+  ramp = np.arange(grid.width) * grid.walk_x
+
+  for rows in (range(grid.height), range(grid.height - 1, -1, -1)):
+    prev = None
+    for y in rows:
+      row = grid_values[:, y]
+      if prev is not None:
+        above = prev + grid.walk_y
+        above[:, 1:] = np.minimum(above[:, 1:], prev[:, :-1] + grid.walk_diagonal)
+        above[:, :-1] = np.minimum(above[:, :-1], prev[:, 1:] + grid.walk_diagonal)
+        row = np.minimum(row, above)
+      prev = grid_values[:, y] = _sweepRows(row, ramp)
+
+  return grid_values.reshape(values.shape)
+
+def times_to_linked(grid: Grid, linked: np.ndarray, closure: np.ndarray, batch_size: int = 64,
+                    path: str = None) -> np.ndarray:
+  """
+  Computes the shortest times from every cell to every linked cell q as the
+  walking transform of the times T(p, q) seeded at the linked cells p.
+  Returns a (cells, linked) float32 matrix, or (cells, columns) if given only
+  some columns of T. With `path`, the matrix is written to a .npy file there
+  and returned memory-mapped.
+  """
+  columns = closure.shape[1]
+  if path is None:
+    result = np.empty((grid.cells, columns), dtype=np.float32)
+  else:
+    result = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(grid.cells, columns))
+  for start in range(0, columns, batch_size):
+    stop = min(start + batch_size, columns)
+    seeds = np.full((stop - start, grid.cells), np.inf)
+    seeds[:, linked] = closure[:, start:stop].T
+    result[:, start:stop] = walking_transform(seeds, grid).T
+  if path is not None:
+    result.flush()
+  return result
+
+def _removeScratch(path: str, pid: int):
+  # Forked pool workers inherit the finalizer, but only the owner removes the file.
+  if os.getpid() == pid and os.path.exists(path):
+    os.remove(path)
+
+class CondensedRows:
+  """
+  Computes rows of the distance matrix from the times to linked cells: the
+  row of cell a is the walking transform of a itself (at 0) and every linked
+  cell q (at the time from a to q).
+
+  The times to linked cells ((cells, linked) float32, over a GB on large
+  grids) are kept in a scratch file at `path` (a temporary file by default)
+  and memory-mapped, so that pool workers map the same file instead of each
+  receiving a pickled copy. The file is removed along with this object.
+  """
+
+  def __init__(self, graph: TransitGraph, batch_size: int = 64, path: str = None):
+    if path is None:
+      handle, path = tempfile.mkstemp(suffix='.npy')
+      os.close(handle)
+    self.grid = graph.grid
+    self.path = path
+    self.linked = linked_cells(graph)
+    self.closure = station_closure(graph, self.linked)
+    self._remover = weakref.finalize(self, _removeScratch, path, os.getpid())
+    self.to_linked = times_to_linked(self.grid, self.linked, self.closure, batch_size, path)
+
+  def __getstate__(self) -> dict:
+    # Workers only need the grid, the linked cells and the scratch file's path.
+    state = self.__dict__.copy()
+    for name in ('closure', 'to_linked', '_remover'):
+      del state[name]
+    return state
+
+  def __setstate__(self, state: dict):
+    self.__dict__.update(state)
+    self.closure = None
+    self.to_linked = np.load(self.path, mmap_mode='r')
+
+  def __call__(self, start: int, stop: int) -> np.ndarray:
+    return self.select(np.arange(start, stop))
+
+  def select(self, cells: np.ndarray) -> np.ndarray:
+    """
+    Computes the rows of any set of cells, not necessarily contiguous.
+    """
+    seeds = np.full((cells.size, self.grid.cells), np.inf)
+    seeds[:, self.linked] = self.to_linked[cells]
+    seeds[np.arange(cells.size), cells] = 0
+    return walking_transform(seeds, self.grid)
@@ -1,17 +1,33 @@
 import sys
-import colorsys
+import argparse
+import json
+import os
+import queue
+import time
 import numpy as np
-import threading
-from collections import defaultdict
-from json import JSONDecoder
-from typing import List, Callable, Dict, DefaultDict, Set
+from collections import OrderedDict
+from typing import List, Callable, Dict, Set, Tuple
 from nptyping import Array
 from PyQt5 import QtWidgets as widgets
-from PyQt5.QtGui import QIcon, QPixmap, QImage, QColor, QMouseEvent, QPen, QBrush, QFont
+from PyQt5.QtGui import QIcon, QPixmap, QImage, QMouseEvent, QPen, QBrush, QFont
 from PyQt5 import QtCore
+from aggregation import REDUCERS, OriginAggregate
+from distance_matrix import DISTANCE_MATRIX_FILE, DistanceMatrix
+from heatmap import heat_lut, quantize_distances
+from regions import SQUARE_INFO_FILE, RegionIndex, load_region_index
+from region_matrix import RegionMatrix, load_region_matrix
+from query_engine import DistanceQueryEngine
+from pyramid import PYRAMID_FILE, DistancePyramid, PyramidLevel
+from transit import Grid, StationIndex, load_network, walking_minutes
 
-HOR_PIXELS, VER_PIXELS = 100, 100
 HOVER_TEXTBOX_PADDING = 5
+SHADOW_MASK_CACHE_BYTES = 64 * 1024 * 1024
+ZOOM_STEP = 1.25
+MAX_ZOOM = 16
+SESSION_FILE = 'distance_map_session.json'
+LOADER_QUIT_WAIT_MS = 500
+NEAREST_STOPS = 3
+NEAREST_STOPS_KM = 1.0
 
 class DistanceMap(widgets.QGraphicsView):
   """
@@ -19,6 +35,7 @@ class DistanceMap(widgets.QGraphicsView):
   """
   
   originsUpdated = QtCore.pyqtSignal(set)
+  zoomChanged = QtCore.pyqtSignal(float)
   
   shift_down = False
   curr_origins: Set[int] = set()
@@ -33,7 +50,15 @@ class DistanceMap(widgets.QGraphicsView):
     self.hor_pixels = hor_pixels
     self.ver_pixels = ver_pixels
     
+    # Regions (and so shadow masks) stay on the grid the map was opened with,
+    # while zooming in may switch the heat to a finer one.
+    self.region_hor_pixels = hor_pixels
+    self.region_ver_pixels = ver_pixels
+    self.zoom = 1.0
+    
     self.curr_distances = None
+    self.curr_heat_indices = None
+    self.heat_lut = heat_lut(self.min_heat, self.max_heat)
     self.onMouseClickHandler: Callable[[QMouseEvent], None] = None
     self.hoverTextHandler: Callable[[int, int], str] = None
     
@@ -68,48 +93,75 @@ class DistanceMap(widgets.QGraphicsView):
     self.shadow_mask.setOpacity(0.5)
     self.shadow_mask.setVisible(False)
     
+    # Ready-made shadow mask pixmaps of recently hovered regions.
+    self.shadow_mask_cache: OrderedDict = OrderedDict()
+    self.shadow_mask_cache_size = max(1, SHADOW_MASK_CACHE_BYTES // (shdw_mask.width() * shdw_mask.height() * 4))
+    
     self.show()
     
   def updateDistances(self, distances):
     """
-    Updates the heat colors of the distance map according to a two-dimensional 
-    numpy array.
+    Updates the heat colors of the distance map according to a numpy array of
+    distances per square.
+    
+    The distances are quantized into color lookup table indices once, laid out
+    as image rows (flipping Y), so that redrawing only takes a table lookup.
     """
     self.curr_distances = distances
+    indices = quantize_distances(distances).reshape(self.ver_pixels, self.hor_pixels)
+    self.curr_heat_indices = np.ascontiguousarray(indices[::-1])
+    self.redrawHeat()
+    
+  def redrawHeat(self):
+    """
+    Colors the current distances through the lookup table and wraps the
+    resulting RGBA array into an image without any per-pixel calls.
+    """
+    if self.curr_heat_indices is None:
+      return
     
-    img = QImage(self.hor_pixels, self.ver_pixels, QImage.Format_RGBA8888)
-    for x in range(self.hor_pixels):
-      for y in range(self.ver_pixels):
-        img.setPixelColor(x, y, self.distance_to_color(distances[int(x + (self.ver_pixels - y - 1) * self.hor_pixels)]))
+    self.heat_rgba = self.heat_lut[self.curr_heat_indices]
+    img = QImage(self.heat_rgba.data, self.hor_pixels, self.ver_pixels, self.hor_pixels * 4, QImage.Format_RGBA8888)
     
     pixmap: QPixmap = QPixmap.fromImage(img)
     pixmap = pixmap.scaled(self.map_image.pixmap().width(), self.map_image.pixmap().height())
     self.heat_image.setPixmap(pixmap)
     
+  def setResolution(self, hor_pixels: int, ver_pixels: int, origins: Set[int]):
+    """
+    Switches the heat to a grid of a different resolution, on which the
+    current origins are `origins`. New distances are expected to follow.
+    """
+    self.hor_pixels = hor_pixels
+    self.ver_pixels = ver_pixels
+    self.curr_origins = set(origins)
+    self.curr_distances = None
+    self.curr_heat_indices = None
+    self.hover_rect.setVisible(False)
+    
+  def wheelEvent(self, event):
+    """
+    Zooms in and out around the mouse cursor, between the whole map and
+    `MAX_ZOOM` times that.
+    """
+    zoom = min(max(self.zoom * ZOOM_STEP ** (event.angleDelta().y() / 120), 1.0), MAX_ZOOM)
+    if zoom == self.zoom:
+      return
+    
+    self.setTransformationAnchor(widgets.QGraphicsView.AnchorUnderMouse)
+    self.scale(zoom / self.zoom, zoom / self.zoom)
+    self.zoom = zoom
+    self.zoomChanged.emit(zoom)
+    
   def setMinHeat(self, new_min_heat):
-    print(new_min_heat)
     self.min_heat = new_min_heat
-    self.updateDistances(self.curr_distances)
+    self.heat_lut = heat_lut(self.min_heat, self.max_heat)
+    self.redrawHeat()
   
   def setMaxHeat(self, new_max_heat):
-    print(new_max_heat)
     self.max_heat = new_max_heat
-    self.updateDistances(self.curr_distances)
-    
-  def distance_to_color(self, distance) -> QColor:
-    """
-    Computes a QColor given some temporal distance value. Takes into account
-    the current min_heat and max_heat.
-    """
-    
-    heat_range = self.max_heat - self.min_heat
-    out = QColor.fromHsvF(
-      min(max(distance-self.min_heat, 0), heat_range) / ((heat_range)*1.5),
-      1,
-      1 - min(max(distance-self.min_heat, 0), heat_range) / (heat_range) / 2,
-      0.5
-    )
-    return out
+    self.heat_lut = heat_lut(self.min_heat, self.max_heat)
+    self.redrawHeat()
   
   def windowToSquareX(self, x: float) -> int:
     return int(x / self._scene.width() * self.hor_pixels)
@@ -134,8 +186,12 @@ class DistanceMap(widgets.QGraphicsView):
         
         if not self.shift_down:
           self.curr_origins.clear()
+          self.curr_origins.add(new_origin)
+        elif new_origin in self.curr_origins:
+          self.curr_origins.remove(new_origin)
+        else:
+          self.curr_origins.add(new_origin)
 
-        self.curr_origins.add(new_origin)
         print(self.curr_origins)
         self.originsUpdated.emit(self.curr_origins)
         
@@ -190,26 +246,44 @@ class DistanceMap(widgets.QGraphicsView):
     
     self.hover_text_bg.setOpacity(0.5)
     
-  def shadowMaskSquares(self, squares: List[int]):
+  def renderShadowMask(self, squares: List[int]) -> QPixmap:
     """
-    Enables the shadow mask, highlighting only a given set of squares.
+    Renders a black mask at the map's resolution which is transparent over the
+    given squares.
     """
-    new_shadow_mask = QImage(self.map_image.pixmap().width(), self.map_image.pixmap().height(), QImage.Format_RGBA8888)
-    new_shadow_mask.fill(QtCore.Qt.black)
-    print('Shadow_mask size: %.2f, %.2f' % (new_shadow_mask.width(), new_shadow_mask.height()))
+    width, height = self.map_image.pixmap().width(), self.map_image.pixmap().height()
     
-    square_width = self.map_image.boundingRect().width() / self.hor_pixels
-    square_height = self.map_image.boundingRect().height() / self.ver_pixels
-    for square_number in squares:
-      sq_x, sq_y = square_number % self.hor_pixels, square_number // self.hor_pixels
-      sq_y = self.ver_pixels - sq_y - 1 # Invert Y.
-      window_x, window_y = sq_x * square_width, sq_y * square_height
-      
-      for x in range(int(window_x), min(int(window_x + square_width + 1), new_shadow_mask.width())):
-        for y in range(int(window_y), min(int(window_y + square_height + 1), new_shadow_mask.height())):
-          new_shadow_mask.setPixelColor(x, y, QtCore.Qt.transparent)
+    hor_pixels, ver_pixels = self.region_hor_pixels, self.region_ver_pixels
+    
+    in_region = np.zeros(hor_pixels * ver_pixels, dtype=bool)
+    in_region[np.asarray(squares, dtype=np.int64)] = True
+    in_region = in_region.reshape(ver_pixels, hor_pixels)[::-1] # Invert Y.
+    
+    # The square each pixel column and row falls in.
+    square_x = np.arange(width) * hor_pixels // width
+    square_y = np.arange(height) * ver_pixels // height
+    
+    mask = np.zeros((height, width, 4), dtype=np.uint8)
+    mask[:, :, 3] = np.where(in_region[square_y][:, square_x], 0, 255)
+    img = QImage(mask.data, width, height, width * 4, QImage.Format_RGBA8888)
+    return QPixmap.fromImage(img)
+    
+  def shadowMaskSquares(self, squares: List[int], key: str = None):
+    """
+    Enables the shadow mask, highlighting only a given set of squares. Masks
+    with a `key` (e.g. the region's name) are built once and cached.
+    """
+    if key is None:
+      pixmap = self.renderShadowMask(squares)
+    elif key in self.shadow_mask_cache:
+      pixmap = self.shadow_mask_cache[key]
+      self.shadow_mask_cache.move_to_end(key)
+    else:
+      pixmap = self.shadow_mask_cache[key] = self.renderShadowMask(squares)
+      if len(self.shadow_mask_cache) > self.shadow_mask_cache_size:
+        self.shadow_mask_cache.popitem(last=False)
       
-    self.shadow_mask.setPixmap(QPixmap.fromImage(new_shadow_mask))
+    self.shadow_mask.setPixmap(pixmap)
     self.shadow_mask.setVisible(True)
   
   def clearShadowMask(self):
@@ -261,9 +335,102 @@ class NumericTableWidgetItem(widgets.QTableWidgetItem):
     
     return super(NumericTableWidgetItem, self).__lt__(other)
 
+class AssetLoader(QtCore.QThread):
+  """
+  Loads what the map can do without in the background, so that it is
+  interactive right away: the distance source if it takes time to build (an
+  on-demand query engine), the region index and region matrix, the stations
+  for listing the stops near the hovered square, and then the
+  distances of likely origins, which warms the page cache (or the query
+  engine's cache) before they are clicked. After that, it builds the query
+  engines of finer pyramid levels when they are first zoomed into. Stops
+  between items once interrupted, e.g. when the viewer quits.
+  """
+  
+  progress = QtCore.pyqtSignal(str)
+  sourceLoaded = QtCore.pyqtSignal(object)
+  regionsLoaded = QtCore.pyqtSignal(object, object)
+  stationsLoaded = QtCore.pyqtSignal(object)
+  levelLoaded = QtCore.pyqtSignal(int)
+  
+  def __init__(self, source, source_factory: Callable[[], object], direction: str, likely_origins: List[int]):
+    super().__init__()
+    self.source = source
+    self.source_factory = source_factory
+    self.direction = direction
+    self.likely_origins = likely_origins
+    self.levels = queue.Queue()
+  
+  def loadLevel(self, level: PyramidLevel, origins: List[int]):
+    """
+    Queues building a level's query engine and computing the distances of
+    `origins` on it.
+    """
+    self.levels.put((level, origins))
+    
+  def run(self):
+    if self.source is None:
+      self.progress.emit('Building the transit graph...')
+      self.source = self.source_factory()
+      self.sourceLoaded.emit(self.source)
+    
+    if self.isInterruptionRequested():
+      return
+    self.progress.emit('Loading regions...')
+    region_index = load_region_index()
+    region_matrix = None
+    if not region_index.fitsGrid(self.source.width, self.source.height):
+      print('%s is for a %dx%d grid, region statistics are disabled' % (
+        SQUARE_INFO_FILE, region_index.width, region_index.height
+      ))
+      region_index = None
+    elif isinstance(self.source, DistanceMatrix):
+      region_matrix = load_region_matrix(matrix=self.source)
+      if region_matrix is not None and region_matrix.names != region_index.names:
+        region_matrix = None
+    self.regionsLoaded.emit(region_index, region_matrix)
+    
+    if self.isInterruptionRequested():
+      return
+    self.progress.emit('Loading stations...')
+    try:
+      self.stationsLoaded.emit(StationIndex.fromNetwork(load_network()))
+    except OSError as error:
+      print('Could not load the stations: %s' % error)
+    
+    self.progress.emit('Prefetching %d likely origins...' % len(self.likely_origins))
+    vectors = self.source.rows if self.direction == 'from' else self.source.columns
+    for origin in self.likely_origins:
+      if self.isInterruptionRequested():
+        return
+      vectors([origin])
+    self.progress.emit('Ready')
+    
+    while not self.isInterruptionRequested():
+      try:
+        level, origins = self.levels.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      self.progress.emit('Building the %dx%d graph of level %d...' % (level.width, level.height, level.level))
+      level.engine()
+      vectors = level.rows if self.direction == 'from' else level.columns
+      for origin in origins:
+        vectors([origin])
+      self.levelLoaded.emit(level.level)
+      self.progress.emit('Ready')
+
 class App(widgets.QApplication):
-  def __init__(self):
+  def __init__(self, distance_source=None, pyramid: DistancePyramid = None,
+               source_factory: Callable[[], object] = None, grid_size: Tuple[int, int] = None):
+    """
+    `distance_source` is anything serving distance rows and columns for the
+    grid, by default the memory-mapped distance matrix file. With a `pyramid`,
+    zooming in switches to its finer levels. A source which takes a while to
+    build is given as a `source_factory` for a grid of `grid_size` instead,
+    and built in the background.
+    """
     super().__init__(sys.argv)
+    self.start_time = time.time()
     
     self.setStyle('Fusion')
     
@@ -273,8 +440,23 @@ class App(widgets.QApplication):
     # On the left - Distance map and heat adjustment controls
     self.left_layout = widgets.QVBoxLayout()
     
-    self.dist_map_widget = DistanceMap(None, HOR_PIXELS, VER_PIXELS)
+    # Memory-map the distance matrix (unless given another source or a
+    # pyramid), which also tells us the grid's size. Mapping takes no time
+    # whatever the matrix's size, so the first click is answered at once.
+    self.pyramid: DistancePyramid = None
+    self.distance_map_raw: PyramidLevel = None
+    if source_factory is None:
+      self.pyramid = pyramid or DistancePyramid.single(distance_source or DistanceMatrix(DISTANCE_MATRIX_FILE))
+      self.distance_map_raw = self.pyramid.levels[0]
+      self.hor_pixels, self.ver_pixels = self.distance_map_raw.width, self.distance_map_raw.height
+    else:
+      self.hor_pixels, self.ver_pixels = grid_size
+    self.level = 0
+    self.wanted_level = 0
+    
+    self.dist_map_widget = DistanceMap(None, self.hor_pixels, self.ver_pixels)
     self.dist_map_widget.originsUpdated.connect(self.setOrigins)
+    self.dist_map_widget.zoomChanged.connect(self.onZoomChanged)
     self.left_layout.addWidget(self.dist_map_widget)
     
     self.min_heat_slider = widgets.QSlider(QtCore.Qt.Horizontal)
@@ -295,65 +477,154 @@ class App(widgets.QApplication):
     self.max_heat_slider.valueChanged.connect(self.onMaxHeatChanged)
     self.left_layout.addWidget(self.max_heat_slider)
     
+    # How the distances of several sources are combined.
+    self.reducer_layout = widgets.QHBoxLayout()
+    self.reducer_box = widgets.QComboBox()
+    self.reducer_box.addItems(REDUCERS)
+    self.reducer_box.currentTextChanged.connect(self.onReducerChanged)
+    self.reducer_layout.addWidget(self.reducer_box)
+    self.percentile_box = widgets.QSpinBox()
+    self.percentile_box.setRange(0, 100)
+    self.percentile_box.setValue(50)
+    self.percentile_box.setSuffix('th percentile')
+    self.percentile_box.setEnabled(False)
+    self.percentile_box.valueChanged.connect(self.onReducerChanged)
+    self.reducer_layout.addWidget(self.percentile_box)
+    self.left_layout.addLayout(self.reducer_layout)
+    
     self.layout.addLayout(self.left_layout)
     
-    # On the right - Region selection
+    # On the right - Loading status and region selection, whose rows are
+    # added once the regions are loaded.
     self.right_layout = widgets.QVBoxLayout()
+    self.status_label = widgets.QLabel('Loading...')
+    self.right_layout.addWidget(self.status_label)
+    self.region_table_widget = DistrictTableWidget(0, 4)
+    self.region_table_widget.setHorizontalHeaderLabels(['Region', 'Average', 'Median', '90th percentile'])
+    self.region_table_widget.setMouseTracking(True)
+    self.region_table_widget.rowEntered.connect(self.onDistrictRowHover)
+    self.region_table_widget.cellDoubleClicked.connect(self.onDistrictRowDoubleClicked)
+    self.right_layout.addWidget(self.region_table_widget)
     self.layout.addLayout(self.right_layout)
     
     self.window.setLayout(self.layout)
     self.window.show()
     
-    # Load distance map from file asynchronously.
-    self.distance_map_raw: NpzFile = None
-    threading.Thread(
-      target=lambda: self.onDistanceMapLoaded(np.load('distance_matrix.npy')),
-      daemon=True
-    ).start()
-    
-    # Load squares area affiliation.
-    self.square_affiliation: DefaultDict[int, Set[str]] = defaultdict(lambda: set())
-    self.regions_to_squares: DefaultDict[str, List[int]] = defaultdict(lambda: [])
-    self.fetchSquareInfo()
+    self.region_index: RegionIndex = None
+    self.region_matrix: RegionMatrix = None
+    self.station_index: StationIndex = None
     self.dist_map_widget.setHoverTextHandler(self.squareInfoToString)
     
-    self.region_table_widget = DistrictTableWidget(len(self.regions_to_squares.keys()), 3)
-    for i, region in enumerate(self.regions_to_squares.keys()):
-      self.region_table_widget.setItem(i, 0, widgets.QTableWidgetItem(region))
-      self.region_table_widget.setItem(i, 1, NumericTableWidgetItem(0))
-      self.region_table_widget.setItem(i, 2, NumericTableWidgetItem(0))
-    self.region_table_widget.setSortingEnabled(True)
-    self.region_table_widget.setMouseTracking(True)
-    self.region_table_widget.rowEntered.connect(self.onDistrictRowHover)
-    self.right_layout.addWidget(self.region_table_widget)
-    
     self.direction = 'to'
     self.origins = []
     
-  def onDistanceMapLoaded(self, result):
-    self.distance_map_raw = result
-    print("Loaded!")
+    # The sources' distances combined per level, updated as sources are added
+    # and removed rather than recomputed.
+    self.aggregates: Dict[int, OriginAggregate] = {}
+    
+    # Origins as points (fractions of the map's width and height), so that
+    # they carry over between levels.
+    self.origin_points = []
+    
+    # Load the rest in the background. Clicks in the meantime are shown as
+    # soon as what they need is there.
+    self.loader = AssetLoader(
+      self.distance_map_raw.source if self.distance_map_raw is not None else None, source_factory,
+      self.direction, self.likelyOrigins()
+    )
+    self.loader.progress.connect(self.onLoadingProgress)
+    self.loader.sourceLoaded.connect(self.onSourceLoaded)
+    self.loader.regionsLoaded.connect(self.onRegionsLoaded)
+    self.loader.stationsLoaded.connect(self.onStationsLoaded)
+    self.loader.levelLoaded.connect(self.onLevelLoaded)
+    self.aboutToQuit.connect(self.saveSession)
+    self.loader.start()
+    
+  def likelyOrigins(self) -> List[int]:
+    """
+    The squares most likely to be clicked first: the map's centre and the
+    sources of the last session.
+    """
+    points = [(0.5, 0.5)]
+    if os.path.exists(SESSION_FILE):
+      try:
+        with open(SESSION_FILE, 'r') as file:
+          points += [tuple(point) for point in json.load(file)['origin_points']]
+      except (ValueError, KeyError, TypeError) as error:
+        print('Could not read %s: %s' % (SESSION_FILE, error))
+    
+    origins = []
+    for fx, fy in points:
+      x = min(max(int(fx * self.hor_pixels), 0), self.hor_pixels - 1)
+      y = min(max(int(fy * self.ver_pixels), 0), self.ver_pixels - 1)
+      origins.append(x + y * self.hor_pixels)
+    return list(dict.fromkeys(origins))
   
-  def fetchSquareInfo(self):
+  def saveSession(self):
     """
-    Load all the prefetched information about the squares' regional affiliation.
+    Remembers the sources, to prefetch them on the next start, and stops the
+    loader. A graph being built can't be interrupted, so it is only waited
+    for briefly.
     """
+    with open(SESSION_FILE + '.tmp', 'w') as file:
+      json.dump({'origin_points': self.origin_points}, file)
+    os.replace(SESSION_FILE + '.tmp', SESSION_FILE)
+    self.loader.requestInterruption()
+    self.loader.wait(LOADER_QUIT_WAIT_MS)
+  
+  def onLoadingProgress(self, message: str):
+    self.status_label.setText(message)
+    if message == 'Ready' and self.start_time is not None:
+      print('Loaded everything in %.2fs' % (time.time() - self.start_time))
+      self.start_time = None
+  
+  def onSourceLoaded(self, source):
+    self.pyramid = DistancePyramid.single(source)
+    self.distance_map_raw = self.pyramid.levels[0]
+    if len(self.origin_points) > 0:
+      self.showOrigins()
+  
+  def onRegionsLoaded(self, region_index: RegionIndex, region_matrix: RegionMatrix):
+    """
+    Adds the regions to the table, with the statistics of any sources selected
+    while they were loading.
+    """
+    self.region_index = region_index
+    self.region_matrix = region_matrix
+    if self.region_index is None:
+      return
     
-    with open('square_info.json', 'r') as file:
-      decoder = JSONDecoder()
-      square_info_json = decoder.decode(file.read())
-      for square_number, info in square_info_json.items():
-        if info == None:
-          continue
-        
-        self.square_affiliation[int(square_number)].update(value for key, value in info.items())
-        for key, value in info.items():
-          self.regions_to_squares[value].append(int(square_number))
+    self.region_table_widget.setSortingEnabled(False)
+    self.region_table_widget.setRowCount(len(self.region_index.names))
+    for i, region in enumerate(self.region_index.names):
+      self.region_table_widget.setItem(i, 0, widgets.QTableWidgetItem(region))
+      self.region_table_widget.setItem(i, 1, NumericTableWidgetItem(0))
+      self.region_table_widget.setItem(i, 2, NumericTableWidgetItem(0))
+      self.region_table_widget.setItem(i, 3, NumericTableWidgetItem(0))
+    self.region_table_widget.setSortingEnabled(True)
+    
+    if self.pyramid is not None and len(self.origin_points) > 0:
+      self.showRegionStats(self.combinedDistances(0))
+  
+  def onStationsLoaded(self, station_index: StationIndex):
+    self.station_index = station_index
   
   def squareInfoToString(self, x: int, y: int) -> str:
-    if self.square_affiliation == None:
-      return ''
-    return '\n'.join(list(self.square_affiliation[x + y * HOR_PIXELS]))
+    lines = []
+    if self.region_index is not None:
+      # Regions are known on the coarsest level's squares.
+      lines += self.region_index.regionsOf((x >> self.level) + (y >> self.level) * self.hor_pixels)
+    if self.station_index is not None:
+      grid = Grid(self.dist_map_widget.hor_pixels, self.dist_map_widget.ver_pixels)
+      # Both platforms of a stop usually share its name, so list each name once.
+      stations, km = self.station_index.nearest(
+        (x + 0.5) * grid.cell_width, (y + 0.5) * grid.cell_height, NEAREST_STOPS * 4, NEAREST_STOPS_KM
+      )
+      stops = {}
+      for station, minutes in zip(stations, walking_minutes(km)):
+        stops.setdefault(self.station_index.names[station], minutes)
+      lines += ['%s (%d min walk)' % (name, round(minutes)) for name, minutes in list(stops.items())[:NEAREST_STOPS]]
+    return '\n'.join(lines)
     
   def onMinHeatChanged(self, value):
     self.dist_map_widget.setMinHeat(value)
@@ -363,25 +634,125 @@ class App(widgets.QApplication):
     self.dist_map_widget.setMaxHeat(value)
     self.min_heat_slider.setMaximum(value)
   
-  def setOrigins(self, origins: Set[int]):
-    self.origins = list(origins)
-    if self.direction == 'from':
-      distances = np.max(self.distance_map_raw[self.origins, :], axis=0)
-    else:
-      distances = np.max(self.distance_map_raw[:, self.origins], axis=1)
+  def onZoomChanged(self, zoom: float):
+    """
+    Switches to the pyramid level matching the zoom, carrying the origins over.
+    A level without its query engine yet has it built in the background,
+    meanwhile the current level stays on screen.
+    """
+    if self.pyramid is None:
+      return
+    self.wanted_level = self.pyramid.levelForZoom(zoom)
+    if self.wanted_level == self.level:
+      return
     
-    self.dist_map_widget.updateDistances(distances)
-      
+    grid = self.pyramid.levels[self.wanted_level]
+    if grid.source is None:
+      self.loader.loadLevel(grid, [grid.cellAt(fx, fy) for fx, fy in self.origin_points])
+      return
+    self.showLevel(self.wanted_level)
+  
+  def onLevelLoaded(self, level: int):
+    if level == self.wanted_level and level != self.level:
+      self.showLevel(level)
+  
+  def showLevel(self, level: int):
+    self.level = level
+    self.aggregates = {key: aggregate for key, aggregate in self.aggregates.items() if key == 0}
+    grid = self.pyramid.levels[level]
+    self.dist_map_widget.setResolution(
+      grid.width, grid.height, {grid.cellAt(fx, fy) for fx, fy in self.origin_points}
+    )
+    print('Showing level %d (%dx%d)' % (level, grid.width, grid.height))
+    if len(self.origin_points) > 0:
+      self.showOrigins()
+  
+  def onReducerChanged(self, _):
+    reducer = self.reducer_box.currentText()
+    self.percentile_box.setEnabled(reducer == 'percentile')
+    for aggregate in self.aggregates.values():
+      aggregate.setReducer(reducer, self.percentile_box.value())
+    if len(self.origin_points) > 0:
+      self.showOrigins()
+  
+  def combinedDistances(self, level: int) -> np.ndarray:
+    """
+    The distances from (or to) the origins combined per cell of a level, by
+    the selected reducer.
+    """
+    grid = self.pyramid.levels[level]
+    if level not in self.aggregates:
+      self.aggregates[level] = OriginAggregate(
+        grid.rows if self.direction == 'from' else grid.columns, grid.cells,
+        self.reducer_box.currentText(), self.percentile_box.value()
+      )
+    aggregate = self.aggregates[level]
+    aggregate.set([grid.cellAt(fx, fy) for fx, fy in self.origin_points])
+    return aggregate.result()
+  
+  def setOrigins(self, origins: Set[int]):
+    hor_pixels, ver_pixels = self.dist_map_widget.hor_pixels, self.dist_map_widget.ver_pixels
+    self.origin_points = [
+      ((origin % hor_pixels + 0.5) / hor_pixels, (origin // hor_pixels + 0.5) / ver_pixels) for origin in origins
+    ]
+    # Without a source yet, the latest selection is shown once it is built.
+    if self.pyramid is None:
+      return
+    self.showOrigins()
+  
+  def showOrigins(self):
+    """
+    Shows the distances of the origins on the current level and fills in the
+    region statistics from the coarsest one, on whose squares regions are known.
+    """
+    self.origins = [self.distance_map_raw.cellAt(fx, fy) for fx, fy in self.origin_points]
+    distances = self.combinedDistances(0)
+    if distances is None:
+      return
+    self.dist_map_widget.updateDistances(distances if self.level == 0 else self.combinedDistances(self.level))
+    if self.region_index is not None:
+      self.showRegionStats(distances)
+  
+  def showRegionStats(self, distances: np.ndarray):
+    """
+    Computes every region's statistics in one pass.
+    """
+    averages, (medians, p90s) = self.region_index.stats(distances, [50, 90])
+    self.fillRegionTable(averages, medians, p90s)
+  
+  def fillRegionTable(self, averages: np.ndarray, medians: np.ndarray, p90s: np.ndarray):
+    """
+    Fills in the table with sorting suspended, so that rows don't move while
+    being updated.
+    """
+    self.region_table_widget.setUpdatesEnabled(False)
+    self.region_table_widget.setSortingEnabled(False)
     for row in range(self.region_table_widget.rowCount()):
-      region_name = self.region_table_widget.item(row, 0).text()
-      distances_to_region = distances[self.regions_to_squares[region_name]]
-      self.region_table_widget.item(row, 1).setText('%.2f' % np.average(distances_to_region))
-      self.region_table_widget.item(row, 2).setText('%.2f' % np.median(distances_to_region))
+      region = self.region_index.ids[self.region_table_widget.item(row, 0).text()]
+      self.region_table_widget.item(row, 1).setText('%.2f' % averages[region])
+      self.region_table_widget.item(row, 2).setText('%.2f' % medians[region])
+      self.region_table_widget.item(row, 3).setText('%.2f' % p90s[region])
+    self.region_table_widget.setSortingEnabled(True)
+    self.region_table_widget.setUpdatesEnabled(True)
+  
+  def onDistrictRowDoubleClicked(self, row: int, column: int):
+    """
+    Shows the travel times between the double-clicked region and every other
+    region (from the region matrix) in the table.
+    """
+    district_name = self.region_table_widget.item(row, 0).text()
+    if self.region_matrix is None:
+      print('No region matrix for this distance matrix, run region_matrix.py first')
+      return
+    print('Travel times %s %s' % ('from' if self.direction == 'from' else 'to', district_name))
+    self.fillRegionTable(*self.region_matrix.stats(district_name, self.direction))
       
   def onDistrictRowHover(self, row: int):
+    if self.region_index is None:
+      return
     district_name = self.region_table_widget.item(row, 0).text()
     print('District %d hovered - %s' % (row, district_name))
-    self.dist_map_widget.shadowMaskSquares(self.regions_to_squares[district_name])
+    self.dist_map_widget.shadowMaskSquares(self.region_index.squaresOf(district_name), key=district_name)
       
   def invertSquareNumber(self, sq_number: int) -> int:
     """
@@ -391,10 +762,29 @@ class App(widgets.QApplication):
     flipping the y coordinate and transforming the new pair into a square number.
     """
     
-    x, y = sq_number % HOR_PIXELS, sq_number // HOR_PIXELS
-    y = VER_PIXELS - y - 1
-    return x + y * HOR_PIXELS
+    x, y = sq_number % self.hor_pixels, sq_number // self.hor_pixels
+    y = self.ver_pixels - y - 1
+    return x + y * self.hor_pixels
 
 if __name__ == '__main__':
-  app = App()
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--on-demand', action='store_true', dest='on_demand')
+  parser.add_argument('--width', default=100, type=int, dest='width')
+  parser.add_argument('--height', default=100, type=int, dest='height')
+  parser.add_argument('--walk-radius', default=0, type=float, dest='walk_radius')
+  parser.add_argument('--pyramid', nargs='?', const=PYRAMID_FILE, default=None, dest='pyramid')
+  parser.add_argument('--server', default=None, dest='server')
+  args, _ = parser.parse_known_args()
+  
+  source, source_factory = None, None
+  if args.on_demand:
+    # Building the graph takes a while, so it is built once the window is up.
+    source_factory = lambda: DistanceQueryEngine.fromFiles(args.width, args.height, walk_radius=args.walk_radius)
+  elif args.server is not None:
+    # A thin client of server.py, which maps the matrix for every viewer.
+    from server import DistanceClient
+    source = DistanceClient(args.server)
+  app = App(
+    source, DistancePyramid.load(args.pyramid) if args.pyramid else None, source_factory, (args.width, args.height)
+  )
   sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,197 @@
+import json
+import os
+import struct
+import numpy as np
+from typing import Dict, Sequence
+
+DISTANCE_MATRIX_FILE = 'distance_matrix.bin'
+
+MAGIC = b'SDMX'
+VERSION = 1
+HEADER_ALIGN = 4096
+
+# Distances are stored as tenths of a minute in a uint16, which covers up to
+# ~109 hours. The largest value marks unreachable cells.
+DEFAULT_SCALE = 10
+UNREACHABLE = np.iinfo(np.uint16).max
+
+def quantize(minutes: np.ndarray, scale: float = DEFAULT_SCALE) -> np.ndarray:
+  """
+  Converts distances in minutes into stored values.
+  """
+  minutes = np.asarray(minutes, dtype=float)
+  values = np.full(minutes.shape, UNREACHABLE, dtype=np.uint16)
+  finite = np.isfinite(minutes)
+  values[finite] = np.clip(np.rint(minutes[finite] * scale), 0, UNREACHABLE - 1)
+  return values
+
+def dequantize(values: np.ndarray, scale: float = DEFAULT_SCALE) -> np.ndarray:
+  """
+  Converts stored values into float32 minutes, with unreachable cells as inf.
+  """
+  minutes = values.astype(np.float32) / np.float32(scale)
+  minutes[values == UNREACHABLE] = np.inf
+  return minutes
+
+class DistanceMatrix:
+  """
+  A memory-mapped matrix of quantized temporal distances between grid cells.
+
+  The file starts with a small binary preamble (magic, version, header length),
+  followed by a JSON header carrying the grid dimensions, bounding box, scale
+  and source data hashes, padded to a page boundary. The (cells, cells) uint16
+  matrix follows in row-major order, row `i` holding distances from cell `i`.
+
+  Optionally the file also holds the transposed matrix right after it, so that
+  columns (distances to a cell) are read as contiguously as rows are.
+  """
+
+  def __init__(self, path: str = DISTANCE_MATRIX_FILE, mode: str = 'r'):
+    self.path = path
+
+    with open(path, 'rb') as file:
+      magic, version, header_len = struct.unpack('<4sII', file.read(12))
+      if magic != MAGIC:
+        raise ValueError('%s is not a distance matrix file' % path)
+      if version != VERSION:
+        raise ValueError('Unsupported distance matrix version %d' % version)
+      self.header: dict = json.loads(file.read(header_len).decode('utf8'))
+
+    self.width: int = self.header['width']
+    self.height: int = self.header['height']
+    self.cells = self.width * self.height
+    self.scale: float = self.header['scale']
+
+    self.data = np.memmap(
+      path, dtype=np.uint16, mode=mode, offset=self.header['offset'], shape=(self.cells, self.cells)
+    )
+    self.transposed: np.memmap = None
+    if self.header.get('transposed', False):
+      self.transposed = np.memmap(
+        path, dtype=np.uint16, mode=mode, offset=self.header['offset'] + self.data.nbytes,
+        shape=(self.cells, self.cells)
+      )
+
+  @staticmethod
+  def create(path: str, width: int, height: int, bounding_box: Dict[str, float] = None,
+             sources: Dict[str, str] = None, scale: float = DEFAULT_SCALE,
+             transposed: bool = False) -> 'DistanceMatrix':
+    """
+    Creates a new matrix file with every cell unreachable and opens it for
+    writing. With `transposed`, room is also made for the transposed matrix,
+    which is filled in by `writeTransposed` once all rows are written.
+    """
+    header = {
+      'width': width,
+      'height': height,
+      'bounding_box': bounding_box or {},
+      'sources': sources or {},
+      'scale': scale,
+      'dtype': 'uint16',
+      'unreachable': int(UNREACHABLE),
+      'transposed': transposed,
+    }
+
+    # The offset depends on the header's length, so encode until it settles.
+    header['offset'] = 0
+    while True:
+      encoded = json.dumps(header).encode('utf8')
+      offset = -(-(12 + len(encoded)) // HEADER_ALIGN) * HEADER_ALIGN
+      if offset == header['offset']:
+        break
+      header['offset'] = offset
+
+    cells = width * height
+    with open(path, 'wb') as file:
+      file.write(struct.pack('<4sII', MAGIC, VERSION, len(encoded)))
+      file.write(encoded)
+      file.write(b'\0' * (offset - 12 - len(encoded)))
+      file.truncate(offset + cells * cells * 2 * (2 if transposed else 1))
+
+    matrix = DistanceMatrix(path, 'r+')
+    matrix.data[:] = UNREACHABLE
+    if transposed:
+      matrix.transposed[:] = UNREACHABLE
+    matrix.flush()
+    return matrix
+
+  @staticmethod
+  def isCompatible(path: str, width: int, height: int, sources: Dict[str, str] = None,
+                   transposed: bool = False) -> bool:
+    """
+    Checks whether an existing file was built for the given grid and sources.
+    """
+    if not os.path.exists(path):
+      return False
+    try:
+      header = DistanceMatrix(path).header
+    except (ValueError, struct.error):
+      return False
+    return header['width'] == width and header['height'] == height and header['sources'] == (sources or {}) and\
+      header.get('transposed', False) == transposed
+
+  def updateHeader(self, **fields):
+    """
+    Updates fields of the header in place (e.g. new source hashes after an
+    incremental update). The header must still fit before the data.
+    """
+    header = dict(self.header, **fields)
+    encoded = json.dumps(header).encode('utf8')
+    if 12 + len(encoded) > header['offset']:
+      raise ValueError('Header of %s is too large to update in place' % self.path)
+
+    with open(self.path, 'r+b') as file:
+      file.write(struct.pack('<4sII', MAGIC, VERSION, len(encoded)))
+      file.write(encoded)
+      file.write(b'\0' * (header['offset'] - 12 - len(encoded)))
+    self.header = header
+
+  def quantize(self, minutes: np.ndarray) -> np.ndarray:
+    return quantize(minutes, self.scale)
+
+  def dequantize(self, values: np.ndarray) -> np.ndarray:
+    return dequantize(values, self.scale)
+
+  def writeRows(self, start: int, minutes: np.ndarray):
+    self.data[start:start + len(minutes)] = self.quantize(minutes)
+
+  def writeTransposed(self, tile_size: int = 2048):
+    """
+    Fills in the transposed matrix from the rows, one square tile at a time so
+    that only a tile's worth of the matrix is held in memory.
+    """
+    for start_row in range(0, self.cells, tile_size):
+      for start_col in range(0, self.cells, tile_size):
+        tile = self.data[start_row:start_row + tile_size, start_col:start_col + tile_size]
+        self.transposed[start_col:start_col + tile_size, start_row:start_row + tile_size] = tile.T
+    self.transposed.flush()
+
+  def flush(self):
+    self.data.flush()
+    if self.transposed is not None:
+      self.transposed.flush()
+
+  def row(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from `origin` to every cell.
+    """
+    return self.dequantize(self.data[origin])
+
+  def column(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from every cell to `origin`.
+    """
+    if self.transposed is not None:
+      return self.dequantize(self.transposed[origin])
+    return self.dequantize(self.data[:, origin])
+
+  def rows(self, origins: Sequence[int]) -> np.ndarray:
+    return self.dequantize(self.data[np.asarray(origins)])
+
+  def columns(self, origins: Sequence[int]) -> np.ndarray:
+    """
+    Distances to each of `origins`, one row per origin.
+    """
+    if self.transposed is not None:
+      return self.dequantize(self.transposed[np.asarray(origins)])
+    return self.dequantize(self.data[:, np.asarray(origins)].T)
@@ -1,137 +1,191 @@
 import argparse
-import json
-import numpy as np
-import math
-import networkx
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--width', default=100, type=int, dest='width')
-parser.add_argument('--height', default=100, type=int, dest='height')
-args = parser.parse_args()
-
-# Load required files.
-with open('routes.txt', 'r') as file:
-  routes = json.load(file)
-  
-with open('stops-bg.json', 'r', encoding='utf8') as file:
-  stations = json.load(file)
-
-# Initialize adjacency matrix.
-MATRIX_LEN = args.width * args.height + len(stations) + np.sum([len(route['stops']) for route in routes])
-# adj_matrix = np.full((MATRIX_LEN, MATRIX_LEN), np.inf)
-graph = networkx.DiGraph()
-graph.add_nodes_from(range(MATRIX_LEN))
-print('Matrix initialized...')
-
-# Map station numbers, cells and routes to matrix indices.
-station_to_node = {station['c']: index + args.width * args.height for index, station in enumerate(stations)}
-
-def cell_to_node(x, y):
-  return y * args.width + x
-
-stop_index = 0
-for route in routes:
-  for stop in route['stops']:
-    stop.append(stop_index)
-    stop_index += 1
-
-def stop_to_node(stop):
-  return stop[2] + args.width * args.height + len(stations)
-
-print('Mappings complete...')
-
-# Connect adjacent map cells (walking distance).
-EASTMOST_LAT = 23.19
-WESTMOST_LAT = 23.47
-NORTHMOST_LON = 42.79
-SOUTHMOST_LON = 42.60
-
-COVER_LAT = abs(EASTMOST_LAT - WESTMOST_LAT)
-COVER_LON = abs(NORTHMOST_LON - SOUTHMOST_LON)
-
-DEGREE_OF_LAT_IN_KM = 85
-DEGREE_OF_LON_IN_KM = 111
-
-CELL_WIDTH = COVER_LAT / args.width * DEGREE_OF_LAT_IN_KM
-CELL_HEIGHT = COVER_LON / args.height * DEGREE_OF_LON_IN_KM
-DIAGONAL_LEN = math.sqrt(CELL_WIDTH ** 2 + CELL_HEIGHT ** 2)
-
-WALKING_SPEED_KMH = 4.5
-
-for x in range(args.width):
-  for y in range(args.height):
-    if x > 0:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x-1, y), weight = CELL_WIDTH / WALKING_SPEED_KMH * 60)
-    if x < args.width-1:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x+1, y), weight = CELL_WIDTH / WALKING_SPEED_KMH * 60)
-    if y > 0:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x, y-1), weight = CELL_HEIGHT / WALKING_SPEED_KMH * 60)
-    if y < args.height-1:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x, y+1), weight = CELL_HEIGHT / WALKING_SPEED_KMH * 60)
-
-    # Diagonals.
-    if x > 0 and y > 0:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x-1, y-1), weight = DIAGONAL_LEN / WALKING_SPEED_KMH * 60)
-    if x > 0 and y < args.height-1:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x-1, y+1), weight = DIAGONAL_LEN / WALKING_SPEED_KMH * 60)
-    if x < args.width-1 and y > 0:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x+1, y-1), weight = DIAGONAL_LEN / WALKING_SPEED_KMH * 60)
-    if x < args.width-1 and y < args.height-1:
-      graph.add_edge(cell_to_node(x, y), cell_to_node(x+1, y+1), weight = DIAGONAL_LEN / WALKING_SPEED_KMH * 60)
-
-print('Walking distance done...')
-
-# Connect cells to stations within them (instant).
-for station in stations:
-  if station['x'] > EASTMOST_LAT and station['x'] < WESTMOST_LAT and station['y'] > SOUTHMOST_LON and station['y'] < NORTHMOST_LON:
-    cell_x = math.floor((station['x'] - EASTMOST_LAT) / COVER_LAT * args.width)
-    cell_y = math.floor((station['y'] - SOUTHMOST_LON) / COVER_LON * args.height)
-    graph.add_edge(cell_to_node(cell_x, cell_y), station_to_node[station['c']], weight = 0)
-    graph.add_edge(station_to_node[station['c']], cell_to_node(cell_x, cell_y), weight = 0)
-
-print('Station to cell mapping done...')
-
-# Connect stations to routes (waiting time).
-for route in routes:
-  for stop in route['stops']:
-    graph.add_edge(station_to_node[stop[1]], stop_to_node(stop), weight = route['median_wait'] / 2) # Bus waiting time (divide by 2 for avg. waiting time).
-    graph.add_edge(stop_to_node(stop), station_to_node[stop[1]], weight = 0) # Instantly get off.
-  
-print('Station to route mapping done...')  
-
-# Connect stations to stations (bus travel time).
-for route in routes:
-  for stop_from, stop_to in zip(route['stops'][:-1], route['stops'][1:]):
-    if stop_from[0] == '***':
-      delta = np.average(list(map(int, stop_to[0].split('-'))))
+import os
+from condensation import LINKED_TIMES_SUFFIX, CondensedRows, linked_cells, station_closure
+from distance_matrix import DISTANCE_MATRIX_FILE, DistanceMatrix
+from incremental import INCREMENTAL_MAX_FRACTION, BuildState, affected_cells, update_distance_matrix
+from profiling import StageProfiler
+from pyramid import PYRAMID_FILE, refine, write_pyramid
+from query_engine import DistanceQueryEngine
+from region_matrix import REGION_MATRIX_FILE, compute_region_matrix
+from regions import load_region_index
+from shortest_paths import DijkstraRows, compute_distance_matrix
+from timetable import TimetableEngine, TimetableRows, departure_window, parse_clock
+from transit import BOUNDING_BOX, Grid, build_graph, load_network
+
+def build_matrix(rows, path: str, args, sources: dict, profiler: StageProfiler, **header):
+  """
+  Creates the output file (unless resuming a build of the same grid and data),
+  computes all of its rows over a pool of processes, writing them straight
+  into it, and adds the transposed copy if requested. Any `header` fields are
+  recorded in the file's header, and must match for a build to be resumed.
+  """
+  with profiler.stage('create output'):
+    resume = args.resume and DistanceMatrix.isCompatible(path, args.width, args.height, sources, args.transposed) and\
+      all(DistanceMatrix(path).header.get(name) == value for name, value in header.items())
+    if not resume:
+      DistanceMatrix.create(path, args.width, args.height, BOUNDING_BOX, sources, transposed=args.transposed)
+    if header:
+      DistanceMatrix(path).updateHeader(**header)
+
+  with profiler.stage('shortest paths', method=args.method, workers=args.workers, **header),\
+       profiler.profile(args.profile):
+    compute_distance_matrix(rows, path, args.workers, args.block_size, resume, profiler)
+
+  # Add the transposed copy, so that `to` queries read columns contiguously.
+  with profiler.stage('save'):
+    matrix = DistanceMatrix(path, 'r+')
+    if args.transposed:
+      matrix.writeTransposed()
+    matrix.flush()
+
+def departure_output(path: str, departure: str) -> str:
+  """
+  Names the output of one departure window, e.g. distance_matrix_0700.bin.
+  """
+  root, extension = os.path.splitext(path)
+  return '%s_%s%s' % (root, departure.replace(':', ''), extension)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--width', default=100, type=int, dest='width')
+  parser.add_argument('--height', default=100, type=int, dest='height')
+  parser.add_argument('--block-size', default=64, type=int, dest='block_size')
+  parser.add_argument('--workers', default=None, type=int, dest='workers')
+  parser.add_argument('--resume', action='store_true', dest='resume')
+  parser.add_argument('--output', default=DISTANCE_MATRIX_FILE, dest='output')
+  parser.add_argument('--transposed', action='store_true', dest='transposed')
+  parser.add_argument('--method', default='dijkstra', choices=['dijkstra', 'condensed', 'timetable'], dest='method')
+  parser.add_argument('--depart', nargs='+', default=['08:00'], dest='depart')
+  parser.add_argument('--window', default=60, type=float, dest='window')
+  parser.add_argument('--samples', default=1, type=int, dest='samples')
+  parser.add_argument('--report', default='build_report.json', dest='report')
+  parser.add_argument('--progress-log', default=None, dest='progress_log')
+  parser.add_argument('--profile', default=None, dest='profile')
+  parser.add_argument('--incremental', action='store_true', dest='incremental')
+  parser.add_argument('--levels', default=1, type=int, dest='levels')
+  parser.add_argument('--pyramid', default=PYRAMID_FILE, dest='pyramid')
+  parser.add_argument('--refine', nargs=4, default=None, type=int, dest='refine', metavar=('X0', 'Y0', 'X1', 'Y1'))
+  parser.add_argument('--region-matrix', nargs='?', const=REGION_MATRIX_FILE, default=None, dest='region_matrix')
+  parser.add_argument('--walk-radius', default=0, type=float, dest='walk_radius')
+  args = parser.parse_args()
+  if args.method == 'timetable' and args.incremental:
+    parser.error('--incremental only applies to the static methods')
+  if args.method == 'timetable' and args.levels > 1:
+    parser.error('--levels only applies to the static methods')
+  if args.method == 'timetable' and args.walk_radius > 0:
+    parser.error('--walk-radius only applies to the static methods')
+  if args.region_matrix is not None and len(args.depart) > 1 and args.method == 'timetable':
+    parser.error('--region-matrix needs a single departure window')
+  if args.region_matrix is not None and not load_region_index().fitsGrid(args.width, args.height):
+    parser.error('--region-matrix needs square_info.json of the %dx%d grid' % (args.width, args.height))
+
+  # The hot loop can only be profiled when it runs in this process.
+  if args.profile is not None and args.workers is None:
+    args.workers = 0
+
+  profiler = StageProfiler(args.progress_log)
+
+  # Load the parsed routes and stations (cached while routes.txt and
+  # stops-bg.json are unchanged).
+  with profiler.stage('load') as stage:
+    network = load_network()
+    stage.update(stations=network.num_stations, routes=network.num_routes, stops=network.num_stops)
+
+  # Build the whole graph (walking, station to cell, station to route and route
+  # chaining edges) as a sparse matrix. Stations are linked to the cells within
+  # walking radius, or only to the one they are in.
+  grid = Grid(args.width, args.height)
+  graph = build_graph(network, grid, profiler, args.walk_radius)
+
+  sources = network.sources
+  fingerprints = network.fingerprints
+  state = BuildState.load(args.output) if args.incremental else None
+
+  if state is not None and state.canUpdate(args.output, args.width, args.height, sources, args.transposed) and\
+     DistanceMatrix(args.output).header.get('walk_radius', 0) == args.walk_radius:
+    # Only the routes changed since the last build, so patch the rows affected
+    # by the change instead of rebuilding everything.
+    changed_routes = state.changedRoutes(fingerprints)
+    print('%d of %d routes changed since the last build' % (changed_routes, network.num_routes))
+    closure = state.closure
+    if changed_routes > 0:
+      with profiler.stage('station closure') as stage:
+        rows = CondensedRows(graph, path=args.output + LINKED_TIMES_SUFFIX)
+        stage['linked_cells'] = int(rows.linked.size)
+      with profiler.stage('affected rows') as stage:
+        cells = affected_cells(rows, state.closure, scale=DistanceMatrix(args.output).scale)
+        stage['rows'] = int(cells.size)
+      if cells.size > INCREMENTAL_MAX_FRACTION * grid.cells:
+        # Patching this many scattered rows is slower than writing them all,
+        # and the condensed rows are already at hand.
+        print('%d of %d rows affected, rebuilding the whole matrix' % (cells.size, grid.cells))
+        build_matrix(rows, args.output, args, sources, profiler, walk_radius=args.walk_radius)
+      else:
+        with profiler.stage('incremental update', changed_routes=changed_routes, rows_updated=int(cells.size)):
+          update_distance_matrix(args.output, rows, cells, args.workers, args.block_size, profiler)
+      closure = rows.closure
+    DistanceMatrix(args.output, 'r+').updateHeader(sources=sources)
+    BuildState(sources, fingerprints, state.linked, closure).save(args.output)
+
+  elif args.method == 'timetable':
+    # One matrix per departure window, each averaging the travel times over
+    # departures spread across the window.
+    engine = TimetableEngine(network, grid)
+    for departure in args.depart:
+      path = args.output if len(args.depart) == 1 else departure_output(args.output, departure)
+      rows = TimetableRows(engine, departure_window(parse_clock(departure), args.window, args.samples))
+      build_matrix(rows, path, args, sources, profiler, departure=departure, window=args.window, samples=args.samples)
+      print('Matrix for departures from %s written to %s' % (departure, path))
+
+  else:
+    # Either run Dijkstra from each grid cell node, or search between stations
+    # only and combine the results with closed-form walking times.
+    if args.method == 'condensed':
+      with profiler.stage('station closure') as stage:
+        rows = CondensedRows(graph, path=args.output + LINKED_TIMES_SUFFIX)
+        linked, closure = rows.linked, rows.closure
+        stage['linked_cells'] = int(linked.size)
     else:
-      delta = np.average(list(map(int, stop_to[0].split('-')))) - np.average(list(map(int, stop_from[0].split('-'))))
-    
-    graph.add_edge(stop_to_node(stop_from), stop_to_node(stop_to), weight = delta)
-
-print('Connecting routes done...')
-
-# Perform Floyd-Warshall on the graph to get the transitive closure.
-# ALL_OPERATIONS = int(MATRIX_LEN) ** 3
-# for k in range(MATRIX_LEN):
-#   for i in range(MATRIX_LEN):
-#     if adj_matrix[i][k] == np.inf: continue
-#     for j in range(MATRIX_LEN):
-#       adj_matrix[i][j] = min(adj_matrix[i][j], adj_matrix[i][k] + adj_matrix[k][j])
-#     print('%f%% done...' % ((k*(int(MATRIX_LEN)**2) + i*int(MATRIX_LEN)) / ALL_OPERATIONS * 100))
-
-# np.save('distance_matrix.npy', adj_matrix)
-
-iterator = networkx.algorithms.all_pairs_dijkstra_path_length(graph)
-
-distance = np.empty((args.width * args.height, args.width * args.height))
-for source, target_dict in iterator:
-  if source >= args.width * args.height: break
-  for target in range(args.width * args.height):
-    distance[source][target] = target_dict[target]
-  print('%f%% done...' % (100 * source / (args.width * args.height)))
-
-np.save('distance_matrix.npy', distance)
-# np.savetxt('distance_matrix.csv', distance, delimiter=',', header='%dx%d\n' % (args.width, args.height))
-
-print('All done!')
\ No newline at end of file
+      rows = DijkstraRows(graph)
+      # An incremental update later on starts from the station closure.
+      if args.incremental:
+        with profiler.stage('station closure') as stage:
+          linked = linked_cells(graph)
+          closure = station_closure(graph, linked)
+          stage['linked_cells'] = int(linked.size)
+
+    build_matrix(rows, args.output, args, sources, profiler, walk_radius=args.walk_radius)
+
+    # Keep what a later incremental update needs.
+    if args.incremental:
+      BuildState(sources, fingerprints, linked, closure).save(args.output)
+
+  # Finer levels are computed on demand by the viewer; only write down where
+  # they go, and compute the area to refine ahead of time if asked to.
+  if args.levels > 1:
+    with profiler.stage('pyramid', levels=args.levels):
+      pyramid = write_pyramid(
+        args.pyramid, args.output, args.width, args.height, args.levels, sources, args.walk_radius
+      )
+    if args.refine is not None:
+      x0, y0, x1, y1 = args.refine
+      for level in pyramid.levels[1:]:
+        with profiler.stage('refine level %d' % level.level) as stage:
+          level_graph = build_graph(network, Grid(level.width, level.height), walk_radius=args.walk_radius)
+          level.source = DistanceQueryEngine(level_graph, cache_size=0)
+          cells = level.cellsIn(x0 / args.width, y0 / args.height, x1 / args.width, y1 / args.height)
+          stage.update(cells=int(cells.size), computed=refine(level, cells))
+    print('Pyramid of %d levels written to %s' % (args.levels, args.pyramid))
+
+  # Reduce the matrix to travel times between every pair of regions, for the
+  # viewer to compare districts without clicking through their cells.
+  if args.region_matrix is not None:
+    with profiler.stage('region matrix') as stage:
+      region_index = load_region_index()
+      region_matrix = compute_region_matrix(DistanceMatrix(args.output), region_index, args.block_size, profiler=profiler)
+      region_matrix.save(args.region_matrix)
+      stage['regions'] = len(region_index.names)
+    print('Travel times between regions written to %s' % args.region_matrix)
+
+  profiler.save(args.report, arguments=vars(args), sources=sources)
+  print('All done! Run report written to %s' % args.report)
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Distances are quantized to tenths of a minute (as in the distance matrix)
+# and used as indices into a colour lookup table. The last entry is shared by
+# everything from ~109 hours up, including unreachable cells.
+STEPS_PER_MINUTE = 10
+LUT_SIZE = np.iinfo(np.uint16).max + 1
+
+def hsv_to_rgb(h: np.ndarray, s: np.ndarray, v: np.ndarray) -> np.ndarray:
+  """
+  Vectorized `colorsys.hsv_to_rgb`, returning an array of shape (..., 3).
+  """
+  h, s, v = np.broadcast_arrays(np.asarray(h, dtype=float), s, v)
+  i = np.floor(h * 6.0)
+  f = h * 6.0 - i
+  p = v * (1.0 - s)
+  q = v * (1.0 - s * f)
+  t = v * (1.0 - s * (1.0 - f))
+  i = i.astype(np.int64) % 6
+
+  choices = [
+    np.stack([v, t, p], axis=-1),
+    np.stack([q, v, p], axis=-1),
+    np.stack([p, v, t], axis=-1),
+    np.stack([p, q, v], axis=-1),
+    np.stack([t, p, v], axis=-1),
+    np.stack([v, p, q], axis=-1),
+  ]
+  return np.choose(i[..., None], choices)
+
+def heat_colors(distances: np.ndarray, min_heat: float, max_heat: float) -> np.ndarray:
+  """
+  Maps distances in minutes to RGB colours in [0, 1]: the hue runs from red at
+  `min_heat` through yellow, green (halfway) and cyan to blue at `max_heat`,
+  darkening to half brightness on the way, saturating outside of them.
+  """
+  heat_range = max_heat - min_heat
+  heat = np.clip(np.asarray(distances, dtype=float) - min_heat, 0, max(heat_range, 0))
+  fraction = heat / heat_range if heat_range > 0 else np.zeros_like(heat)
+  return hsv_to_rgb(fraction / 1.5, 1, 1 - fraction / 2)
+
+def heat_lut(min_heat: float, max_heat: float, alpha: float = 0.5) -> np.ndarray:
+  """
+  Builds a (LUT_SIZE, 4) uint8 RGBA lookup table indexed by quantized distance.
+  """
+  lut = np.empty((LUT_SIZE, 4), dtype=np.uint8)
+
+  # Everything past max_heat has the same color, so only compute up to it.
+  varying = int(min(max(max_heat, 0) * STEPS_PER_MINUTE + 2, LUT_SIZE))
+  distances = np.arange(varying) / STEPS_PER_MINUTE
+  lut[:varying, :3] = np.rint(heat_colors(distances, min_heat, max_heat) * 255)
+  lut[varying:, :3] = lut[varying - 1, :3]
+  lut[:, 3] = round(alpha * 255)
+  return lut
+
+def quantize_distances(distances: np.ndarray) -> np.ndarray:
+  """
+  Converts distances in minutes into lookup table indices.
+  """
+  distances = np.nan_to_num(np.asarray(distances, dtype=float), posinf=LUT_SIZE)
+  return np.clip(np.rint(distances * STEPS_PER_MINUTE), 0, LUT_SIZE - 1).astype(np.uint16)
@@ -0,0 +1,122 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import List
+
+try:
+  import resource
+except ImportError: # Not available on Windows.
+  resource = None
+
+def peak_rss_mb() -> float:
+  """
+  Returns the peak resident set size of this process and its finished
+  children in MB, or None where it cannot be measured.
+  """
+  if resource is None:
+    return None
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  # Reported in bytes on macOS and in kilobytes elsewhere.
+  return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+class StageProfiler:
+  """
+  Records the elapsed time, peak RSS and any counts (nodes, edges, rows/s...)
+  of each stage of a build, and writes them out as a JSON run report.
+
+  Progress within a stage can be reported through `progress`, which also
+  appends each update as a JSON line to `progress_path` if given.
+  """
+
+  def __init__(self, progress_path: str = None, verbose: bool = True):
+    self.stages: List[dict] = []
+    self.current: dict = None
+    self.start_time = time.time()
+    self.verbose = verbose
+    self.progress_file = open(progress_path, 'a') if progress_path else None
+
+  @contextmanager
+  def stage(self, name: str, **counts):
+    """
+    Times the enclosed block as a stage. Yields the stage's record, to which
+    further counts can be added.
+    """
+    record = {'stage': name}
+    record.update(counts)
+    outer, self.current = self.current, record
+    start = time.perf_counter()
+    try:
+      yield record
+    finally:
+      record['seconds'] = time.perf_counter() - start
+      record['peak_rss_mb'] = peak_rss_mb()
+      self.current = outer
+      self.stages.append(record)
+      if self.verbose:
+        extra = ', '.join('%s: %s' % (key, value) for key, value in record.items() if key not in ('stage', 'seconds', 'peak_rss_mb'))
+        print('[%s] %.2fs%s%s' % (
+          name,
+          record['seconds'],
+          ', peak RSS %.0fMB' % record['peak_rss_mb'] if record['peak_rss_mb'] is not None else '',
+          ', ' + extra if extra else ''
+        ))
+
+  def progress(self, **fields):
+    """
+    Records progress (e.g. rows done, rows/s, ETA) of the current stage.
+    """
+    if self.current is not None:
+      self.current.update(fields)
+    if self.progress_file is not None:
+      line = {'time': time.time() - self.start_time, 'stage': self.current['stage'] if self.current else None}
+      line.update(fields)
+      self.progress_file.write(json.dumps(line) + '\n')
+      self.progress_file.flush()
+
+  @contextmanager
+  def profile(self, path: str):
+    """
+    Runs the enclosed block under cProfile, saving the statistics to `path`
+    (if given) for inspection with `python -m pstats` or snakeviz.
+    """
+    if path is None:
+      yield
+      return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+      yield
+    finally:
+      profiler.disable()
+      profiler.dump_stats(path)
+
+  def report(self, **info) -> dict:
+    report = {'total_seconds': time.time() - self.start_time, 'peak_rss_mb': peak_rss_mb(), 'pid': os.getpid()}
+    report.update(info)
+    report['stages'] = self.stages
+    return report
+
+  def save(self, path: str, **info):
+    with open(path, 'w') as file:
+      json.dump(self.report(**info), file, indent=2)
+    if self.progress_file is not None:
+      self.progress_file.close()
+      self.progress_file = None
+
+class NullProfiler(StageProfiler):
+  """
+  A profiler which records nothing and prints nothing.
+  """
+
+  def __init__(self):
+    super().__init__(verbose=False)
+
+  @contextmanager
+  def stage(self, name: str, **counts):
+    yield dict(counts)
+
+  def progress(self, **fields):
+    pass
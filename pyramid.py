@@ -0,0 +1,274 @@
+"""
+A multi-resolution pyramid of distance maps.
+
+A full matrix grows with the fourth power of the grid's linear resolution, so
+only the coarsest level is an all-pairs matrix (`distance_matrix.bin`). Every
+further level doubles the resolution in both directions and holds just the
+rows and columns of the origins actually looked at: they are computed on
+demand by a `DistanceQueryEngine` on that level's grid and kept in a row store
+on disk, which graph.py can also fill in ahead of time for chosen areas
+(`--levels`, `--refine`).
+
+The manifest (`distance_pyramid.json`) lists the levels, their grids and
+where their distances are kept, along with the source hashes they were built
+from.
+"""
+
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+from distance_matrix import DistanceMatrix, dequantize, quantize
+from query_engine import DistanceQueryEngine
+from transit import file_digest
+
+PYRAMID_FILE = 'distance_pyramid.json'
+PYRAMID_DIR = 'distance_pyramid'
+
+class RowStore:
+  """
+  Quantized distance vectors of one level on disk, one .npy file per origin
+  and direction (`from_<cell>.npy` for rows, `to_<cell>.npy` for columns).
+  """
+
+  def __init__(self, directory: str):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def path(self, origin: int, reverse: bool) -> str:
+    return os.path.join(self.directory, '%s_%d.npy' % ('to' if reverse else 'from', origin))
+
+  def get(self, origin: int, reverse: bool) -> np.ndarray:
+    """
+    Returns the stored distances in minutes, or None if they were never computed.
+    """
+    path = self.path(origin, reverse)
+    if not os.path.exists(path):
+      return None
+    return dequantize(np.load(path))
+
+  def put(self, origin: int, reverse: bool, minutes: np.ndarray):
+    path = self.path(origin, reverse)
+    with open(path + '.tmp', 'wb') as file:
+      np.save(file, quantize(minutes))
+    os.replace(path + '.tmp', path)
+
+  def clear(self):
+    for name in os.listdir(self.directory):
+      if name.endswith('.npy'):
+        os.remove(os.path.join(self.directory, name))
+
+class PyramidLevel:
+  """
+  One level of the pyramid, serving the same row/column interface as
+  `DistanceMatrix`. Levels without a `source` (a matrix or query engine) read
+  their row store and compute what is missing with a query engine on their
+  grid, built the first time it is needed.
+  """
+
+  def __init__(self, level: int, width: int, height: int, source=None, store: RowStore = None,
+               cache_size: int = 64, walk_radius: float = 0):
+    self.level = level
+    self.width = width
+    self.height = height
+    self.cells = width * height
+    self.source = source
+    self.store = store
+    self.walk_radius = walk_radius
+
+    self.cache_size = cache_size
+    self._cache: OrderedDict = OrderedDict()
+    self._lock = threading.Lock() # The viewer builds levels on a background thread.
+
+  def engine(self) -> DistanceQueryEngine:
+    with self._lock:
+      if self.source is None:
+        print('Building the %dx%d graph of level %d...' % (self.width, self.height, self.level))
+        self.source = DistanceQueryEngine.fromFiles(
+          self.width, self.height, cache_size=0, walk_radius=self.walk_radius
+        )
+      return self.source
+
+  def _vector(self, origin: int, reverse: bool) -> np.ndarray:
+    key = (int(origin), reverse)
+    with self._lock:
+      if key in self._cache:
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    distances = self.store.get(*key) if self.store is not None else None
+    if distances is None:
+      engine = self.engine()
+      distances = engine.column(key[0]) if reverse else engine.row(key[0])
+      if self.store is not None:
+        self.store.put(key[0], reverse, distances)
+
+    with self._lock:
+      self._cache[key] = distances
+      if len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    return distances
+
+  def row(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from `origin` to every cell.
+    """
+    if self.store is None and self.source is not None:
+      return self.source.row(origin)
+    return self._vector(origin, False)
+
+  def column(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from every cell to `origin`.
+    """
+    if self.store is None and self.source is not None:
+      return self.source.column(origin)
+    return self._vector(origin, True)
+
+  def rows(self, origins: Sequence[int]) -> np.ndarray:
+    if self.store is None and self.source is not None:
+      return self.source.rows(origins)
+    return np.stack([self.row(origin) for origin in origins])
+
+  def columns(self, origins: Sequence[int]) -> np.ndarray:
+    """
+    Distances to each of `origins`, one row per origin.
+    """
+    if self.store is None and self.source is not None:
+      return self.source.columns(origins)
+    return np.stack([self.column(origin) for origin in origins])
+
+  def cellAt(self, fx: float, fy: float) -> int:
+    """
+    Returns the cell at a point given as fractions of the map's width and
+    height (from the south-west).
+    """
+    x = min(max(int(fx * self.width), 0), self.width - 1)
+    y = min(max(int(fy * self.height), 0), self.height - 1)
+    return x + y * self.width
+
+  def cellCenter(self, cell: int) -> Tuple[float, float]:
+    """
+    Returns the centre of a cell as fractions of the map's width and height.
+    """
+    return (cell % self.width + 0.5) / self.width, (cell // self.width + 0.5) / self.height
+
+  def cellsIn(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+    """
+    Returns the cells overlapping an area given as fractions of the map's
+    width and height.
+    """
+    xs = np.arange(max(int(x0 * self.width), 0), min(int(np.ceil(x1 * self.width)), self.width))
+    ys = np.arange(max(int(y0 * self.height), 0), min(int(np.ceil(y1 * self.height)), self.height))
+    return (xs[None, :] + ys[:, None] * self.width).ravel()
+
+class DistancePyramid:
+  """
+  The levels of a pyramid, from the coarsest (level 0) to the finest.
+  """
+
+  def __init__(self, levels: List[PyramidLevel], sources: Dict[str, str] = None):
+    self.levels = levels
+    self.sources = sources or {}
+
+  @staticmethod
+  def single(source) -> 'DistancePyramid':
+    """
+    A pyramid of a single level, e.g. a plain distance matrix or query engine.
+    """
+    return DistancePyramid([PyramidLevel(0, source.width, source.height, source)])
+
+  @staticmethod
+  def load(path: str = PYRAMID_FILE) -> 'DistancePyramid':
+    """
+    Loads a pyramid. Rows stored from other routes or stops than the current
+    ones are discarded, as the finer levels' engines are built from the
+    current files.
+    """
+    with open(path, 'r') as file:
+      manifest = json.load(file)
+    base = os.path.dirname(path)
+
+    sources = current_sources(manifest.get('sources', {}))
+    if manifest.get('sources', {}) != sources:
+      print('%s was built from other routes or stops, discarding the rows stored for its finer levels' % path)
+      for entry in manifest['levels']:
+        if 'rows' in entry:
+          RowStore(os.path.join(base, entry['rows'])).clear()
+      manifest['sources'] = sources
+      write_manifest(path, manifest)
+    walk_radius = manifest.get('walk_radius', 0)
+
+    levels = []
+    for entry in manifest['levels']:
+      if 'matrix' in entry:
+        source = DistanceMatrix(os.path.join(base, entry['matrix']))
+        levels.append(PyramidLevel(entry['level'], entry['width'], entry['height'], source, walk_radius=walk_radius))
+      else:
+        store = RowStore(os.path.join(base, entry['rows']))
+        levels.append(PyramidLevel(
+          entry['level'], entry['width'], entry['height'], store=store, walk_radius=walk_radius
+        ))
+    return DistancePyramid(levels, manifest.get('sources', {}))
+
+  def levelForZoom(self, zoom: float) -> int:
+    """
+    Picks the level whose cells are at least as large on screen as the
+    coarsest level's are without zooming: level k from a zoom of 2^k.
+    """
+    if zoom <= 1:
+      return 0
+    return min(int(np.floor(np.log2(zoom) + 1e-9)), len(self.levels) - 1)
+
+def current_sources(sources: Dict[str, str]) -> Dict[str, str]:
+  """
+  The hashes of the source files named in `sources` as they are now (None for
+  missing ones).
+  """
+  return {name: file_digest(name) if os.path.exists(name) else None for name in sources}
+
+def write_manifest(path: str, manifest: dict):
+  with open(path + '.tmp', 'w') as file:
+    json.dump(manifest, file, indent=2)
+  os.replace(path + '.tmp', path)
+
+def write_pyramid(path: str, matrix_path: str, width: int, height: int, levels: int,
+                  sources: Dict[str, str], walk_radius: float = 0) -> DistancePyramid:
+  """
+  Writes the manifest of a pyramid of `levels` levels over the matrix at
+  `matrix_path`. Rows stored for other sources, grids or walking radii are
+  cleared.
+  """
+  base = os.path.dirname(path)
+  previous = {'sources': {}, 'levels': []}
+  if os.path.exists(path):
+    with open(path, 'r') as file:
+      previous = json.load(file)
+
+  entries = [{'level': 0, 'width': width, 'height': height, 'matrix': os.path.relpath(matrix_path, base or '.')}]
+  for level in range(1, levels):
+    rows = os.path.join(PYRAMID_DIR, 'level%d' % level)
+    entries.append({'level': level, 'width': width << level, 'height': height << level, 'rows': rows})
+    store = RowStore(os.path.join(base, rows))
+    if previous['sources'] != sources or entries[level] not in previous['levels'] or\
+       previous.get('walk_radius', 0) != walk_radius:
+      store.clear()
+
+  write_manifest(path, {'sources': sources, 'walk_radius': walk_radius, 'levels': entries})
+  return DistancePyramid.load(path)
+
+def refine(level: PyramidLevel, cells: Sequence[int], transposed: bool = True) -> int:
+  """
+  Computes (and stores) the rows, and with `transposed` also the columns, of
+  the given cells of a level ahead of time. Returns the number of vectors
+  computed.
+  """
+  computed = 0
+  for cell in cells:
+    for reverse in ((False, True) if transposed else (False,)):
+      if level.store is None or not os.path.exists(level.store.path(cell, reverse)):
+        level._vector(cell, reverse)
+        computed += 1
+  return computed
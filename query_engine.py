@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from scipy.sparse.csgraph import dijkstra
+from typing import Sequence
+from transit import ROUTES_FILE, STOPS_FILE, Grid, TransitGraph, build_graph, load_network
+
+DEFAULT_CACHE_SIZE = 256
+
+class DistanceQueryEngine:
+  """
+  Answers distance queries by running Dijkstra from a single origin on demand,
+  instead of reading a precomputed all-pairs matrix.
+
+  Serves the same row/column interface as `DistanceMatrix`. Rows are searched
+  on the transit graph and columns on its reverse, and the most recent
+  `cache_size` vectors of each kind are kept in an LRU cache.
+  """
+
+  def __init__(self, graph: TransitGraph, cache_size: int = DEFAULT_CACHE_SIZE):
+    self.graph = graph
+    self.width = graph.grid.width
+    self.height = graph.grid.height
+    self.cells = graph.grid.cells
+
+    self.forward = graph.matrix
+    self.reverse = graph.matrix.T.tocsr()
+
+    self.cache_size = cache_size
+    self._cache: OrderedDict = OrderedDict()
+    self._lock = threading.Lock() # The viewer prefetches rows on a background thread.
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def fromFiles(width: int, height: int, routes_path: str = ROUTES_FILE, stops_path: str = STOPS_FILE,
+                cache_size: int = DEFAULT_CACHE_SIZE, walk_radius: float = 0) -> 'DistanceQueryEngine':
+    network = load_network(routes_path, stops_path)
+    return DistanceQueryEngine(build_graph(network, Grid(width, height), walk_radius=walk_radius), cache_size)
+
+  def _query(self, origin: int, reverse: bool) -> np.ndarray:
+    key = (int(origin), reverse)
+    with self._lock:
+      if key in self._cache:
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return self._cache[key]
+      self.misses += 1
+
+    graph = self.reverse if reverse else self.forward
+    distances = dijkstra(graph, indices=key[0])[:self.cells].astype(np.float32)
+    distances.setflags(write=False)
+
+    with self._lock:
+      self._cache[key] = distances
+      if len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    return distances
+
+  def row(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from `origin` to every cell.
+    """
+    return self._query(origin, False)
+
+  def column(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from every cell to `origin`.
+    """
+    return self._query(origin, True)
+
+  def rows(self, origins: Sequence[int]) -> np.ndarray:
+    return np.stack([self.row(origin) for origin in origins])
+
+  def columns(self, origins: Sequence[int]) -> np.ndarray:
+    """
+    Distances to each of `origins`, one row per origin.
+    """
+    return np.stack([self.column(origin) for origin in origins])
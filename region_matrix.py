@@ -0,0 +1,166 @@
+"""
+Region-to-region travel times, computed from the distance matrix in one pass.
+
+The times from region A to region B are those between every square of A and
+every square of B. Row blocks of the memory-mapped matrix are read in order,
+and each row (a square of A) adds its distances to the squares of every region
+B into running sums (for exact means) and into histograms per pair of regions
+(for medians and the 90th percentile). The bins are a minute wide up to an
+hour and wider beyond (`BIN_EDGES`), so the histograms stay around a hundred
+bins per pair and percentiles are resolved to a fraction of a bin.
+
+The result is saved as `region_matrix.npz`, which the viewer loads in
+milliseconds.
+
+Example usage: `python region_matrix.py`, or `python graph.py --region-matrix`
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from typing import Dict, List, Sequence
+from aggregation import histogram_percentile
+from distance_matrix import DISTANCE_MATRIX_FILE, UNREACHABLE, DistanceMatrix
+from profiling import NullProfiler, StageProfiler
+from regions import RegionIndex, load_region_index
+
+REGION_MATRIX_FILE = 'region_matrix.npz'
+PERCENTILES = [50, 90]
+
+# Bins of 1 minute up to an hour, 2 up to two hours and 5 up to four hours;
+# the last bin holds everything beyond, including unreachable squares.
+BIN_EDGES = np.concatenate([np.arange(0, 60), np.arange(60, 120, 2), np.arange(120, 241, 5)]).astype(float)
+
+class RegionMatrix:
+  """
+  Mean and percentile travel times between every pair of regions, row `i`
+  holding the times from region `i`. Carries the source hashes of the
+  distance matrix it was computed from.
+  """
+
+  def __init__(self, names: Sequence[str], means: np.ndarray, percentiles: Dict[int, np.ndarray],
+               sources: Dict[str, str] = None):
+    self.names = list(names)
+    self.ids: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+    self.means = means
+    self.percentiles = percentiles
+    self.sources = sources or {}
+
+  @staticmethod
+  def load(path: str = REGION_MATRIX_FILE) -> 'RegionMatrix':
+    with np.load(path) as data:
+      percentiles = {int(key[len('p'):]): data[key] for key in data.files if key.startswith('p')}
+      return RegionMatrix(data['names'].tolist(), data['means'], percentiles, json.loads(str(data['sources'])))
+
+  def save(self, path: str = REGION_MATRIX_FILE):
+    arrays = {'p%d' % percentile: values.astype(np.float32) for percentile, values in self.percentiles.items()}
+    with open(path + '.tmp', 'wb') as file:
+      np.savez(
+        file, names=np.array(self.names, dtype=str), means=self.means.astype(np.float32),
+        sources=json.dumps(self.sources), **arrays
+      )
+    os.replace(path + '.tmp', path)
+
+  def stats(self, name: str, direction: str = 'from') -> List[np.ndarray]:
+    """
+    The mean and percentiles of the times from (or to) a region to (or from)
+    every region.
+    """
+    region = self.ids[name]
+    pick = (lambda values: values[region]) if direction == 'from' else (lambda values: values[:, region])
+    return [pick(self.means)] + [pick(self.percentiles[percentile]) for percentile in sorted(self.percentiles)]
+
+def compute_region_matrix(matrix: DistanceMatrix, region_index: RegionIndex, block_size: int = 64,
+                          percentiles: Sequence[int] = PERCENTILES, profiler: StageProfiler = None) -> RegionMatrix:
+  """
+  Streams through the rows of `matrix` once, in blocks of `block_size`, and
+  reduces them to travel times between the regions of `region_index`.
+  """
+  profiler = profiler or NullProfiler()
+  regions, bins = len(region_index.names), BIN_EDGES.size
+  if not region_index.fitsGrid(matrix.width, matrix.height):
+    raise ValueError('The regions are not on the %dx%d grid of the matrix' % (matrix.width, matrix.height))
+
+  sums = np.zeros((regions, regions))
+  unreachable = np.zeros((regions, regions), dtype=np.int64)
+  histograms = np.zeros((regions, regions * bins), dtype=np.uint32)
+
+  # Every (square, region) pair as destinations, and the regions of every
+  # square (none past the last square with any) as sources.
+  squares, destinations = region_index.squares, region_index.group_of
+  square_offsets = np.pad(region_index.square_offsets, (0, matrix.cells + 1 - region_index.square_offsets.size), 'edge')
+  membership = csr_matrix((np.ones(squares.size), (destinations, squares)), shape=(regions, matrix.cells))
+
+  # The bin of every stored value, so that rows are binned by a lookup, and
+  # where each (row, destination) pair's histogram starts in a block.
+  bin_of_value = np.searchsorted(BIN_EDGES, np.arange(UNREACHABLE + 1) / matrix.scale, 'right') - 1
+  bin_of_value[UNREACHABLE] = bins - 1
+  bin_of_value = bin_of_value.astype(np.uint8)
+  histogram_starts = np.arange(block_size)[:, None] * (regions * bins) + destinations[None, :] * bins
+
+  for start in range(0, matrix.cells, block_size):
+    stop = min(start + block_size, matrix.cells)
+    stored = np.asarray(matrix.data[start:stop])
+    finite = stored != UNREACHABLE
+
+    # Reduce each row of the block to the destination regions.
+    row_sums = (membership @ np.where(finite, stored / matrix.scale, 0).T).T
+    row_unreachable = np.zeros((stop - start, regions))
+    if not finite.all():
+      row_unreachable = (membership @ (~finite).T.astype(float)).T
+    row_bins = histogram_starts[:stop - start] + bin_of_value[stored][:, squares]
+    row_histograms = np.bincount(row_bins.ravel(), minlength=(stop - start) * regions * bins).reshape(stop - start, -1)
+
+    # Neighbouring squares mostly share their regions, so add up the rows of
+    # each source region in the block before adding them to its totals.
+    owners = np.repeat(np.arange(stop - start), np.diff(square_offsets[start:stop + 1]))
+    owned = region_index.square_regions[square_offsets[start]:square_offsets[stop]]
+    for source in np.unique(owned):
+      members = owners[owned == source]
+      sums[source] += row_sums[members].sum(axis=0)
+      unreachable[source] += row_unreachable[members].sum(axis=0).astype(np.int64)
+      histograms[source] += row_histograms[members].sum(axis=0).astype(np.uint32)
+    profiler.progress(rows_done=stop, rows_total=matrix.cells)
+
+  counts = np.outer(region_index.counts, region_index.counts)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    means = np.where(unreachable > 0, np.inf, sums / counts)
+
+  # Percentiles a few source regions at a time, to bound the cumulative sums.
+  result = {percentile: np.empty((regions, regions)) for percentile in percentiles}
+  for start in range(0, regions, 16):
+    block = histograms[start:start + 16].reshape(-1, regions, bins).astype(np.int64)
+    for percentile in percentiles:
+      result[percentile][start:start + 16] = histogram_percentile(block, BIN_EDGES, percentile)
+  return RegionMatrix(region_index.names, means, result, matrix.header['sources'])
+
+def load_region_matrix(path: str = REGION_MATRIX_FILE, matrix: DistanceMatrix = None) -> RegionMatrix:
+  """
+  Loads the region matrix, or returns None if there is none or it was
+  computed from different sources than `matrix`.
+  """
+  if not os.path.exists(path):
+    return None
+  region_matrix = RegionMatrix.load(path)
+  if matrix is not None and region_matrix.sources != matrix.header.get('sources', {}):
+    print('%s is out of date, run region_matrix.py again' % path)
+    return None
+  return region_matrix
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Computes travel times between every pair of regions.')
+  parser.add_argument('--matrix', default=DISTANCE_MATRIX_FILE, dest='matrix')
+  parser.add_argument('--output', default=REGION_MATRIX_FILE, dest='output')
+  parser.add_argument('--block-size', default=64, type=int, dest='block_size')
+  args = parser.parse_args()
+
+  profiler = StageProfiler()
+  with profiler.stage('region matrix') as stage:
+    matrix = DistanceMatrix(args.matrix)
+    region_index = load_region_index()
+    region_matrix = compute_region_matrix(matrix, region_index, args.block_size, profiler=profiler)
+    stage['regions'] = len(region_index.names)
+  region_matrix.save(args.output)
+  print('Saved travel times between %d regions to %s' % (len(region_matrix.names), args.output))
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+
+SQUARE_INFO_FILE = 'square_info.json'
+REGION_INDEX_FILE = 'square_info.npz'
+
+class RegionIndex:
+  """
+  Grid squares grouped by region, stored CSR-style: the squares of region `i`
+  are `squares[offsets[i]:offsets[i + 1]]`.
+
+  The inverse mapping is stored the same way: the regions of square `j` are
+  `square_regions[square_offsets[j]:square_offsets[j + 1]]`.
+
+  Squares are numbered on a `width` x `height` grid, which distance sources
+  must match for the index to apply to them (see `fitsGrid`).
+  """
+
+  def __init__(self, names: Sequence[str], offsets: np.ndarray, squares: np.ndarray,
+               square_offsets: np.ndarray = None, square_regions: np.ndarray = None,
+               width: int = None, height: int = None):
+    self.names = list(names)
+    self.width = width
+    self.height = height
+    self.ids: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.squares = np.asarray(squares, dtype=np.int64)
+
+    self.counts = np.diff(self.offsets)
+    self.group_of = np.repeat(np.arange(len(self.names)), self.counts)
+
+    if square_offsets is None:
+      order = np.argsort(self.squares, kind='stable')
+      square_counts = np.bincount(self.squares, minlength=1)
+      square_offsets = np.concatenate([[0], np.cumsum(square_counts)])
+      square_regions = self.group_of[order]
+    self.square_offsets = np.asarray(square_offsets, dtype=np.int64)
+    self.square_regions = np.asarray(square_regions, dtype=np.int32)
+
+  def fitsGrid(self, width: int, height: int) -> bool:
+    return self.width == width and self.height == height
+
+  @staticmethod
+  def fromMapping(regions_to_squares: Dict[str, List[int]]) -> 'RegionIndex':
+    names = list(regions_to_squares.keys())
+    counts = [len(regions_to_squares[name]) for name in names]
+    offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+    squares = np.concatenate([np.asarray(regions_to_squares[name], dtype=np.int64) for name in names]) \
+      if names else np.empty(0, dtype=np.int64)
+    return RegionIndex(names, offsets, squares)
+
+  @staticmethod
+  def fromSquareInfo(square_info: Dict[str, dict], width: int = None, height: int = None) -> 'RegionIndex':
+    """
+    Builds the index from the contents of square_info.json, in which every
+    value of a square's address (suburb, city, postcode...) is a region.
+    Regions are numbered in order of first appearance.
+
+    square_info.json lists every square of its grid, so without a `width`
+    and `height` the grid is taken to be square.
+    """
+    if width is None or height is None:
+      width = height = int(np.sqrt(len(square_info)))
+      if width * height != len(square_info):
+        raise ValueError('%d squares are not a square grid, give its width and height' % len(square_info))
+    elif width * height != len(square_info):
+      raise ValueError('%d squares are not a %dx%d grid' % (len(square_info), width, height))
+
+    ids: Dict[str, int] = {}
+    square_counts = np.zeros(max((int(square) for square in square_info), default=-1) + 1, dtype=np.int64)
+    pairs = []
+    for square, info in square_info.items():
+      if info is None:
+        continue
+      regions = list(dict.fromkeys(ids.setdefault(value, len(ids)) for value in info.values()))
+      square_counts[int(square)] = len(regions)
+      pairs.extend((int(square), region) for region in regions)
+
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    square_order = np.argsort(pairs[:, 0], kind='stable')
+    region_order = np.argsort(pairs[:, 1], kind='stable')
+    return RegionIndex(
+      list(ids.keys()),
+      np.concatenate([[0], np.cumsum(np.bincount(pairs[:, 1], minlength=len(ids)))]),
+      pairs[region_order, 0],
+      np.concatenate([[0], np.cumsum(square_counts)]),
+      pairs[square_order, 1],
+      width, height
+    )
+
+  @staticmethod
+  def load(path: str = REGION_INDEX_FILE) -> 'RegionIndex':
+    with np.load(path) as index:
+      return RegionIndex(
+        index['names'].tolist(), index['offsets'], index['squares'], index['square_offsets'], index['square_regions'],
+        int(index['width']), int(index['height'])
+      )
+
+  def save(self, path: str = REGION_INDEX_FILE):
+    with open(path + '.tmp', 'wb') as file:
+      np.savez(
+        file,
+        names=np.array(self.names, dtype=str),
+        offsets=self.offsets,
+        squares=self.squares.astype(np.int32),
+        square_offsets=self.square_offsets,
+        square_regions=self.square_regions,
+        width=self.width,
+        height=self.height
+      )
+    os.replace(path + '.tmp', path)
+
+  def squaresOf(self, name: str) -> np.ndarray:
+    region = self.ids[name]
+    return self.squares[self.offsets[region]:self.offsets[region + 1]]
+
+  def regionsOf(self, square: int) -> List[str]:
+    """
+    Returns the names of the regions a square belongs to.
+    """
+    if square + 1 >= self.square_offsets.size:
+      return []
+    regions = self.square_regions[self.square_offsets[square]:self.square_offsets[square + 1]]
+    return [self.names[region] for region in regions]
+
+  def means(self, distances: np.ndarray) -> np.ndarray:
+    """
+    Returns the mean distance over each region's squares.
+    """
+    sums = np.bincount(self.group_of, weights=distances[self.squares], minlength=len(self.names))
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return sums / self.counts
+
+  def percentiles(self, distances: np.ndarray, percentiles: Sequence[float]) -> np.ndarray:
+    """
+    Returns a (len(percentiles), regions) array of distance percentiles over
+    each region's squares, interpolated linearly like `np.percentile`.
+
+    All regions are sorted at once by (region, distance), after which every
+    percentile is a pair of lookups per region.
+    """
+    values = distances[self.squares]
+    values = values[np.lexsort((values, self.group_of))]
+
+    result = np.full((len(percentiles), len(self.names)), np.nan)
+    present = self.counts > 0
+    for i, percentile in enumerate(percentiles):
+      position = (self.counts[present] - 1) * (percentile / 100)
+      low = np.floor(position).astype(np.int64)
+      high = np.minimum(low + 1, self.counts[present] - 1)
+      fraction = position - low
+      low_values = values[self.offsets[:-1][present] + low]
+      high_values = values[self.offsets[:-1][present] + high]
+      result[i, present] = np.where(fraction > 0, low_values + (high_values - low_values) * fraction, low_values)
+    return result
+
+  def stats(self, distances: np.ndarray, percentiles: Sequence[float] = (50,)) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the means and the requested percentiles of every region at once.
+    """
+    return self.means(distances), self.percentiles(distances, percentiles)
+
+def load_region_index(square_info_path: str = SQUARE_INFO_FILE, index_path: str = REGION_INDEX_FILE) -> RegionIndex:
+  """
+  Loads the binary region index, converting square_info.json into it first if
+  the index is missing, older or was saved without its grid size.
+  """
+  if os.path.exists(index_path) and (not os.path.exists(square_info_path) or
+                                     os.path.getmtime(index_path) >= os.path.getmtime(square_info_path)):
+    try:
+      return RegionIndex.load(index_path)
+    except KeyError:
+      pass
+
+  with open(square_info_path, 'r') as file:
+    index = RegionIndex.fromSquareInfo(json.load(file))
+  try:
+    index.save(index_path)
+  except OSError as error:
+    print('Could not save the region index to %s: %s' % (index_path, error))
+  return index
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Converts square_info.json into a binary region index.')
+  parser.add_argument('--input', default=SQUARE_INFO_FILE, dest='input')
+  parser.add_argument('--output', default=REGION_INDEX_FILE, dest='output')
+  parser.add_argument('--width', default=None, type=int, dest='width')
+  parser.add_argument('--height', default=None, type=int, dest='height')
+  args = parser.parse_args()
+
+  with open(args.input, 'r') as file:
+    index = RegionIndex.fromSquareInfo(json.load(file), args.width, args.height)
+  index.save(args.output)
+  print('Saved %d regions over the %dx%d grid to %s' % (len(index.names), index.width, index.height, args.output))
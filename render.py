@@ -0,0 +1,181 @@
+"""
+Renders heatmaps and district tables for many origins without a window.
+
+Every line of the origins file (or every command-line argument) is one job: a
+cell number, `x,y` coordinates or a region name from square_info.json, or
+several of those joined by `+`, whose distances are combined by `--reducer`
+(the farthest of them by default, as when shift-clicking in the viewer, see
+`aggregation.py`). Each job produces a
+PNG of the heat over sofia.jpg and a CSV of the average and median distance
+in every region.
+
+Jobs are spread over a pool of processes, each of which memory-maps the same
+distance matrix file, so its pages are shared through the OS page cache
+instead of being copied into every worker. Results are written as soon as
+each job finishes and listed in `index.jsonl` in the output directory.
+
+Example usage: `python render.py --origins offices.txt --direction to --output-dir renders`
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import time
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple
+from aggregation import REDUCERS, OriginAggregate
+from distance_matrix import DISTANCE_MATRIX_FILE, DistanceMatrix
+from heatmap import heat_lut, quantize_distances
+from regions import RegionIndex, load_region_index
+
+MAP_FILE = 'sofia.jpg'
+OUTPUT_DIR = 'renders'
+
+def parse_job(line: str, width: int, region_index: RegionIndex) -> List[int]:
+  """
+  Returns the origin cells of a job such as `5050`, `50,50` or
+  `Lozenets + 10,20`.
+  """
+  cells = []
+  for spec in line.split('+'):
+    spec = spec.strip()
+    if re.fullmatch(r'\d+', spec):
+      cells.append(int(spec))
+    elif re.fullmatch(r'\d+\s*,\s*\d+', spec):
+      x, y = (int(value) for value in spec.split(','))
+      cells.append(x + y * width)
+    elif spec in region_index.ids:
+      cells.extend(region_index.squaresOf(spec).tolist())
+    else:
+      raise ValueError('Unknown origin %r' % spec)
+  return cells
+
+def job_name(number: int, line: str) -> str:
+  """
+  Names a job's output files after its line, e.g. 0003_Lozenets.
+  """
+  return '%04d_%s' % (number, re.sub(r'\W+', '_', line).strip('_')[:60])
+
+# Per-process state of the pool workers, set up once by _initWorker.
+_worker_matrix: DistanceMatrix = None
+_worker_regions: RegionIndex = None
+_worker_background: np.ndarray = None
+_worker_lut: np.ndarray = None
+_worker_args = None
+
+def _initWorker(args):
+  global _worker_matrix, _worker_regions, _worker_background, _worker_lut, _worker_args
+  _worker_args = args
+  _worker_matrix = DistanceMatrix(args.matrix)
+  _worker_regions = load_region_index() if args.csv else None
+  _worker_background = cv2.imread(args.map, flags=cv2.IMREAD_COLOR) if args.png else None
+  _worker_lut = heat_lut(args.min_heat, args.max_heat)
+
+def render_heatmap(distances: np.ndarray, width: int, height: int, background: np.ndarray,
+                   lut: np.ndarray) -> np.ndarray:
+  """
+  Colors distances per cell through the lookup table and blends them over the
+  background (BGR, as read by OpenCV), as the viewer does.
+  """
+  cells = lut[quantize_distances(distances)].reshape(height, width, 4)[::-1] # Invert Y.
+  heat = np.ascontiguousarray(cells[:, :, 2::-1]) # RGB to BGR.
+  heat = cv2.resize(heat, (background.shape[1], background.shape[0]), interpolation=cv2.INTER_NEAREST)
+  alpha = lut[0, 3] / 255
+  return cv2.addWeighted(heat, alpha, background, 1 - alpha, 0)
+
+def write_region_stats(path: str, distances: np.ndarray, region_index: RegionIndex):
+  averages, (medians,) = region_index.stats(distances, [50])
+  with open(path + '.tmp', 'w', newline='', encoding='utf8') as file:
+    writer = csv.writer(file)
+    writer.writerow(['region', 'average', 'median'])
+    for name, average, median in zip(region_index.names, averages, medians):
+      writer.writerow([name, '%.2f' % average, '%.2f' % median])
+  os.replace(path + '.tmp', path)
+
+def _renderJob(name: str, cells: List[int]) -> dict:
+  start = time.perf_counter()
+  vectors = _worker_matrix.rows if _worker_args.direction == 'from' else _worker_matrix.columns
+  aggregate = OriginAggregate(vectors, _worker_matrix.cells, _worker_args.reducer, _worker_args.percentile)
+  aggregate.add(cells)
+  distances = aggregate.result()
+
+  record = {'name': name, 'origins': len(cells)}
+  if _worker_background is not None:
+    record['png'] = os.path.join(_worker_args.output_dir, name + '.png')
+    image = render_heatmap(distances, _worker_matrix.width, _worker_matrix.height, _worker_background, _worker_lut)
+    cv2.imwrite(record['png'], image)
+  if _worker_regions is not None:
+    record['csv'] = os.path.join(_worker_args.output_dir, name + '.csv')
+    write_region_stats(record['csv'], distances, _worker_regions)
+  record['seconds'] = time.perf_counter() - start
+  return record
+
+def render_all(jobs: List[Tuple[str, List[int]]], args):
+  """
+  Renders every job over a pool of `args.workers` processes (or in this
+  process with 0), appending each result to index.jsonl as it finishes.
+  """
+  os.makedirs(args.output_dir, exist_ok=True)
+  start_time = time.time()
+  with open(os.path.join(args.output_dir, 'index.jsonl'), 'w', encoding='utf8') as index:
+    def onJobDone(record: dict, done: int):
+      index.write(json.dumps(record, ensure_ascii=False) + '\n')
+      index.flush()
+      print('[%d/%d] %s in %.2fs, %.1f jobs/s' % (
+        done, len(jobs), record['name'], record['seconds'], done / max(time.time() - start_time, 1e-9)
+      ))
+
+    if args.workers == 0:
+      _initWorker(args)
+      for done, job in enumerate(jobs, 1):
+        onJobDone(_renderJob(*job), done)
+    else:
+      with ProcessPoolExecutor(args.workers, initializer=_initWorker, initargs=(args,)) as executor:
+        futures = [executor.submit(_renderJob, *job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+          onJobDone(future.result(), done)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('origins', nargs='*')
+  parser.add_argument('--origins', default=None, dest='origins_file')
+  parser.add_argument('-d', '--direction', default='to', choices=['to', 'from'], dest='direction')
+  parser.add_argument('--reducer', default='max', choices=REDUCERS, dest='reducer')
+  parser.add_argument('--percentile', default=50, type=float, dest='percentile')
+  parser.add_argument('--matrix', default=DISTANCE_MATRIX_FILE, dest='matrix')
+  parser.add_argument('--map', default=MAP_FILE, dest='map')
+  parser.add_argument('--min-heat', default=0, type=float, dest='min_heat')
+  parser.add_argument('--max-heat', default=60, type=float, dest='max_heat')
+  parser.add_argument('--output-dir', default=OUTPUT_DIR, dest='output_dir')
+  parser.add_argument('--workers', default=None, type=int, dest='workers')
+  parser.add_argument('--no-png', action='store_false', dest='png')
+  parser.add_argument('--no-csv', action='store_false', dest='csv')
+  args = parser.parse_args()
+
+  lines = list(args.origins)
+  if args.origins_file is not None:
+    with open(args.origins_file, 'r', encoding='utf8') as file:
+      lines += [line.strip() for line in file if line.strip() and not line.startswith('#')]
+  if len(lines) == 0:
+    parser.error('No origins given')
+
+  matrix = DistanceMatrix(args.matrix)
+  region_index = load_region_index()
+  if args.csv and not region_index.fitsGrid(matrix.width, matrix.height):
+    parser.error('%s is not on the %dx%d grid of %s' % ('square_info.json', matrix.width, matrix.height, args.matrix))
+
+  jobs = []
+  for number, line in enumerate(lines):
+    try:
+      jobs.append((job_name(number, line), parse_job(line, matrix.width, region_index)))
+    except ValueError as error:
+      parser.error(str(error))
+  if any(cell >= matrix.cells for _, cells in jobs for cell in cells):
+    parser.error('Origins outside the %dx%d grid of %s' % (matrix.width, matrix.height, args.matrix))
+
+  render_all(jobs, args)
+  print('Rendered %d jobs into %s' % (len(jobs), args.output_dir))
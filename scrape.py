@@ -1,52 +1,263 @@
-import requests
-import html
-from bs4 import BeautifulSoup, NavigableString
-from requests_html import HTMLSession
+"""
+Scrapes the routes of every line from schedules.sofiatraffic.bg into routes.txt.
+
+Line pages are rendered concurrently by a bounded pool of reused renderers and
+every page is kept in an on-disk cache, so that re-runs only render what is
+missing. Routes are saved per line as soon as they are parsed, so a failed or
+interrupted run resumes where it left off. With `--replay` the cache is used
+as a fixture and nothing is fetched, which allows running (and timing) the
+parsing pipeline offline.
+
+Example usage: `python scrape.py --renderers 4`, `python scrape.py --replay --cache-dir fixtures`
+
+To pick up timetable changes, run with `--refresh`, which renders every page
+again (updating the cache) instead of reusing cached pages.
+"""
+
+import argparse
+import asyncio
+import hashlib
 import json
-import requests_html
+import os
+import time
+import requests
+from bs4 import BeautifulSoup
 from datetime import datetime
 from statistics import median
+from typing import Dict, List
+
+try:
+  from requests_html import AsyncHTMLSession
+except ImportError: # Only needed to render pages which are not cached.
+  AsyncHTMLSession = None
 
 DT_FORMAT = '%H:%M'
 
-base_url = 'http://schedules.sofiatraffic.bg/'
-response = requests.get(base_url)
-response.encoding = 'utf-8'
-soup = BeautifulSoup(response.text, features="html.parser")
-
-links = []
-for transport_type in soup.find('div', {'id': 'lines_quick_access'}).find_all('div'):
-  for line in transport_type.find_all('li'):
-    if 'N' not in line.a['href'] and line.a['href'] != 'autobus/123':
-      links.append(base_url + line.a['href'])
-
-links.append('http://schedules.sofiatraffic.bg/metro/1')
-  
-routes = []  
-for link in links:
-  session = HTMLSession()
-  print(link)
-  link_response = session.get(link)
-  link_response.html.render(sleep=1)
-  
-  page = link_response.html
-  
-  
-  # for stops_list in link_response.html.find('.schedule_direction_signs')[:2]:
-  #   stops = [(stop.find('input', first=True).text, stop.find('a', first=True).text) for stop in stops_list.find('li')]
-  #   print(stops_list)
-  
-  dirs = len(page.find('.schedule_view_direction_tabs', first=True).find('li'))
-  
-  for stops_list, times_list, schedule_table in zip(page.find('.schedule_direction_signs')[:dirs], page.find('.line_print_route')[:dirs], page.find('.schedule_times')[:dirs]):
-    stops = [(stop_time.find('.stop_minutes_print', first=True).text, stop.find('a', first=True).text) for stop, stop_time in zip(stops_list.find('li'), times_list.find('li'))]
-    schedule_times = [cell.text for cell in schedule_table.find('.hours_cell a')]
-    schedule_diffs = [(datetime.strptime(t2, DT_FORMAT) - datetime.strptime(t1, DT_FORMAT)).seconds / 60 for t1, t2 in zip(schedule_times[:-1], schedule_times[1:])]
+BASE_URL = 'http://schedules.sofiatraffic.bg/'
+EXTRA_LINKS = ['metro/1']
+
+CACHE_DIR = 'scrape_cache'
+PARTIAL_ROUTES_FILE = 'routes.partial.jsonl'
+
+def text_of(element) -> str:
+  """
+  Returns an element's text with whitespace collapsed.
+  """
+  return ' '.join(element.get_text().split())
+
+def parse_line_links(index_html: str, base_url: str = BASE_URL) -> List[str]:
+  """
+  Returns the URLs of the line pages listed on the index page (night lines and
+  line 123 excluded).
+  """
+  soup = BeautifulSoup(index_html, features='html.parser')
+  links = []
+  for transport_type in soup.find('div', {'id': 'lines_quick_access'}).find_all('div'):
+    for line in transport_type.find_all('li'):
+      if 'N' not in line.a['href'] and line.a['href'] != 'autobus/123':
+        links.append(base_url + line.a['href'])
+  return links + [base_url + link for link in EXTRA_LINKS]
+
+def parse_line(page_html: str) -> List[dict]:
+  """
+  Parses the routes (one per direction) out of a rendered line page, along
+  with the departure times ('HH:MM') of each from its first stop.
+  """
+  page = BeautifulSoup(page_html, features='html.parser')
+  dirs = len(page.select_one('.schedule_view_direction_tabs').select('li'))
+
+  routes = []
+  for stops_list, times_list, schedule_table in zip(page.select('.schedule_direction_signs')[:dirs],
+                                                    page.select('.line_print_route')[:dirs],
+                                                    page.select('.schedule_times')[:dirs]):
+    stops = [
+      (text_of(stop_time.select_one('.stop_minutes_print')), text_of(stop.select_one('a')))
+      for stop, stop_time in zip(stops_list.select('li'), times_list.select('li'))
+    ]
+    schedule_times = [text_of(cell) for cell in schedule_table.select('.hours_cell a')]
+    schedule_diffs = [
+      (datetime.strptime(t2, DT_FORMAT) - datetime.strptime(t1, DT_FORMAT)).seconds / 60
+      for t1, t2 in zip(schedule_times[:-1], schedule_times[1:])
+    ]
     if len(schedule_diffs) == 0: continue # No times on timetable.
-    
-    routes.append({'stops': stops, 'median_wait': median(schedule_diffs)})
-  
-  session.close()
 
-with open('routes.txt', 'w') as file:
-  json.dump(routes, file)
+    routes.append({'stops': stops, 'median_wait': median(schedule_diffs), 'departures': schedule_times})
+  return routes
+
+class PageCache:
+  """
+  Pages on disk, stored by the hash of their contents, with an index from URL
+  to content hash. Identical pages are only stored once.
+  """
+
+  def __init__(self, directory: str = CACHE_DIR):
+    self.directory = directory
+    self.index_path = os.path.join(directory, 'index.json')
+    os.makedirs(os.path.join(directory, 'pages'), exist_ok=True)
+
+    self.index: Dict[str, str] = {}
+    if os.path.exists(self.index_path):
+      with open(self.index_path, 'r') as file:
+        self.index = json.load(file)
+
+  def pagePath(self, content_hash: str) -> str:
+    return os.path.join(self.directory, 'pages', content_hash + '.html')
+
+  def get(self, url: str) -> str:
+    """
+    Returns the cached page at `url`, or None if it is not cached.
+    """
+    content_hash = self.index.get(url)
+    if content_hash is None or not os.path.exists(self.pagePath(content_hash)):
+      return None
+    with open(self.pagePath(content_hash), 'r', encoding='utf8') as file:
+      return file.read()
+
+  def put(self, url: str, page_html: str) -> str:
+    content_hash = hashlib.sha256(page_html.encode('utf8')).hexdigest()
+    with open(self.pagePath(content_hash), 'w', encoding='utf8') as file:
+      file.write(page_html)
+
+    self.index[url] = content_hash
+    with open(self.index_path + '.tmp', 'w') as file:
+      json.dump(self.index, file, indent=2)
+    os.replace(self.index_path + '.tmp', self.index_path)
+    return content_hash
+
+class RendererPool:
+  """
+  A fixed number of rendering sessions (each with its own headless browser),
+  handed out to one page at a time and reused across pages.
+  """
+
+  def __init__(self, size: int, sleep: float = 1):
+    if AsyncHTMLSession is None:
+      raise RuntimeError('requests_html is needed to render pages, use --replay to scrape from the cache only')
+    self.sleep = sleep
+    self.sessions = [AsyncHTMLSession() for _ in range(size)]
+    self.idle: asyncio.Queue = asyncio.Queue()
+    for session in self.sessions:
+      self.idle.put_nowait(session)
+
+  async def render(self, url: str) -> str:
+    session = await self.idle.get()
+    try:
+      response = await session.get(url)
+      await response.html.arender(sleep=self.sleep)
+      return response.html.html
+    finally:
+      self.idle.put_nowait(session)
+
+  async def close(self):
+    for session in self.sessions:
+      await session.close()
+
+def load_partial_routes(path: str) -> Dict[str, List[dict]]:
+  """
+  Loads the routes of the lines already scraped, keyed by line URL.
+  """
+  done = {}
+  if os.path.exists(path):
+    with open(path, 'r', encoding='utf8') as file:
+      for line in file:
+        if line.strip():
+          entry = json.loads(line)
+          done[entry['url']] = entry['routes']
+  return done
+
+class Scraper:
+  def __init__(self, cache: PageCache, renderers: RendererPool = None, partial_path: str = PARTIAL_ROUTES_FILE,
+               refresh: bool = False):
+    self.cache = cache
+    self.refresh = refresh
+    self.renderers = renderers
+    self.partial_path = partial_path
+    self.done = load_partial_routes(partial_path)
+
+  async def page(self, url: str) -> str:
+    page_html = None if self.refresh else self.cache.get(url)
+    if page_html is None:
+      if self.renderers is None:
+        raise KeyError('%s is not in the cache' % url)
+      page_html = await self.renderers.render(url)
+      self.cache.put(url, page_html)
+    return page_html
+
+  async def scrapeLine(self, url: str) -> List[dict]:
+    if url in self.done:
+      return self.done[url]
+
+    routes = parse_line(await self.page(url))
+    self.done[url] = routes
+    with open(self.partial_path, 'a', encoding='utf8') as file:
+      file.write(json.dumps({'url': url, 'routes': routes}) + '\n')
+    print('%s: %d routes' % (url, len(routes)))
+    return routes
+
+  async def run(self, links: List[str]) -> Dict[str, List[dict]]:
+    """
+    Scrapes all lines concurrently (bounded by the renderer pool), returning
+    the routes of each line which succeeded. Failures are reported and the
+    rest of the lines carry on.
+    """
+    results = await asyncio.gather(*[self.scrapeLine(link) for link in links], return_exceptions=True)
+    routes = {}
+    for link, result in zip(links, results):
+      if isinstance(result, Exception):
+        print('Failed to scrape %s: %r' % (link, result))
+      else:
+        routes[link] = result
+    return routes
+
+def fetch_index(cache: PageCache, base_url: str, replay: bool, refresh: bool) -> str:
+  index_html = None if refresh and not replay else cache.get(base_url)
+  if index_html is None:
+    if replay:
+      raise KeyError('%s is not in the cache' % base_url)
+    response = requests.get(base_url)
+    response.encoding = 'utf-8'
+    index_html = response.text
+    cache.put(base_url, index_html)
+  return index_html
+
+async def scrape(args) -> bool:
+  cache = PageCache(args.cache_dir)
+  if args.refresh and os.path.exists(args.partial):
+    os.remove(args.partial)
+
+  links = parse_line_links(fetch_index(cache, args.base_url, args.replay, args.refresh), args.base_url)
+  renderers = None if args.replay else RendererPool(args.renderers, args.sleep)
+  try:
+    start_time = time.time()
+    routes = await Scraper(cache, renderers, args.partial, args.refresh and not args.replay).run(links)
+    print('Scraped %d of %d lines in %.2fs' % (len(routes), len(links), time.time() - start_time))
+  finally:
+    if renderers is not None:
+      await renderers.close()
+
+  # Only write a complete set of routes; a re-run picks up the failed lines.
+  if len(routes) < len(links):
+    print('Not writing %s, re-run to retry the %d failed lines' % (args.output, len(links) - len(routes)))
+    return False
+
+  with open(args.output, 'w') as file:
+    json.dump([route for link in links for route in routes[link]], file)
+  # Nothing is written there when every line came from the cache.
+  if os.path.exists(args.partial):
+    os.remove(args.partial)
+  return True
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--renderers', default=4, type=int, dest='renderers')
+  parser.add_argument('--sleep', default=1, type=float, dest='sleep')
+  parser.add_argument('--cache-dir', default=CACHE_DIR, dest='cache_dir')
+  parser.add_argument('--partial', default=PARTIAL_ROUTES_FILE, dest='partial')
+  parser.add_argument('--refresh', action='store_true', dest='refresh')
+  parser.add_argument('--replay', action='store_true', dest='replay')
+  parser.add_argument('--base-url', default=BASE_URL, dest='base_url')
+  parser.add_argument('--output', default='routes.txt', dest='output')
+  args = parser.parse_args()
+
+  if not asyncio.run(scrape(args)):
+    raise SystemExit(1)
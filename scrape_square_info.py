@@ -1,15 +1,29 @@
-import numpy as np
-import requests
-import json
-import argparse
-import time
+"""
+Reverse-geocodes the centre of every grid square into square_info.json.
+
+Requests are kept in flight concurrently (`--concurrency`), paced by a token
+bucket (`--rate` requests per second) which also backs off for as long as the
+server asks through `Retry-After`. Every result is appended to a checkpoint log
+as soon as it arrives, so an interrupted run continues where it left off.
 
-parser = argparse.ArgumentParser()
-parser.add_argument('token', type=str)
-parser.add_argument('-w --width', dest='width', type=int, default=100)
-parser.add_argument('-h --height', dest='height', type=int, default=100)
+With `--adaptive` the grid is covered by blocks whose corners are geocoded
+first. A block whose corners all agree is filled in without further requests,
+otherwise it is split into four and the same is done for each quarter, so only
+the squares near district boundaries are ever geocoded.
 
-args = parser.parse_args() 
+Example usage: `python scrape_square_info.py TOKEN --width 200 --height 200 --adaptive`
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Tuple
 
 WESTMOST_LAT = 23.19
 EASTMOST_LAT = 23.47
@@ -19,53 +33,272 @@ SOUTHMOST_LON = 42.60
 COVER_LAT = abs(EASTMOST_LAT - WESTMOST_LAT)
 COVER_LON = abs(NORTHMOST_LON - SOUTHMOST_LON)
 
-GEO_FETCH_URL = 'https://eu1.locationiq.com/v1/reverse.php?key=%s&lat=%.6f&lon=%.6f&format=json&zoom=14'
-
-HOR_PIXELS, VER_PIXELS = args.width, args.height
-
-square_info = {x: None for x in range(HOR_PIXELS * VER_PIXELS)}
-
-encoder = json.JSONEncoder()
-
-def fetchSquare(x: int, y: int):
-  square_center_x = x / HOR_PIXELS * COVER_LAT + WESTMOST_LAT + COVER_LAT / HOR_PIXELS / 2
-  square_center_y = y / VER_PIXELS * COVER_LON + SOUTHMOST_LON + COVER_LON / VER_PIXELS / 2
-  status = 0
-  while status != 200:
-    response = requests.get(GEO_FETCH_URL % (args.token, square_center_y, square_center_x))
-    status = response.status_code
-    
-    if status != 200: 
-      print('Error: Status %d' % status)
-      print(response.headers)
-      if retry_time := response.headers.get('Retry-After', None):
-        print('Retrying in %d seconds...' % retry_time)
-        time.sleep(float(retry_time))
-      else:
-        time.sleep(1)
-
-  jres = response.json()
-  
-  global square_info
-  square_info[x + y * HOR_PIXELS] = jres['address']
-  
-def fetchAll():
-  start_time = time.time()
-  
-  for y in range(VER_PIXELS):
-    for x in range(HOR_PIXELS):
-      fetchSquare(x, y)
-      print('Fetched %d, %d' % (x, y))
-      
-      avg_secs_per_square = (time.time() - start_time) / (x + 1 + y * HOR_PIXELS)
-      est_remaining = (HOR_PIXELS - x + (VER_PIXELS - y - 1) * HOR_PIXELS) * avg_secs_per_square
-      print('Est. remaining: %.2f minutes' % (est_remaining / 60))
-      
-      time.sleep(1)
-    
-    with open('square_info.json', 'w') as file:
-      file.write(encoder.encode(square_info))
-      print('Output up to y = %d saved to file.' % y)
+GEO_BASE_URL = 'https://eu1.locationiq.com'
+GEO_FETCH_PATH = '/v1/reverse.php?key=%s&lat=%.6f&lon=%.6f&format=json&zoom=14'
+
+SQUARE_INFO_FILE = 'square_info.json'
+CHECKPOINT_FILE = 'square_info.log.jsonl'
+
+def square_center(x: int, y: int, width: int, height: int) -> Tuple[float, float]:
+  """
+  Returns the (lat, lon) of the centre of a square, as used by the geocoder.
+  """
+  square_center_x = x / width * COVER_LAT + WESTMOST_LAT + COVER_LAT / width / 2
+  square_center_y = y / height * COVER_LON + SOUTHMOST_LON + COVER_LON / height / 2
+  return square_center_y, square_center_x
+
+def retry_after_seconds(value: str, default: float = 1) -> float:
+  """
+  Parses a `Retry-After` header, given either in seconds or as an HTTP date.
+  """
+  if value is None:
+    return default
+  try:
+    return max(float(value), 0)
+  except ValueError:
+    pass
+  try:
+    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+  except (TypeError, ValueError):
+    return default
+
+class TokenBucket:
+  """
+  Allows `rate` acquisitions per second on average, with bursts of up to
+  `burst`. `pause` holds back every acquisition for a while (e.g. Retry-After).
+  """
+
+  def __init__(self, rate: float, burst: int = 1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.paused_until = 0.0
+    self.lock = asyncio.Lock()
+
+  def pause(self, seconds: float):
+    self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    self.tokens = 0
+
+  async def acquire(self):
+    async with self.lock:
+      while True:
+        now = time.monotonic()
+        if now < self.paused_until:
+          await asyncio.sleep(self.paused_until - now)
+          self.updated = time.monotonic()
+          continue
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Geocoder:
+  """
+  Geocodes squares of a `width` x `height` grid (numbered x + y * width, from
+  the south-west), each at most once, recording results in a checkpoint log.
+  """
+
+  def __init__(self, token: str, width: int, height: int, base_url: str = GEO_BASE_URL, rate: float = 1,
+               concurrency: int = 4, checkpoint_path: str = CHECKPOINT_FILE):
+    self.token = token
+    self.width = width
+    self.height = height
+    self.url = base_url.rstrip('/') + GEO_FETCH_PATH
+    self.bucket = TokenBucket(rate, burst=concurrency)
+    self.executor = ThreadPoolExecutor(concurrency)
+    # requests.Session isn't thread-safe, so each executor thread has its own.
+    self._local = threading.local()
+    self.sessions: List[requests.Session] = []
+    self.sessions_lock = threading.Lock()
+
+    self.results: Dict[int, dict] = {}
+    self.inferred: Dict[int, dict] = {}
+    self.pending: Dict[int, asyncio.Future] = {}
+    self.requests = 0
+    self.start_time = time.time()
+
+    self.checkpoint_path = checkpoint_path
+    self.loadCheckpoint()
+    self.checkpoint = open(checkpoint_path, 'a')
+    if os.path.getsize(checkpoint_path) == 0:
+      self.checkpoint.write(json.dumps({'width': width, 'height': height}) + '\n')
+      self.checkpoint.flush()
+
+  @property
+  def session(self) -> requests.Session:
+    if not hasattr(self._local, 'session'):
+      self._local.session = requests.Session()
+      with self.sessions_lock:
+        self.sessions.append(self._local.session)
+    return self._local.session
+
+  def loadCheckpoint(self):
+    if not os.path.exists(self.checkpoint_path):
+      return
+    with open(self.checkpoint_path, 'r') as file:
+      text = [line for line in file if line.strip()]
+
+    # A run killed mid-write leaves a truncated last line, which is dropped
+    # (and later requested again) so that appending starts on a fresh line.
+    lines = []
+    for index, line in enumerate(text):
+      try:
+        lines.append(json.loads(line))
+      except ValueError:
+        if index < len(text) - 1:
+          raise
+        print('Dropping the truncated last line of %s' % self.checkpoint_path)
+        with open(self.checkpoint_path + '.tmp', 'w') as file:
+          file.writelines(text[:-1])
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+    if len(lines) > 0 and (lines[0].get('width'), lines[0].get('height')) != (self.width, self.height):
+      raise ValueError('%s is for a different grid, remove it to start over' % self.checkpoint_path)
+    for entry in lines[1:]:
+      self.results[entry['square']] = entry['address']
+    print('Loaded %d squares from %s' % (len(self.results), self.checkpoint_path))
+
+  def request(self, lat: float, lon: float) -> dict:
+    """
+    Fetches a single address, or returns None if there is none at the point.
+    Raises an exception with a `retry_after` attribute when it should be retried.
+    """
+    try:
+      response = self.session.get(self.url % (self.token, lat, lon), timeout=30)
+    except requests.RequestException as error:
+      error.retry_after = 1
+      raise
+
+    if response.status_code == 404: # Nothing at this point (e.g. "Unable to geocode").
+      return None
+    if response.status_code != 200:
+      error = requests.HTTPError('Status %d' % response.status_code)
+      error.retry_after = retry_after_seconds(response.headers.get('Retry-After', None))
+      raise error
+
+    # A cut-off body or one without an address (e.g. an error message sent
+    # with status 200) is retried like any other failed request.
+    try:
+      address = response.json()['address']
+    except (ValueError, KeyError, TypeError) as error:
+      error = requests.RequestException('Invalid response (%s)' % error)
+      error.retry_after = 1
+      raise error
+    return address
+
+  async def fetch(self, square: int) -> dict:
+    lat, lon = square_center(square % self.width, square // self.width, self.width, self.height)
+    loop = asyncio.get_running_loop()
+    while True:
+      await self.bucket.acquire()
+      try:
+        address = await loop.run_in_executor(self.executor, self.request, lat, lon)
+        break
+      except requests.RequestException as error:
+        print('Error: %s, retrying square %d in %.1f seconds...' % (error, square, error.retry_after))
+        self.bucket.pause(error.retry_after)
+
+    self.results[square] = address
+    self.checkpoint.write(json.dumps({'square': square, 'address': address}) + '\n')
+    self.checkpoint.flush()
+
+    self.requests += 1
+    if self.requests % 50 == 0:
+      print('Fetched %d squares, %.2f requests/s' % (self.requests, self.requests / (time.time() - self.start_time)))
+    return address
+
+  async def fetchSquare(self, x: int, y: int) -> dict:
+    """
+    Returns the address of a square, geocoding it unless it already was (or
+    is being) geocoded.
+    """
+    square = x + y * self.width
+    if square in self.results:
+      return self.results[square]
+    if square not in self.pending:
+      self.pending[square] = asyncio.ensure_future(self.fetch(square))
+    return await self.pending[square]
+
+  async def fetchAll(self):
+    await asyncio.gather(*[self.fetchSquare(x, y) for y in range(self.height) for x in range(self.width)])
+
+  async def fetchBlock(self, x0: int, y0: int, x1: int, y1: int):
+    """
+    Covers the block of squares between two corners (inclusive), filling it
+    in from the corners if they agree and splitting it up otherwise.
+    """
+    corners = await asyncio.gather(*[self.fetchSquare(x, y) for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))])
+    if all(corner == corners[0] for corner in corners):
+      for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+          self.inferred[x + y * self.width] = corners[0]
+      return
+
+    xs = [(x0, x1)] if x1 - x0 <= 1 else [(x0, (x0 + x1) // 2), ((x0 + x1) // 2, x1)]
+    ys = [(y0, y1)] if y1 - y0 <= 1 else [(y0, (y0 + y1) // 2), ((y0 + y1) // 2, y1)]
+    if len(xs) == 1 and len(ys) == 1:
+      return # Every square is a corner.
+    await asyncio.gather(*[self.fetchBlock(bx0, by0, bx1, by1) for bx0, bx1 in xs for by0, by1 in ys])
+
+  async def fetchAdaptive(self, block_size: int):
+    """
+    Starts from blocks of `block_size` squares, small enough not to skip over
+    whole districts.
+    """
+    def splits(length: int) -> List[int]:
+      return sorted(set(list(range(0, length - 1, block_size)) + [length - 1]))
+    xs, ys = splits(self.width), splits(self.height)
+    xs, ys = xs if len(xs) > 1 else xs * 2, ys if len(ys) > 1 else ys * 2
+    await asyncio.gather(*[
+      self.fetchBlock(x0, y0, x1, y1) for x0, x1 in zip(xs[:-1], xs[1:]) for y0, y1 in zip(ys[:-1], ys[1:])
+    ])
+
+  def squareInfo(self) -> Dict[int, dict]:
+    info = {square: None for square in range(self.width * self.height)}
+    info.update(self.inferred)
+    info.update(self.results)
+    return info
+
+  def close(self):
+    self.checkpoint.close()
+    self.executor.shutdown()
+    for session in self.sessions:
+      session.close()
+
+async def geocode(args) -> Dict[int, dict]:
+  geocoder = Geocoder(args.token, args.width, args.height, args.base_url, args.rate, args.concurrency, args.checkpoint)
+  try:
+    if args.adaptive:
+      await geocoder.fetchAdaptive(args.block_size)
+    else:
+      await geocoder.fetchAll()
+  finally:
+    geocoder.close()
+
+  print('Geocoded %d of %d squares with %d requests in %.2f minutes' % (
+    len(geocoder.results), args.width * args.height, geocoder.requests, (time.time() - geocoder.start_time) / 60
+  ))
+  return geocoder.squareInfo()
 
 if __name__ == '__main__':
-  fetchAll()
\ No newline at end of file
+  parser = argparse.ArgumentParser()
+  parser.add_argument('token', type=str)
+  parser.add_argument('--width', dest='width', type=int, default=100)
+  parser.add_argument('--height', dest='height', type=int, default=100)
+  parser.add_argument('--rate', dest='rate', type=float, default=1)
+  parser.add_argument('--concurrency', dest='concurrency', type=int, default=4)
+  parser.add_argument('--adaptive', dest='adaptive', action='store_true')
+  parser.add_argument('--block-size', dest='block_size', type=int, default=8)
+  parser.add_argument('--base-url', dest='base_url', default=GEO_BASE_URL)
+  parser.add_argument('--checkpoint', dest='checkpoint', default=CHECKPOINT_FILE)
+  parser.add_argument('--output', dest='output', default=SQUARE_INFO_FILE)
+  args = parser.parse_args()
+
+  square_info = asyncio.run(geocode(args))
+  with open(args.output + '.tmp', 'w') as file:
+    json.dump(square_info, file)
+  os.replace(args.output + '.tmp', args.output)
+  print('Output saved to %s.' % args.output)
@@ -0,0 +1,274 @@
+"""
+A local HTTP service answering distance queries from one memory-mapped matrix.
+
+Every viewer on a machine can share a single server instead of mapping the
+matrix itself: only the server reads the file, and rows, columns, region
+statistics and rendered heatmap tiles are fetched from it. Requests are
+handled concurrently on a thread per connection (reads from the memory map
+and NumPy release the GIL for most of their work), and rendered tiles are
+kept in an LRU cache.
+
+Endpoints (origins are comma-separated cells, combined like shift-clicked
+sources in the viewer; direction is `to` or `from`):
+
+* `/info` - the matrix header (grid size, scale, source hashes...)
+* `/row/<cell>`, `/column/<cell>` - distances as stored (uint16 LE, see `/info`)
+* `/distances?origins=...&direction=...` - the same, for several origins
+* `/regions?origins=...&direction=...` - average and median per region as JSON
+* `/tiles/<z>/<x>/<y>.png?origins=...&direction=...&min_heat=...&max_heat=...` -
+  a heatmap tile over sofia.jpg, tile (0, 0) of zoom z being the north-west
+  one of 2^z x 2^z
+
+Example usage: `python server.py --port 8765`, then `python distance_map.py --server http://localhost:8765`
+"""
+
+import argparse
+import json
+import threading
+import cv2
+import numpy as np
+import requests
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence
+from urllib.parse import parse_qs, urlparse
+from distance_matrix import DISTANCE_MATRIX_FILE, DistanceMatrix, dequantize
+from heatmap import heat_lut, quantize_distances
+from regions import RegionIndex, load_region_index
+
+DEFAULT_PORT = 8765
+TILE_SIZE = 256
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+MAX_ZOOM = 8
+
+class DistanceService:
+  """
+  The queries served, independent of HTTP.
+  """
+
+  def __init__(self, matrix: DistanceMatrix, region_index: RegionIndex = None, background: np.ndarray = None,
+               tile_cache_bytes: int = TILE_CACHE_BYTES):
+    self.matrix = matrix
+    self.region_index = region_index
+    self.background = background
+
+    self.tile_cache: OrderedDict = OrderedDict()
+    self.tile_cache_bytes = tile_cache_bytes
+    self.tile_bytes = 0
+    self.tile_lock = threading.Lock()
+    self.tile_hits = 0
+    self.tile_misses = 0
+
+  def distances(self, origins: Sequence[int], direction: str) -> np.ndarray:
+    """
+    The distance from (or to) the farthest of the origins, per cell.
+    """
+    if len(origins) == 0 or min(origins) < 0 or max(origins) >= self.matrix.cells:
+      raise ValueError('Origins must be cells of the %dx%d grid' % (self.matrix.width, self.matrix.height))
+    if direction == 'from':
+      return np.max(self.matrix.rows(origins), axis=0)
+    if direction == 'to':
+      return np.max(self.matrix.columns(origins), axis=0)
+    raise ValueError('Unknown direction %r' % direction)
+
+  def regionStats(self, origins: Sequence[int], direction: str) -> Dict[str, dict]:
+    if self.region_index is None:
+      raise LookupError('No region index for this grid')
+    averages, (medians,) = self.region_index.stats(self.distances(origins, direction), [50])
+    return {
+      name: {'average': None if np.isnan(average) else float(average),
+             'median': None if np.isnan(median) else float(median)}
+      for name, average, median in zip(self.region_index.names, averages, medians)
+    }
+
+  def renderTile(self, z: int, x: int, y: int, origins: Sequence[int], direction: str,
+                 min_heat: float, max_heat: float) -> bytes:
+    """
+    Renders a tile as PNG: the heat of the cells under each pixel, blended
+    over the matching part of the map.
+    """
+    tiles = 1 << z
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < tiles or not 0 <= y < tiles:
+      raise ValueError('No tile %d/%d/%d' % (z, x, y))
+    width, height = self.matrix.width, self.matrix.height
+
+    # The fraction across (and down) the map of every pixel's centre.
+    fx = (x + (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE) / tiles
+    fy = (y + (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE) / tiles
+    cell_x = np.minimum((fx * width).astype(np.int64), width - 1)
+    cell_y = height - 1 - np.minimum((fy * height).astype(np.int64), height - 1) # Invert Y.
+
+    lut = heat_lut(min_heat, max_heat)
+    indices = quantize_distances(self.distances(origins, direction))
+    heat = lut[indices[cell_y[:, None] * width + cell_x[None, :]]]
+    tile = np.ascontiguousarray(heat[:, :, 2::-1]) # RGB to BGR.
+
+    if self.background is not None:
+      map_height, map_width = self.background.shape[:2]
+      crop = self.background[
+        map_height * y // tiles:max(map_height * (y + 1) // tiles, map_height * y // tiles + 1),
+        map_width * x // tiles:max(map_width * (x + 1) // tiles, map_width * x // tiles + 1)
+      ]
+      crop = cv2.resize(crop, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_LINEAR)
+      alpha = lut[0, 3] / 255
+      tile = cv2.addWeighted(tile, alpha, crop, 1 - alpha, 0)
+    return cv2.imencode('.png', tile)[1].tobytes()
+
+  def tile(self, z: int, x: int, y: int, origins: Sequence[int], direction: str,
+           min_heat: float = 0, max_heat: float = 60) -> bytes:
+    """
+    Returns a rendered tile, from the cache if it was rendered recently.
+    """
+    key = (z, x, y, tuple(sorted(set(origins))), direction, min_heat, max_heat)
+    with self.tile_lock:
+      if key in self.tile_cache:
+        self.tile_hits += 1
+        self.tile_cache.move_to_end(key)
+        return self.tile_cache[key]
+
+    png = self.renderTile(z, x, y, origins, direction, min_heat, max_heat)
+    with self.tile_lock:
+      self.tile_misses += 1
+      if key not in self.tile_cache:
+        self.tile_cache[key] = png
+        self.tile_bytes += len(png)
+      while self.tile_bytes > self.tile_cache_bytes and len(self.tile_cache) > 1:
+        self.tile_bytes -= len(self.tile_cache.popitem(last=False)[1])
+    return png
+
+def parse_origins(query: Dict[str, List[str]]) -> List[int]:
+  return [int(origin) for origin in query.get('origins', [''])[0].split(',') if origin.strip()]
+
+class DistanceRequestHandler(BaseHTTPRequestHandler):
+  service: DistanceService = None
+
+  def send(self, body: bytes, content_type: str, **headers):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in headers.items():
+      self.send_header(name.replace('_', '-'), value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def sendVector(self, minutes: np.ndarray):
+    self.send(self.service.matrix.quantize(minutes).astype('<u2').tobytes(), 'application/octet-stream',
+              X_Scale=str(self.service.matrix.scale))
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    parts = [part for part in url.path.split('/') if part]
+    query = parse_qs(url.query)
+    direction = query.get('direction', ['to'])[0]
+    matrix = self.service.matrix
+    try:
+      if parts == ['info']:
+        self.send(json.dumps(matrix.header).encode('utf8'), 'application/json')
+      elif len(parts) == 2 and parts[0] in ('row', 'column'):
+        self.sendVector(self.service.distances([int(parts[1])], 'from' if parts[0] == 'row' else 'to'))
+      elif parts == ['distances']:
+        self.sendVector(self.service.distances(parse_origins(query), direction))
+      elif parts == ['regions']:
+        stats = self.service.regionStats(parse_origins(query), direction)
+        self.send(json.dumps(stats, ensure_ascii=False).encode('utf8'), 'application/json')
+      elif len(parts) == 4 and parts[0] == 'tiles' and parts[3].endswith('.png'):
+        z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-len('.png')])
+        self.send(self.service.tile(
+          z, x, y, parse_origins(query), direction,
+          float(query.get('min_heat', [0])[0]), float(query.get('max_heat', [60])[0])
+        ), 'image/png')
+      else:
+        self.send_error(404, 'Unknown endpoint')
+    except LookupError as error:
+      self.send_error(404, str(error))
+    except ValueError as error:
+      self.send_error(400, str(error))
+
+  def log_message(self, format, *args):
+    pass # Every tile is a request, so don't log each one.
+
+def serve(service: DistanceService, host: str, port: int) -> ThreadingHTTPServer:
+  """
+  Creates a server answering from `service` on a thread per connection.
+  """
+  handler = type('Handler', (DistanceRequestHandler,), {'service': service})
+  server = ThreadingHTTPServer((host, port), handler)
+  server.daemon_threads = True
+  return server
+
+class DistanceClient:
+  """
+  Serves the same row/column interface as `DistanceMatrix` from a server, so
+  that viewers can use it in place of mapping the matrix themselves. Sessions
+  are not thread-safe, so every thread using the client gets its own.
+  """
+
+  def __init__(self, base_url: str):
+    self.base_url = base_url.rstrip('/')
+    self._local = threading.local()
+    self.header = self.get('/info').json()
+    self.width: int = self.header['width']
+    self.height: int = self.header['height']
+    self.cells = self.width * self.height
+    self.scale: float = self.header['scale']
+
+  @property
+  def session(self) -> requests.Session:
+    if not hasattr(self._local, 'session'):
+      self._local.session = requests.Session()
+    return self._local.session
+
+  def get(self, path: str, **params) -> requests.Response:
+    response = self.session.get(self.base_url + path, params=params, timeout=30)
+    response.raise_for_status()
+    return response
+
+  def vector(self, path: str, **params) -> np.ndarray:
+    return dequantize(np.frombuffer(self.get(path, **params).content, dtype='<u2'), self.scale)
+
+  def row(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from `origin` to every cell.
+    """
+    return self.vector('/row/%d' % origin)
+
+  def column(self, origin: int) -> np.ndarray:
+    """
+    Distances in minutes from every cell to `origin`.
+    """
+    return self.vector('/column/%d' % origin)
+
+  def rows(self, origins: Sequence[int]) -> np.ndarray:
+    return np.stack([self.row(origin) for origin in origins])
+
+  def columns(self, origins: Sequence[int]) -> np.ndarray:
+    """
+    Distances to each of `origins`, one row per origin.
+    """
+    return np.stack([self.column(origin) for origin in origins])
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1', dest='host')
+  parser.add_argument('--port', default=DEFAULT_PORT, type=int, dest='port')
+  parser.add_argument('--matrix', default=DISTANCE_MATRIX_FILE, dest='matrix')
+  parser.add_argument('--map', default='sofia.jpg', dest='map')
+  parser.add_argument('--tile-cache-mb', default=TILE_CACHE_BYTES // 1024 // 1024, type=int, dest='tile_cache_mb')
+  args = parser.parse_args()
+
+  matrix = DistanceMatrix(args.matrix)
+  region_index = load_region_index()
+  if not region_index.fitsGrid(matrix.width, matrix.height):
+    print('square_info.json is not on the %dx%d grid, region statistics are disabled' % (matrix.width, matrix.height))
+    region_index = None
+  background = cv2.imread(args.map, flags=cv2.IMREAD_COLOR)
+
+  service = DistanceService(matrix, region_index, background, args.tile_cache_mb * 1024 * 1024)
+  server = serve(service, args.host, args.port)
+  print('Serving the %dx%d matrix %s on http://%s:%d' % (matrix.width, matrix.height, args.matrix, args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
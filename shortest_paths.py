@@ -0,0 +1,135 @@
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.sparse.csgraph import dijkstra
+from typing import Callable, Set
+from distance_matrix import DistanceMatrix
+from profiling import NullProfiler, StageProfiler
+from transit import TransitGraph
+
+class DijkstraRows:
+  """
+  Computes rows of the distance matrix by running Dijkstra from each of the
+  grid cells over the full transit graph.
+  """
+
+  def __init__(self, graph: TransitGraph):
+    self.matrix = graph.matrix
+    self.cells = graph.grid.cells
+
+  def __call__(self, start: int, stop: int) -> np.ndarray:
+    return dijkstra(self.matrix, indices=np.arange(start, stop))[:, :self.cells]
+
+# Per-process state of the pool workers, set up once by _initWorker.
+_worker_rows: Callable[[int, int], np.ndarray] = None
+_worker_matrix: DistanceMatrix = None
+_worker_cells: np.ndarray = None
+
+def _initWorker(rows: Callable[[int, int], np.ndarray], path: str, cells: np.ndarray = None):
+  global _worker_rows, _worker_matrix, _worker_cells
+  _worker_rows = rows
+  _worker_matrix = DistanceMatrix(path, 'r+')
+  _worker_cells = cells
+
+def _computeBlock(block: int, start: int, stop: int) -> int:
+  """
+  Computes the rows of the grid cells in [start, stop) (or of
+  `cells[start:stop]`) and writes them straight into the memory-mapped matrix.
+  """
+  if _worker_cells is None:
+    _worker_matrix.writeRows(start, _worker_rows(start, stop))
+  else:
+    # Scattered rows are patched in place, along with their transposed columns.
+    cells = _worker_cells[start:stop]
+    values = _worker_matrix.quantize(_worker_rows(start, stop))
+    _worker_matrix.data[cells] = values
+    if _worker_matrix.transposed is not None:
+      _worker_matrix.transposed[:, cells] = values.T
+  _worker_matrix.flush()
+  return block
+
+def _loadProgress(progress_path: str, cells: int, block_size: int) -> Set[int]:
+  if not os.path.exists(progress_path):
+    return set()
+
+  with open(progress_path, 'r') as file:
+    progress = json.load(file)
+
+  if progress['cells'] != cells or progress['block_size'] != block_size:
+    print('Progress file does not match this build, starting over...')
+    return set()
+  return set(progress['done'])
+
+def _saveProgress(progress_path: str, cells: int, block_size: int, done: Set[int]):
+  with open(progress_path + '.tmp', 'w') as file:
+    json.dump({'cells': cells, 'block_size': block_size, 'done': sorted(done)}, file)
+  os.replace(progress_path + '.tmp', progress_path)
+
+def compute_distance_matrix(rows: Callable[[int, int], np.ndarray], path: str, workers: int = None,
+                            block_size: int = 64, resume: bool = False, profiler: StageProfiler = None,
+                            cells: np.ndarray = None):
+  """
+  Computes the shortest times between every pair of grid cells into the
+  distance matrix file at `path`, which must already have been created with
+  `DistanceMatrix.create`. `rows(start, stop)` returns the matrix rows of the
+  grid cells in [start, stop), e.g. `DijkstraRows` or `CondensedRows`.
+
+  Blocks of source rows are spread over a pool of `workers` processes, each of
+  which writes its rows directly into the memory-mapped output file. Completed
+  blocks are recorded in `path + '.progress'`, so an interrupted run can pick up
+  where it left off with `resume=True`. With `workers=0` all rows are computed
+  in this process instead (e.g. for profiling the hot loop).
+
+  With `cells`, only the rows of those cells are recomputed and patched into
+  an existing matrix (and its transposed copy): `rows(start, stop)` then
+  returns the rows of `cells[start:stop]`, e.g. `SelectedRows`. Such partial
+  runs are not recorded for resuming.
+
+  Progress (rows done, rows/s and ETA) is reported through `profiler`.
+  """
+  profiler = profiler or NullProfiler()
+  selected = cells
+  cells = DistanceMatrix(path).cells if selected is None else selected.size
+  progress_path = path + '.progress'
+  blocks = [(block, start, min(start + block_size, cells)) for block, start in enumerate(range(0, cells, block_size))]
+
+  done = _loadProgress(progress_path, cells, block_size) if resume else set()
+  pending = [block for block in blocks if block[0] not in done]
+  rows_total = sum(stop - start for _, start, stop in pending)
+  if len(done) > 0:
+    print('Resuming with %d of %d blocks done...' % (len(done), len(blocks)))
+
+  rows_done = 0
+  start_time = time.time()
+  def onBlockDone(block: int, start: int, stop: int):
+    nonlocal rows_done
+    done.add(block)
+    if selected is None:
+      _saveProgress(progress_path, cells, block_size, done)
+
+    rows_done += stop - start
+    rows_per_sec = rows_done / max(time.time() - start_time, 1e-9)
+    eta_seconds = (rows_total - rows_done) / rows_per_sec
+    profiler.progress(rows_done=rows_done, rows_total=rows_total, rows_per_sec=rows_per_sec, eta_seconds=eta_seconds)
+    print('%f%% done, %.1f rows/s, est. remaining: %.2f minutes...' % (
+      100 * len(done) / len(blocks),
+      rows_per_sec,
+      eta_seconds / 60
+    ))
+
+  if workers == 0:
+    _initWorker(rows, path, selected)
+    for block in pending:
+      _computeBlock(*block)
+      onBlockDone(*block)
+  else:
+    with ProcessPoolExecutor(workers, initializer=_initWorker, initargs=(rows, path, selected)) as executor:
+      futures = {executor.submit(_computeBlock, *block): block for block in pending}
+      for future in as_completed(futures):
+        future.result()
+        onBlockDone(*futures[future])
+
+  if os.path.exists(progress_path):
+    os.remove(progress_path)
@@ -0,0 +1,173 @@
+"""
+Time-of-day travel times over the timetable.
+
+Instead of the static graph's fixed boarding cost of half the median wait, a
+route can only be boarded at a stop when one of its trips passes there. All
+trips of a route share its stop offsets, so the trip departing at d reaches
+stop k at d + t_k and trips of the same route never overtake each other.
+Earliest arrivals are found in rounds, each allowing one more trip:
+
+* at every route stop, the first trip passing no earlier than the earliest
+  arrival at its station is found by binary search in a single sorted table
+  of (route, departure) keys,
+* riding on, the trip reached at each stop is the earliest one boarded at it
+  or at any stop before it, which is a running minimum along the route,
+* alighting improves the arrivals at stations and walking on from them (a
+  walking transform over the grid, see `condensation.py`) those at cells.
+
+Every step is an array operation over a batch of origins, so a single query
+takes milliseconds and full rows are computed in batches, just like the rows
+of the static distance matrix.
+"""
+
+import numpy as np
+from typing import Sequence
+from condensation import walking_transform
+from transit import Grid, TransitNetwork
+
+def parse_clock(time: str) -> float:
+  """
+  Parses 'HH:MM' into minutes since midnight.
+  """
+  hours, minutes = time.split(':')
+  return int(hours) * 60 + int(minutes)
+
+def departure_window(start: float, minutes: float, samples: int) -> np.ndarray:
+  """
+  Returns `samples` departure times spread evenly over a window.
+  """
+  return start + np.arange(samples) * (minutes / samples)
+
+class TimetableEngine:
+  """
+  Answers earliest arrival queries from grid cells at given departure times.
+  Rounds are repeated until no arrival improves, unless `max_rounds` caps the
+  number of trips taken.
+  """
+
+  def __init__(self, network: TransitNetwork, grid: Grid, max_rounds: int = None):
+    self.grid = grid
+    self.max_rounds = max_rounds
+    self.num_stations = network.num_stations
+
+    # Stations inside the grid and their cells, also sorted by cell so that
+    # arrivals can be reduced per cell.
+    inside = grid.contains(network.station_lat, network.station_lon)
+    self.inside = np.flatnonzero(inside)
+    cell_x, cell_y = grid.cellOf(network.station_lat[inside], network.station_lon[inside])
+    self.station_cells = grid.cellToNode(cell_x, cell_y)
+    order = np.argsort(self.station_cells, kind='stable')
+    self.stations_by_cell = self.inside[order]
+    self.cells_with_stations, self.cell_starts = np.unique(self.station_cells[order], return_index=True)
+
+    # Route stops, also sorted by station so that arrivals can be reduced per
+    # station, and their places in a padded (routes, longest route) layout.
+    self.stop_stations = network.stop_stations
+    self.stop_times = network.stop_times
+    self.stops_by_station = np.argsort(self.stop_stations, kind='stable')
+    self.served_stations, self.station_starts = np.unique(
+      self.stop_stations[self.stops_by_station], return_index=True
+    )
+    route_lengths = np.diff(network.route_offsets)
+    self.num_routes = route_lengths.size
+    self.longest_route = int(route_lengths.max()) if route_lengths.size > 0 else 0
+    self.stop_routes = np.repeat(np.arange(self.num_routes), route_lengths)
+    self.stop_positions = np.arange(network.num_stops) - network.route_offsets[self.stop_routes]
+
+    # All trips as one sorted table of keys, route * key_span + departure.
+    self.trip_departures = network.trip_departures
+    self.trip_ends = network.trip_offsets[1:]
+    self.latest = float(self.trip_departures.max()) + 1 if self.trip_departures.size > 0 else 1
+    self.key_span = self.latest + 1
+    trip_routes = np.repeat(np.arange(self.num_routes), np.diff(network.trip_offsets))
+    self.trip_keys = trip_routes * self.key_span + self.trip_departures
+
+  def ride(self, station_arrivals: np.ndarray) -> np.ndarray:
+    """
+    Given the earliest arrivals at every station (batch, stations), returns
+    the earliest arrivals at every station by taking one more trip.
+    """
+    batch = station_arrivals.shape[0]
+
+    # The first trip of each route passing each stop after arriving there.
+    needed = np.clip(station_arrivals[:, self.stop_stations] - self.stop_times, 0, self.latest)
+    trips = np.searchsorted(self.trip_keys, self.stop_routes * self.key_span + needed)
+    boarded = np.full(trips.shape, np.inf)
+    found = trips < self.trip_ends[self.stop_routes]
+    boarded[found] = self.trip_departures[trips[found]]
+
+    # The earliest trip boarded at or before each stop of a route.
+    along_routes = np.full((batch, self.num_routes, self.longest_route), np.inf)
+    along_routes[:, self.stop_routes, self.stop_positions] = boarded
+    np.minimum.accumulate(along_routes, axis=2, out=along_routes)
+    arrivals = along_routes[:, self.stop_routes, self.stop_positions] + self.stop_times
+
+    result = np.full((batch, self.num_stations), np.inf)
+    if self.served_stations.size > 0:
+      result[:, self.served_stations] = np.minimum.reduceat(
+        arrivals[:, self.stops_by_station], self.station_starts, axis=1
+      )
+    return result
+
+  def arrivals(self, origins: Sequence[int], departure: float) -> np.ndarray:
+    """
+    Returns the earliest arrival times (minutes since midnight) at every cell,
+    one row per origin cell, leaving at `departure`.
+    """
+    origins = np.asarray(origins, dtype=np.int64)
+    batch, cells = origins.size, self.grid.cells
+
+    seeds = np.full((batch, cells), np.inf)
+    seeds[np.arange(batch), origins] = departure
+    cell_arrivals = walking_transform(seeds, self.grid)
+    station_arrivals = np.full((batch, self.num_stations), np.inf)
+    station_arrivals[:, self.inside] = cell_arrivals[:, self.station_cells]
+
+    # Only origins with arrivals improved in the last round need another one.
+    active = np.arange(batch)
+    rounds = 0
+    while active.size > 0 and (self.max_rounds is None or rounds < self.max_rounds):
+      rounds += 1
+      ridden = self.ride(station_arrivals[active])
+      improved = ridden < station_arrivals[active]
+      still_improving = improved.any(axis=1)
+      active, ridden, improved = active[still_improving], ridden[still_improving], improved[still_improving]
+      if active.size == 0:
+        break
+      station_arrivals[active] = np.minimum(station_arrivals[active], ridden)
+
+      # Walk on from the stations reached earlier than before.
+      seeds = np.full((active.size, cells), np.inf)
+      if self.cells_with_stations.size > 0:
+        alighted = np.where(improved, ridden, np.inf)[:, self.stations_by_cell]
+        seeds[:, self.cells_with_stations] = np.minimum.reduceat(alighted, self.cell_starts, axis=1)
+      walked = np.minimum(cell_arrivals[active], walking_transform(seeds, self.grid))
+      cell_arrivals[active] = walked
+      station_arrivals[np.ix_(active, self.inside)] = np.minimum(
+        station_arrivals[np.ix_(active, self.inside)], walked[:, self.station_cells]
+      )
+
+    return cell_arrivals
+
+  def travelTimes(self, origins: Sequence[int], departure: float) -> np.ndarray:
+    """
+    Returns the travel times in minutes from each origin cell to every cell.
+    """
+    return self.arrivals(origins, departure) - departure
+
+class TimetableRows:
+  """
+  Computes rows of a time-of-day distance matrix: the travel times from each
+  cell averaged over a set of departure times (e.g. a rush hour window).
+  """
+
+  def __init__(self, engine: TimetableEngine, departures: Sequence[float]):
+    self.engine = engine
+    self.departures = np.asarray(departures, dtype=float)
+
+  def __call__(self, start: int, stop: int) -> np.ndarray:
+    origins = np.arange(start, stop)
+    total = np.zeros((origins.size, self.engine.grid.cells))
+    for departure in self.departures:
+      total += self.engine.travelTimes(origins, departure)
+    return total / self.departures.size
@@ -0,0 +1,451 @@
+import hashlib
+import json
+import os
+import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+from typing import Dict, List, Tuple
+from profiling import NullProfiler, StageProfiler
+
+# Bounding box of the map (see sofia.jpg).
+EASTMOST_LAT = 23.19
+WESTMOST_LAT = 23.47
+NORTHMOST_LON = 42.79
+SOUTHMOST_LON = 42.60
+
+BOUNDING_BOX = {'east': EASTMOST_LAT, 'west': WESTMOST_LAT, 'north': NORTHMOST_LON, 'south': SOUTHMOST_LON}
+
+COVER_LAT = abs(EASTMOST_LAT - WESTMOST_LAT)
+COVER_LON = abs(NORTHMOST_LON - SOUTHMOST_LON)
+
+DEGREE_OF_LAT_IN_KM = 85
+DEGREE_OF_LON_IN_KM = 111
+
+WALKING_SPEED_KMH = 4.5
+
+ROUTES_FILE = 'routes.txt'
+STOPS_FILE = 'stops-bg.json'
+NETWORK_CACHE_FILE = 'transit_network.npz'
+
+# Hours of service assumed for routes scraped without departure times, which
+# are then taken to run every `median_wait` minutes.
+SERVICE_START = 5 * 60
+SERVICE_END = 24 * 60
+
+def file_digest(path: str) -> str:
+  """
+  Returns the SHA-256 hex digest of a file's contents.
+  """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file:
+    for chunk in iter(lambda: file.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def route_fingerprints(routes: List[dict]) -> List[str]:
+  """
+  Returns a SHA-256 hex digest of each route's stops and median wait, so that
+  changed routes can be told apart from unchanged ones between scrapes.
+  """
+  return [hashlib.sha256(json.dumps(route, sort_keys=True).encode('utf8')).hexdigest() for route in routes]
+
+class Grid:
+  """
+  A regular grid of map cells covering the bounding box. Cell (x, y) has node
+  number y * width + x, with y growing northwards.
+  """
+
+  def __init__(self, width: int, height: int):
+    self.width = width
+    self.height = height
+    self.cells = width * height
+
+    self.cell_width = COVER_LAT / width * DEGREE_OF_LAT_IN_KM
+    self.cell_height = COVER_LON / height * DEGREE_OF_LON_IN_KM
+    self.diagonal_len = np.sqrt(self.cell_width ** 2 + self.cell_height ** 2)
+
+    # Walking times across a single cell, in minutes.
+    self.walk_x = self.cell_width / WALKING_SPEED_KMH * 60
+    self.walk_y = self.cell_height / WALKING_SPEED_KMH * 60
+    self.walk_diagonal = self.diagonal_len / WALKING_SPEED_KMH * 60
+
+  def cellToNode(self, x, y):
+    return y * self.width + x
+
+  def contains(self, lat, lon):
+    """
+    Returns a boolean mask of which coordinates fall strictly within the map.
+    """
+    return (lat > EASTMOST_LAT) & (lat < WESTMOST_LAT) & (lon > SOUTHMOST_LON) & (lon < NORTHMOST_LON)
+
+  def cellOf(self, lat, lon):
+    """
+    Returns the (x, y) cell coordinates of arrays of coordinates within the map.
+    """
+    cell_x = np.floor((lat - EASTMOST_LAT) / COVER_LAT * self.width).astype(np.int64)
+    cell_y = np.floor((lon - SOUTHMOST_LON) / COVER_LON * self.height).astype(np.int64)
+    return cell_x, cell_y
+
+  def cellCenters(self):
+    """
+    Returns the (x, y) kilometres east and north of the map's south-west
+    corner of every cell's centre, in node order.
+    """
+    nodes = np.arange(self.cells)
+    return (nodes % self.width + 0.5) * self.cell_width, (nodes // self.width + 0.5) * self.cell_height
+
+def to_km(lat, lon):
+  """
+  Returns the (x, y) kilometres east and north of the map's south-west corner
+  of arrays of coordinates.
+  """
+  return (np.asarray(lat) - EASTMOST_LAT) * DEGREE_OF_LAT_IN_KM, (np.asarray(lon) - SOUTHMOST_LON) * DEGREE_OF_LON_IN_KM
+
+def walking_minutes(km):
+  return np.asarray(km) / WALKING_SPEED_KMH * 60
+
+class StationIndex:
+  """
+  A KD-tree over station coordinates (in kilometres, see `to_km`), answering
+  which stations are near points on the map: the nearest few to one point
+  (e.g. the hovered cell) in microseconds, or every (point, station) pair
+  within a radius for many points at once.
+  """
+
+  def __init__(self, lat: np.ndarray, lon: np.ndarray, names: np.ndarray = None):
+    self.x, self.y = to_km(lat, lon)
+    self.names = names
+    self.tree = cKDTree(np.column_stack([self.x, self.y]))
+
+  @staticmethod
+  def fromNetwork(network: 'TransitNetwork') -> 'StationIndex':
+    return StationIndex(network.station_lat, network.station_lon, network.station_names)
+
+  def nearest(self, x: float, y: float, count: int = 5, radius: float = np.inf) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the indices of up to `count` stations nearest to a point, within
+    `radius` km, and their distances in km, nearest first.
+    """
+    count = min(count, self.x.size)
+    if count == 0:
+      return np.empty(0, dtype=np.int64), np.empty(0)
+    distances, stations = self.tree.query([x, y], k=count, distance_upper_bound=radius)
+    distances, stations = np.atleast_1d(distances), np.atleast_1d(stations)
+    found = np.isfinite(distances)
+    return stations[found].astype(np.int64), distances[found]
+
+  def within(self, x: np.ndarray, y: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns every (point, station) pair within `radius` km as arrays of
+    point indices, station indices and distances in km.
+    """
+    points = cKDTree(np.column_stack([x, y]))
+    pairs = points.sparse_distance_matrix(self.tree, radius, output_type='ndarray')
+    return pairs['i'].astype(np.int64), pairs['j'].astype(np.int64), pairs['v']
+
+class TransitNetwork:
+  """
+  The contents of routes.txt and stops-bg.json parsed into arrays: stations
+  (codes, names, coordinates) and route stops stored CSR-style, the stops of
+  route `i` being `route_offsets[i]:route_offsets[i + 1]`. Each stop has its
+  station's index and its minutes since the start of the route.
+
+  The trips of route `i` are stored the same way: their departures from the
+  first stop, in minutes since midnight, are
+  `trip_departures[trip_offsets[i]:trip_offsets[i + 1]]`, sorted.
+
+  Parsed networks are cached in a .npz file keyed by hashes of the source
+  files (see `load_network`).
+  """
+
+  def __init__(self, station_codes: np.ndarray, station_names: np.ndarray, station_lat: np.ndarray,
+               station_lon: np.ndarray, route_offsets: np.ndarray, stop_stations: np.ndarray, stop_times: np.ndarray,
+               route_waits: np.ndarray, trip_offsets: np.ndarray, trip_departures: np.ndarray,
+               timetabled: np.ndarray, fingerprints: List[str], sources: Dict[str, str] = None):
+    self.station_codes = station_codes
+    self.station_names = station_names
+    self.station_lat = np.asarray(station_lat, dtype=float)
+    self.station_lon = np.asarray(station_lon, dtype=float)
+    self.route_offsets = np.asarray(route_offsets, dtype=np.int64)
+    self.stop_stations = np.asarray(stop_stations, dtype=np.int64)
+    self.stop_times = np.asarray(stop_times, dtype=float)
+    self.route_waits = np.asarray(route_waits, dtype=float)
+    self.trip_offsets = np.asarray(trip_offsets, dtype=np.int64)
+    self.trip_departures = np.asarray(trip_departures, dtype=float)
+    self.timetabled = np.asarray(timetabled, dtype=bool)
+    self.fingerprints = list(fingerprints)
+    self.sources = sources or {}
+
+    self.num_stations = self.station_lat.size
+    self.num_routes = self.route_waits.size
+    self.num_stops = self.stop_times.size
+    self.num_trips = self.trip_departures.size
+
+  @staticmethod
+  def fromJson(routes: List[dict], stations: List[dict]) -> 'TransitNetwork':
+    station_index = {station['c']: index for index, station in enumerate(stations)}
+    stops = [stop for route in routes for stop in route['stops']]
+    route_lengths = np.array([len(route['stops']) for route in routes], dtype=np.int64)
+    departures = [route_departures(route) for route in routes]
+
+    return TransitNetwork(
+      np.array([station['c'] for station in stations], dtype=str),
+      np.array([station['n'] for station in stations], dtype=str),
+      np.array([station['x'] for station in stations], dtype=float),
+      np.array([station['y'] for station in stations], dtype=float),
+      np.concatenate([[0], np.cumsum(route_lengths)]),
+      np.array([station_index[stop[1]] for stop in stops], dtype=np.int64),
+      parse_stop_times([stop[0] for stop in stops]),
+      np.array([route['median_wait'] for route in routes], dtype=float),
+      np.concatenate([[0], np.cumsum([trips.size for trips in departures])]),
+      np.concatenate(departures) if departures else np.empty(0),
+      np.array(['departures' in route for route in routes], dtype=bool),
+      route_fingerprints(routes)
+    )
+
+  @staticmethod
+  def fromFiles(routes_path: str = ROUTES_FILE, stops_path: str = STOPS_FILE) -> 'TransitNetwork':
+    with open(routes_path, 'r') as file:
+      routes = json.load(file)
+    with open(stops_path, 'r', encoding='utf8') as file:
+      stations = json.load(file)
+
+    network = TransitNetwork.fromJson(routes, stations)
+    network.sources = {routes_path: file_digest(routes_path), stops_path: file_digest(stops_path)}
+    return network
+
+  @staticmethod
+  def load(path: str = NETWORK_CACHE_FILE) -> 'TransitNetwork':
+    with np.load(path) as cache:
+      return TransitNetwork(
+        cache['station_codes'], cache['station_names'], cache['station_lat'], cache['station_lon'],
+        cache['route_offsets'], cache['stop_stations'], cache['stop_times'], cache['route_waits'],
+        cache['trip_offsets'], cache['trip_departures'], cache['timetabled'], cache['fingerprints'].tolist(), json.loads(str(cache['sources']))
+      )
+
+  def save(self, path: str = NETWORK_CACHE_FILE):
+    with open(path + '.tmp', 'wb') as file:
+      np.savez(
+        file,
+        station_codes=self.station_codes,
+        station_names=self.station_names,
+        station_lat=self.station_lat,
+        station_lon=self.station_lon,
+        route_offsets=self.route_offsets,
+        stop_stations=self.stop_stations.astype(np.int32),
+        stop_times=self.stop_times,
+        route_waits=self.route_waits,
+        trip_offsets=self.trip_offsets,
+        trip_departures=self.trip_departures,
+        timetabled=self.timetabled,
+        fingerprints=np.array(self.fingerprints, dtype=str),
+        sources=json.dumps(self.sources)
+      )
+    os.replace(path + '.tmp', path)
+
+  def stopWaits(self) -> np.ndarray:
+    """
+    The median wait of each stop's route.
+    """
+    return np.repeat(self.route_waits, np.diff(self.route_offsets))
+
+def load_network(routes_path: str = ROUTES_FILE, stops_path: str = STOPS_FILE,
+                 cache_path: str = NETWORK_CACHE_FILE) -> TransitNetwork:
+  """
+  Loads the parsed network from the cache at `cache_path` if it was made from
+  the current source files, or parses them and refreshes the cache otherwise.
+  """
+  sources = {routes_path: file_digest(routes_path), stops_path: file_digest(stops_path)}
+  if cache_path is not None and os.path.exists(cache_path):
+    try:
+      network = TransitNetwork.load(cache_path)
+      if network.sources == sources:
+        return network
+    except (OSError, ValueError, KeyError):
+      pass
+
+  network = TransitNetwork.fromFiles(routes_path, stops_path)
+  if cache_path is not None:
+    try:
+      network.save(cache_path)
+    except OSError as error:
+      print('Could not save the network cache to %s: %s' % (cache_path, error))
+  return network
+
+class TransitGraph:
+  """
+  The full weighted directed graph as a CSR adjacency matrix of minutes.
+
+  Nodes are laid out as grid cells first, then stations (in stops-bg.json
+  order) and then route stops (in routes.txt order).
+  """
+
+  def __init__(self, matrix: sparse.csr_matrix, grid: Grid, num_stations: int, num_stops: int):
+    self.matrix = matrix
+    self.grid = grid
+    self.num_stations = num_stations
+    self.num_stops = num_stops
+    self.num_nodes = matrix.shape[0]
+
+def parse_stop_times(times) -> np.ndarray:
+  """
+  Parses an array of stop time strings such as '+6 - 7' into the average
+  number of minutes since the start of the route. The first stop ('***') is 0.
+  """
+  times = np.asarray(times, dtype=str)
+  times = np.where(times == '***', '0', times)
+  parts = np.char.partition(times, '-')
+  low = np.char.strip(parts[:, 0]).astype(float)
+  high_str = np.char.strip(parts[:, 2])
+  high = low.copy()
+  has_high = high_str != ''
+  high[has_high] = high_str[has_high].astype(float)
+  return (low + high) / 2
+
+def parse_departures(times: List[str]) -> np.ndarray:
+  """
+  Parses departure times ('HH:MM') into minutes since midnight. Times past
+  midnight at the end of a timetable are counted into the next day.
+  """
+  minutes = np.array([int(time[:-3]) * 60 + int(time[-2:]) for time in times], dtype=float)
+  if minutes.size > 1:
+    minutes += 24 * 60 * np.concatenate([[0], np.cumsum(np.diff(minutes) < 0)])
+  return minutes
+
+def route_departures(route: dict) -> np.ndarray:
+  """
+  Returns a route's sorted departures from its first stop, falling back to a
+  regular service every `median_wait` minutes if none were scraped.
+  """
+  if 'departures' in route:
+    return np.sort(parse_departures(route['departures']))
+  return np.arange(SERVICE_START, SERVICE_END, max(route['median_wait'], 1), dtype=float)
+
+def grid_edges(grid: Grid):
+  """
+  Returns the (sources, targets, weights) of the walking edges between every
+  cell and its eight neighbours.
+  """
+  nodes = np.arange(grid.cells).reshape(grid.height, grid.width)
+  offsets = [
+    (-1, 0, grid.walk_x), (1, 0, grid.walk_x),
+    (0, -1, grid.walk_y), (0, 1, grid.walk_y),
+    (-1, -1, grid.walk_diagonal), (-1, 1, grid.walk_diagonal),
+    (1, -1, grid.walk_diagonal), (1, 1, grid.walk_diagonal),
+  ]
+
+  sources, targets, weights = [], [], []
+  for dx, dy, weight in offsets:
+    src = nodes[max(0, -dy):grid.height - max(0, dy), max(0, -dx):grid.width - max(0, dx)]
+    dst = nodes[max(0, dy):grid.height - max(0, -dy), max(0, dx):grid.width - max(0, -dx)]
+    sources.append(src.ravel())
+    targets.append(dst.ravel())
+    weights.append(np.full(src.size, weight))
+
+  return np.concatenate(sources), np.concatenate(targets), np.concatenate(weights)
+
+def station_cell_edges(lat: np.ndarray, lon: np.ndarray, grid: Grid, walk_radius: float = 0):
+  """
+  Returns the edges in both directions between each station and the cell
+  containing it, of zero weight. With a `walk_radius` (in km), each station
+  is instead linked to every cell whose centre is within that radius, and
+  always to its own cell, weighted by the time to walk to the cell's centre.
+  """
+  station_nodes = np.arange(lat.size) + grid.cells
+
+  inside = grid.contains(lat, lon)
+  cell_x, cell_y = grid.cellOf(lat[inside], lon[inside])
+  cell_nodes = grid.cellToNode(cell_x, cell_y)
+  station_nodes = station_nodes[inside]
+  weights = np.zeros(cell_nodes.size)
+
+  if walk_radius > 0:
+    station_x, station_y = to_km(lat[inside], lon[inside])
+    center_x, center_y = grid.cellCenters()
+    weights = walking_minutes(np.hypot(center_x[cell_nodes] - station_x, center_y[cell_nodes] - station_y))
+
+    nearby_cells, nearby_stations, km = StationIndex(lat, lon).within(center_x, center_y, walk_radius)
+    cell_nodes = np.concatenate([cell_nodes, nearby_cells])
+    station_nodes = np.concatenate([station_nodes, nearby_stations + grid.cells])
+    weights = np.concatenate([weights, walking_minutes(km)])
+
+  sources = np.concatenate([cell_nodes, station_nodes])
+  targets = np.concatenate([station_nodes, cell_nodes])
+  return sources, targets, np.concatenate([weights, weights])
+
+def station_route_edges(stop_stations: np.ndarray, stop_waits: np.ndarray, first_stop_node: int):
+  """
+  Returns the boarding edges (half the median wait) from stations to route
+  stops and the zero-weight alighting edges back.
+  """
+  stop_nodes = np.arange(stop_stations.size) + first_stop_node
+  sources = np.concatenate([stop_stations, stop_nodes])
+  targets = np.concatenate([stop_nodes, stop_stations])
+  weights = np.concatenate([stop_waits / 2, np.zeros(stop_nodes.size)])
+  return sources, targets, weights
+
+def route_chain_edges(stop_times: np.ndarray, route_offsets: np.ndarray, first_stop_node: int):
+  """
+  Returns the travel edges between consecutive stops of every route.
+  """
+  stop_nodes = np.arange(stop_times.size) + first_stop_node
+  consecutive = np.ones(stop_times.size, dtype=bool)
+  consecutive[route_offsets[:-1]] = False # First stop of a route has no predecessor.
+  consecutive = np.flatnonzero(consecutive)
+
+  sources = stop_nodes[consecutive - 1]
+  targets = stop_nodes[consecutive]
+  weights = stop_times[consecutive] - stop_times[consecutive - 1]
+  return sources, targets, weights
+
+def edges_to_csr(edges, num_nodes: int) -> sparse.csr_matrix:
+  """
+  Assembles lists of (sources, targets, weights) into a CSR matrix, keeping the
+  lightest of any parallel edges. Zero weights are kept as explicit edges.
+  """
+  sources = np.concatenate([e[0] for e in edges]).astype(np.int64)
+  targets = np.concatenate([e[1] for e in edges]).astype(np.int64)
+  weights = np.concatenate([e[2] for e in edges]).astype(float)
+
+  keys = sources * num_nodes + targets
+  unique_keys, inverse = np.unique(keys, return_inverse=True)
+  unique_weights = np.full(unique_keys.size, np.inf)
+  np.minimum.at(unique_weights, inverse, weights)
+
+  return sparse.csr_matrix(
+    (unique_weights, (unique_keys // num_nodes, unique_keys % num_nodes)),
+    shape=(num_nodes, num_nodes)
+  )
+
+def build_graph(network: TransitNetwork, grid: Grid, profiler: StageProfiler = None,
+                walk_radius: float = 0) -> TransitGraph:
+  """
+  Builds the full transit graph of a network over a grid, linking stations to
+  the cells within `walk_radius` km (see `station_cell_edges`). Each step is
+  recorded as a stage of `profiler`, if given.
+  """
+  profiler = profiler or NullProfiler()
+
+  # Nodes are numbered cells first, then stations, then route stops.
+  with profiler.stage('node mapping') as stage:
+    first_stop_node = grid.cells + network.num_stations
+    num_nodes = first_stop_node + network.num_stops
+    stop_station_nodes = network.stop_stations + grid.cells
+    stage.update(cells=grid.cells, stations=network.num_stations, stops=network.num_stops)
+
+  edges = []
+  for name, make_edges in [
+    ('walking edges', lambda: grid_edges(grid)),
+    ('station to cell', lambda: station_cell_edges(network.station_lat, network.station_lon, grid, walk_radius)),
+    ('station to route', lambda: station_route_edges(stop_station_nodes, network.stopWaits(), first_stop_node)),
+    ('route chaining', lambda: route_chain_edges(network.stop_times, network.route_offsets, first_stop_node)),
+  ]:
+    with profiler.stage(name) as stage:
+      edges.append(make_edges())
+      stage['edges'] = int(edges[-1][0].size)
+
+  with profiler.stage('graph assembly') as stage:
+    matrix = edges_to_csr(edges, num_nodes)
+    stage.update(nodes=num_nodes, edges=int(matrix.nnz))
+
+  return TransitGraph(matrix, grid, network.num_stations, network.num_stops)
@@ -1,8 +1,10 @@
 import cv2
 import argparse
 import numpy as np
-import colorsys
-import math
+from aggregation import REDUCERS, OriginAggregate
+from distance_matrix import DISTANCE_MATRIX_FILE, DistanceMatrix
+from heatmap import heat_colors
+from query_engine import DistanceQueryEngine
 
 WINDOW_WIDTH = 970
 WINDOW_HEIGHT = 896
@@ -11,71 +13,87 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-x', required=False, type=int, dest='x', default=0)
 parser.add_argument('-y', required=False, type=int, dest='y', default=0)
 parser.add_argument('-d', '--direction', default='to', choices=['to', 'from'], dest='direction')
-parser.add_argument('--width', required=True, type=int, dest='width')
-parser.add_argument('--height', required=True, type=int, dest='height')
+parser.add_argument('--width', required=False, type=int, dest='width')
+parser.add_argument('--height', required=False, type=int, dest='height')
+parser.add_argument('--matrix', default=DISTANCE_MATRIX_FILE, dest='matrix')
+parser.add_argument('--on-demand', action='store_true', dest='on_demand')
+parser.add_argument('--walk-radius', default=0, type=float, dest='walk_radius')
+parser.add_argument('--reducer', default='max', choices=REDUCERS, dest='reducer')
+parser.add_argument('--percentile', default=50, type=float, dest='percentile')
 args = parser.parse_args()
 
-CELLS_X = args.width
-CELLS_Y = args.height
+if args.on_demand:
+  # Compute distances for the selected cells only, without a prebuilt matrix.
+  if args.width is None or args.height is None:
+    parser.error('--on-demand requires --width and --height')
+  distance = DistanceQueryEngine.fromFiles(args.width, args.height, walk_radius=args.walk_radius)
+else:
+  distance = DistanceMatrix(args.matrix)
 
-selected = [args.x + args.y * CELLS_Y]
+# The grid size is read from the matrix file; --width/--height are only checked.
+if (args.width or distance.width) != distance.width or (args.height or distance.height) != distance.height:
+  parser.error('%s was built for a %dx%d grid' % (args.matrix, distance.width, distance.height))
 
-heatmap = np.full((CELLS_X, CELLS_Y, 3), 0)
+CELLS_X = distance.width
+CELLS_Y = distance.height
 
-distance = np.load('distance_matrix.npy')
+selected = [args.x + args.y * CELLS_X]
 
-def distance_to_color(distance):
-  # if distance == 0: return np.array([1, 1, 1])
-  min_heat = cv2.getTrackbarPos('minheat', 'Heatmap')
-  max_heat = cv2.getTrackbarPos('maxheat', 'Heatmap')
-  heat_range = max_heat - min_heat
-  out = colorsys.hsv_to_rgb(
-    min(max(distance-min_heat, 0), heat_range) / ((heat_range)*1.5),
-    1,
-    1 - min(max(distance-min_heat, 0), heat_range) / (heat_range) / 2
-  )
-  # out = colorsys.hsv_to_rgb(math.log10(distance), 1, 1 - min(distance, 90) / 180)
-  return np.array(out)
-
-def extract_array(list_of_points, direction):
-  global distance
-  if direction == 'from':
-    return np.max(distance[list_of_points, :], axis=0)
-  else:
-    return np.max(distance[:, list_of_points], axis=1)
+heatmap = np.full((CELLS_Y, CELLS_X, 3), 0)
+
+# The background never changes, so decode it once.
+sofia = cv2.imread('sofia.jpg', flags=cv2.IMREAD_COLOR).astype(np.float32) / 255
+
+# Distances for the current selection, updated with only the cells added or
+# removed when it changes.
+selected_array = None
+aggregate = OriginAggregate(
+  distance.rows if args.direction == 'from' else distance.columns, distance.cells, args.reducer, args.percentile
+)
+
+# Set by the mouse and trackbar callbacks; the main loop redraws at most once
+# per REDRAW_INTERVAL_MS, coalescing bursts of trackbar events.
+REDRAW_INTERVAL_MS = 15
+needs_redraw = True
+
+def extract_array(list_of_points):
+  global aggregate
+  aggregate.set(list_of_points)
+  return aggregate.result()
 
 def compute_heatmap(array):
   global CELLS_X, CELLS_Y, heatmap
 
-  heatmap = np.empty((CELLS_X, CELLS_Y, 3))
-  for x in range(CELLS_X):
-    for y in range(CELLS_Y):
-      heatmap[y, x, :] = distance_to_color(array[x + (CELLS_Y - y - 1)*CELLS_X])
+  # Read the trackbars once per frame rather than once per cell.
+  min_heat = cv2.getTrackbarPos('minheat', 'Heatmap')
+  max_heat = cv2.getTrackbarPos('maxheat', 'Heatmap')
+
+  # Grid rows grow northwards, image rows southwards.
+  cells = np.asarray(array).reshape(CELLS_Y, CELLS_X)[::-1]
+  heatmap = heat_colors(cells, min_heat, max_heat).astype(np.float32)
 
   heatmap = cv2.resize(heatmap, (WINDOW_WIDTH, WINDOW_HEIGHT), interpolation=cv2.INTER_LINEAR)
-  sofia = cv2.imread('sofia.jpg', flags=cv2.IMREAD_COLOR)
-  heatmap = cv2.addWeighted(heatmap, 0.5, np.array(sofia, dtype=float)/255, 0.5, 0)
+  heatmap = cv2.addWeighted(heatmap, 0.5, sofia, 0.5, 0)
 
 def on_click(event, x, y, flags, param):
-  global WINDOW_WIDTH, WINDOW_HEIGHT, CELLS_X, CELLS_Y, selected
+  global WINDOW_WIDTH, WINDOW_HEIGHT, CELLS_X, CELLS_Y, selected, selected_array, needs_redraw
   if event == cv2.EVENT_LBUTTONDOWN:
     box_clicked_x = int(x / WINDOW_WIDTH * CELLS_X)
     box_clicked_y = int((WINDOW_HEIGHT - y) / WINDOW_HEIGHT * CELLS_Y)
     if flags & cv2.EVENT_FLAG_SHIFTKEY == cv2.EVENT_FLAG_SHIFTKEY:
-      if box_clicked_x + box_clicked_y * CELLS_Y in selected:
-        selected.remove(box_clicked_x + box_clicked_y * CELLS_Y)
+      if box_clicked_x + box_clicked_y * CELLS_X in selected:
+        selected.remove(box_clicked_x + box_clicked_y * CELLS_X)
       else:
-        selected.append(box_clicked_x + box_clicked_y * CELLS_Y)
+        selected.append(box_clicked_x + box_clicked_y * CELLS_X)
     else:
-      selected = [box_clicked_x + box_clicked_y * CELLS_Y]
+      selected = [box_clicked_x + box_clicked_y * CELLS_X]
       
-    compute_heatmap(extract_array(selected, args.direction))
-    cv2.imshow('Heatmap', heatmap)
+    selected_array = extract_array(selected) if selected else None
+    needs_redraw = True
     
 def on_trackbar_change(value):
-  global selected, args, heatmap
-  compute_heatmap(extract_array(selected, args.direction))
-  cv2.imshow('Heatmap', heatmap)
+  global needs_redraw
+  needs_redraw = True
 
 if __name__ == '__main__':
   
@@ -84,8 +102,17 @@ if __name__ == '__main__':
   cv2.createTrackbar('maxheat', 'Heatmap', 90, 300, on_trackbar_change)
   cv2.setMouseCallback('Heatmap', on_click)
   
-  compute_heatmap(extract_array(selected, args.direction))
-  cv2.imshow('Heatmap', heatmap)
+  selected_array = extract_array(selected)
+
+  # Redraw whenever something changed, until a key is pressed or the window
+  # is closed.
+  while True:
+    if needs_redraw and selected_array is not None:
+      needs_redraw = False
+      compute_heatmap(selected_array)
+      cv2.imshow('Heatmap', heatmap)
+
+    if cv2.waitKey(REDRAW_INTERVAL_MS) != -1 or cv2.getWindowProperty('Heatmap', cv2.WND_PROP_VISIBLE) < 1:
+      break
 
-  cv2.waitKey()
   cv2.destroyAllWindows()